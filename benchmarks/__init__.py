@@ -0,0 +1,4 @@
+"""
+benchmarks - tools for timing the hcidemux pipeline without a sequencer,
+GNomEx, or a mail server.
+"""
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+fakebcl2fastq.py - stands in for Illumina's configureBclToFastq.pl (CASAVA
+1.8) and bcl2fastq (bcl2fastq2) when benchmarking the pipeline. It accepts
+the arguments the pipeline passes, and writes synthetic FASTQ output in the
+layout the real programs use, so everything downstream of bcl conversion
+runs on realistic file trees. The number of reads per file comes from the
+FAKE_BCL2FASTQ_READS environment variable (default 1000).
+
+	fakebcl2fastq.py configureBclToFastq.pl --input-dir ... --output-dir ...
+	fakebcl2fastq.py bcl2fastq --runfolder-dir ... --output-dir ...
+
+Like the real configureBclToFastq.pl, the first form only writes a
+Makefile into the output directory; running make produces the files.
+"""
+import os
+import sys
+import xml.dom.minidom
+
+from benchmarks import runfolder
+
+def ParseArgs( args ):
+	"""Returns dictionary of --option value pairs. Options without a
+	value map to True."""
+	options = {}
+	i = 0
+	while i < len(args):
+		if args[i].startswith('--'):
+			if i+1 < len(args) and not args[i+1].startswith('--'):
+				options[args[i]] = args[i+1]
+				i += 2
+				continue
+			options[args[i]] = True
+		i += 1
+	return options
+
+def ReadCycles( run_dir ):
+	"""Returns list of the number of cycles in each read of the run."""
+	doc = xml.dom.minidom.parse( os.path.join( run_dir, "RunInfo.xml" ) )
+	return [ int(read.getAttribute("NumCycles")) for read in doc.getElementsByTagName("Read") ]
+
+def Factory():
+	return runfolder.FastqFactory( int(os.environ.get('FAKE_BCL2FASTQ_READS','1000')) )
+
+def Configure( args ):
+	options = ParseArgs( args )
+	output_dir = options['--output-dir']
+	run_dir = os.path.realpath( os.path.join( options['--input-dir'], '..', '..', '..' ) )
+	if not os.path.exists( output_dir ):
+		os.makedirs( output_dir )
+	command = [ sys.executable, os.path.abspath(__file__), 'materialize', run_dir,
+		os.path.abspath(options['--sample-sheet']), os.path.abspath(output_dir) ]
+	runfolder.WriteFile( os.path.join( output_dir, "Makefile" ),
+		"all:\n\tPYTHONPATH=%s %s\n" % ( os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ' '.join(command) ) )
+	return 0
+
+def Materialize( args ):
+	( run_dir, sample_sheet, output_dir ) = args
+	# Data reads are the ones at least 25 cycles long, as in
+	# HiSeqRun.DetermineRunType.
+	data_reads = [ cycles for cycles in ReadCycles( run_dir ) if cycles >= 25 ]
+	runfolder.MakeCasavaOutput( output_dir, sample_sheet, data_reads, Factory() )
+	return 0
+
+def Bcl2Fastq( args ):
+	options = ParseArgs( args )
+	run_dir = options['--runfolder-dir']
+	cycles = ReadCycles( run_dir )
+	# Reads masked with Y are written as output reads R1, R2, ...
+	mask = options.get('--use-bases-mask')
+	if mask and mask is not True:
+		output_reads = [ cycles[i] for i in range(len(cycles)) if mask.split(',')[i].startswith('Y') ]
+	else:
+		output_reads = [ c for c in cycles if c >= 25 ]
+	runfolder.MakeBcl2FastqOutput( options['--output-dir'], options['--sample-sheet'], output_reads, Factory() )
+	return 0
+
+def main():
+	if len(sys.argv) < 2:
+		sys.stderr.write(__doc__)
+		sys.exit(1)
+	mode = os.path.basename( sys.argv[1] )
+	if mode == 'configureBclToFastq.pl':
+		sys.exit( Configure( sys.argv[2:] ) )
+	elif mode == 'materialize':
+		sys.exit( Materialize( sys.argv[2:] ) )
+	elif mode == 'bcl2fastq':
+		sys.exit( Bcl2Fastq( sys.argv[2:] ) )
+	sys.stderr.write("Unknown program %s.\n" % mode)
+	sys.exit(1)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,631 @@
+#!/usr/bin/env python
+"""
+microbench.py - micro-benchmarks for the pipeline's hot paths: FASTQ
+reading and writing, the Patch PCR UMI post-processing loop, barcode
+counting (IndexingEvaluator.Setup_18), the QC lane report
+(GenerateLaneReportBarcoded), concatenation of CASAVA 1.8 output
+(DemultiplexRenameDataFiles_18), MD5 checksums (GenerateChecksums),
+sample sheet parsing, reading index cycles straight from .bcl files
+(bcl.BclReader) and run discovery (RunMgr.Discover).
+
+Each benchmark runs in its own child process on synthetic data in a
+scratch directory, and reports its best time over the repetitions,
+throughput, and the peak resident set size of the Python process and of
+the programs it ran. Results are saved as JSON; compare checks a result
+file against a saved baseline and lists the benchmarks that got slower or
+bigger. Run from the top of the source tree:
+
+	python -m benchmarks.microbench run [--scale X] [--repeat N] [--only name,...] [--output results.json] [--workdir DIR] [--keep]
+	python -m benchmarks.microbench compare baseline.json results.json [--threshold 0.10]
+	python -m benchmarks.microbench list
+
+compare exits with status 1 if anything regressed beyond the threshold
+(default 10%).
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import shutil
+import random
+import socket
+import resource
+import tempfile
+import itertools
+import traceback
+import cStringIO
+
+from benchmarks import runfolder
+from benchmarks.pipeline_timing import PipelineBenchmark
+
+RUN_ID = '160101_D00550_0101_AC8A1ACXX'
+MISEQ_RUN_ID = '160102_M01234_0007_000000000-AB1CD'
+
+def TemplateFastq( workdir, read_length, num_reads, barcode='' ):
+	"""
+	Returns the name of a gzipped FASTQ file of num_reads random reads,
+	creating it the first time. Benchmarks that only move bytes around
+	copy this file rather than generating new random reads.
+	"""
+	template_dir = os.path.join( workdir, "templates" )
+	if not os.path.exists(template_dir):
+		os.makedirs(template_dir)
+	fname = os.path.join( template_dir, "%d_%d_%s.fastq.gz" % ( read_length, num_reads, barcode or 'none' ) )
+	if not os.path.exists(fname):
+		runfolder.FastqFactory( num_reads ).Write( fname, read_length, barcode )
+	return fname
+
+def UncompressedSize( fname ):
+	size = 0
+	ifs = gzip.open(fname)
+	while True:
+		block = ifs.read(1 << 20)
+		if not block:
+			break
+		size += len(block)
+	ifs.close()
+	return size
+
+class Benchmark:
+	"""
+	Base class of the benchmarks. Setup prepares the input once, Reset
+	runs before every repetition, and Run is the timed part. Run returns
+	( items, bytes ) processed, from which throughput is computed. unit
+	names the items.
+	"""
+	name = None
+	unit = 'items'
+
+	def __init__( self, workdir, scale ):
+		self.workdir = workdir
+		self.scale = scale
+
+	def Count( self, n ):
+		"""Scales a default input size."""
+		return max( 1, int( n * self.scale ) )
+
+	def Setup( self ):
+		pass
+
+	def Reset( self ):
+		pass
+
+	def Run( self ):
+		raise NotImplementedError
+
+class FastqReaderBench(Benchmark):
+	"""fastq.Reader over a gzipped file of 101 bp reads."""
+	name = 'fastq_reader'
+	unit = 'reads'
+
+	def Setup( self ):
+		self.num_reads = self.Count(20000)
+		self.fname = TemplateFastq( self.workdir, 101, self.num_reads )
+		self.size = UncompressedSize( self.fname )
+
+	def Run( self ):
+		from hcidemux import fastq
+		count = 0
+		ifs = fastq.Reader( self.fname )
+		for read in ifs:
+			count += 1
+		ifs.close()
+		return ( count, self.size )
+
+class FastqWriterBench(Benchmark):
+	"""fastq.Writer writing 101 bp reads to a gzipped file."""
+	name = 'fastq_writer'
+	unit = 'reads'
+
+	def Setup( self ):
+		from hcidemux import fastq
+		self.num_reads = self.Count(20000)
+		fname = TemplateFastq( self.workdir, 101, self.num_reads )
+		self.size = UncompressedSize( fname )
+		self.reads = [ read for read in fastq.Reader( fname ) ]
+		self.output = os.path.join( self.workdir, "writer.fastq.gz" )
+
+	def Run( self ):
+		from hcidemux import fastq
+		ofs = fastq.Writer( self.output )
+		for read in self.reads:
+			ofs.write( read )
+		ofs.close()
+		# Writer doesn't wait for gzip to finish.
+		if ofs.p:
+			ofs.p.wait()
+		return ( len(self.reads), self.size )
+
+class UmiPostprocessBench(Benchmark):
+	"""PatchPcrRun.PatchPcrPostProcessSample: appends the read 2 n-mer
+	to the names of the read 1 and read 3 reads of one sample."""
+	name = 'umi_postprocess'
+	unit = 'reads'
+
+	def Setup( self ):
+		self.num_reads = self.Count(20000)
+		self.run_dir = os.path.join( self.workdir, MISEQ_RUN_ID )
+		project_dir = os.path.join( self.run_dir, "Unaligned", "1001R" )
+		os.makedirs( project_dir )
+		data = TemplateFastq( self.workdir, 151, self.num_reads )
+		nmer = TemplateFastq( self.workdir, 12, self.num_reads )
+		shutil.copy( data, os.path.join( project_dir, "1001X1_S1_L001_R1_001.fastq.gz" ) )
+		shutil.copy( nmer, os.path.join( project_dir, "1001X1_S1_L001_R2_001.fastq.gz" ) )
+		shutil.copy( data, os.path.join( project_dir, "1001X1_S1_L001_R3_001.fastq.gz" ) )
+		self.size = 2 * UncompressedSize( data )
+
+	def Run( self ):
+		from hcidemux.patchpcrrun import PatchPcrRun
+		from hcidemux.runmetadata import RunMetadata
+		run = PatchPcrRun( MISEQ_RUN_ID, self.run_dir, metadata=RunMetadata(MISEQ_RUN_ID) )
+		run.PatchPcrPostProcessSample( "1001R", "1001X1_S1" )
+		return ( 2 * self.num_reads, self.size )
+
+def WriteCasavaSampleSheet( run_dir, lanes, samples_per_lane ):
+	"""Writes created_samplesheet.csv for a run with the given numbers
+	of lanes and samples. Returns its rows as ( lane, sample, barcode,
+	request )."""
+	rows = []
+	barcodes = itertools.product( 'ACGT', repeat=8 )
+	sample_number = 1
+	for lane in range( 1, lanes+1 ):
+		for i in range(samples_per_lane):
+			rows.append( ( lane, "1001X%d" % sample_number, ''.join(barcodes.next()), "1001R" ) )
+			sample_number += 1
+	lines = [ "FCID,Lane,SampleID,SampleRef,Index,Description,Control,Recipe,Operator,SampleProject" ]
+	for ( lane, sample, barcode, request ) in rows:
+		lines.append( ','.join([ 'C8A1ACXX', str(lane), sample, 'hg38', barcode, 'Babbage', 'N', 'R1', 'Lovelace', request ]) )
+	basecalls = os.path.join( run_dir, "Data", "Intensities", "BaseCalls" )
+	if not os.path.exists(basecalls):
+		os.makedirs(basecalls)
+	runfolder.WriteFile( os.path.join( basecalls, "created_samplesheet.csv" ), '\n'.join(lines) + '\n' )
+	return rows
+
+class BarcodeCountBench(Benchmark):
+	"""IndexingEvaluator.Setup_18: finds each sample's file and counts
+	the barcodes of the undetermined reads of 8 lanes."""
+	name = 'barcode_count'
+	unit = 'reads'
+
+	def Setup( self ):
+		self.reads_per_lane = self.Count(10000)
+		self.run_dir = runfolder.MakeRunFolder( self.workdir, RUN_ID, runfolder.PAIRED_END_READS, bcl_bytes=0 )
+		unaligned = os.path.join( self.run_dir, "Unaligned" )
+		os.makedirs( unaligned )
+		rows = WriteCasavaSampleSheet( self.run_dir, 8, 12 )
+		for ( lane, sample, barcode, request ) in rows:
+			runfolder.FastqFactory(1).Write( os.path.join( unaligned, "%s_%s_%d_1.txt.gz" % ( sample, RUN_ID, lane ) ), 101, barcode, lane )
+		template = TemplateFastq( self.workdir, 25, self.reads_per_lane, 'random' )
+		self.size = 0
+		for lane in range(1,9):
+			lane_dir = os.path.join( unaligned, "Undetermined_indices", "Sample_lane%d" % lane )
+			os.makedirs( lane_dir )
+			fname = os.path.join( lane_dir, "lane%d_Undetermined_L00%d_R1_001.fastq.gz" % ( lane, lane ) )
+			shutil.copy( template, fname )
+			self.size += UncompressedSize( fname )
+
+	def Run( self ):
+		from hcidemux.evaluateindexing import IndexingEvaluator
+		cwd = os.getcwd()
+		try:
+			evaluator = IndexingEvaluator( self.run_dir, '1.8' )
+			evaluator.Setup_18( range(1,9) )
+		finally:
+			os.chdir(cwd)
+		return ( 8 * self.reads_per_lane, self.size )
+
+class LaneReportBench(Benchmark):
+	"""IndexingEvaluator.GenerateLaneReportBarcoded for 8 lanes of 24
+	samples and many unexpected barcodes."""
+	name = 'lane_report'
+	unit = 'barcodes'
+
+	def Setup( self ):
+		from hcidemux.evaluateindexing import IndexingEvaluator
+		self.barcodes_per_lane = self.Count(50000)
+		run_dir = runfolder.MakeRunFolder( self.workdir, RUN_ID, runfolder.PAIRED_END_READS, lanes=1, bcl_bytes=0 )
+		os.makedirs( os.path.join( run_dir, "Unaligned" ) )
+		cwd = os.getcwd()
+		try:
+			self.evaluator = IndexingEvaluator( run_dir, '1.8' )
+		finally:
+			os.chdir(cwd)
+		self.evaluator.CountBases()
+		rng = random.Random(1)
+		for lane in range(1,9):
+			barcodes = itertools.product( 'ACGT', repeat=8 )
+			counts = {}
+			names = {}
+			for i in range(24):
+				barcode = ''.join(barcodes.next())
+				counts[barcode] = rng.randint( 500000, 2000000 )
+				names[barcode] = "1001X%d" % ( (lane-1)*24 + i + 1 )
+			for i in range(self.barcodes_per_lane):
+				counts[''.join(barcodes.next())] = rng.randint( 1, 2000 )
+			self.evaluator.readcount[lane] = counts
+			self.evaluator.samplename[lane] = names
+			self.evaluator.numsamples[lane] = 24
+
+	def Run( self ):
+		ofs = cStringIO.StringIO()
+		for lane in range(1,9):
+			self.evaluator.GenerateLaneReportBarcoded( lane, ofs )
+		return ( 8 * ( self.barcodes_per_lane + 24 ), len(ofs.getvalue()) )
+
+class RenameConcatBench(Benchmark):
+	"""Run.DemultiplexRenameDataFiles_18: concatenates CASAVA 1.8
+	output into one file per sample and end."""
+	name = 'rename_concat'
+	unit = 'files'
+
+	def Setup( self ):
+		self.run_dir = runfolder.MakeRunFolder( self.workdir, RUN_ID, runfolder.PAIRED_END_READS, lanes=2, bcl_bytes=0 )
+		rows = WriteCasavaSampleSheet( self.run_dir, 2, 4 )
+		template = TemplateFastq( self.workdir, 101, self.Count(5000) )
+		self.size = 0
+		self.num_inputs = 0
+		# Three chunks per sample, lane and end, like CASAVA splitting
+		# its output every 4M reads.
+		for ( lane, sample, barcode, request ) in rows:
+			sample_dir = os.path.join( self.run_dir, "Unaligned", "Project_%s" % request, "Sample_%s" % sample )
+			os.makedirs( sample_dir )
+			for end in [ 1, 2 ]:
+				for chunk in [ 1, 2, 3 ]:
+					fname = os.path.join( sample_dir, "%s_%s_L%03d_R%d_%03d.fastq.gz" % ( sample, barcode, lane, end, chunk ) )
+					shutil.copy( template, fname )
+					self.size += os.path.getsize( fname )
+					self.num_inputs += 1
+
+	def Run( self ):
+		from hcidemux.run import Run
+		from hcidemux.runmetadata import RunMetadata
+		run = Run( RUN_ID, self.run_dir, metadata=RunMetadata(RUN_ID) )
+		if not run.DemultiplexRenameDataFiles_18():
+			raise Exception("DemultiplexRenameDataFiles_18 failed.")
+		return ( self.num_inputs, self.size )
+
+class ChecksumBench(Benchmark):
+	"""Run.GenerateChecksums over a set of gzipped FASTQ files."""
+	name = 'checksums'
+	unit = 'files'
+
+	def Setup( self ):
+		self.data_dir = os.path.join( self.workdir, "checksums" )
+		os.makedirs( self.data_dir )
+		template = TemplateFastq( self.workdir, 101, self.Count(20000) )
+		self.files = []
+		for i in range(16):
+			fname = os.path.join( self.data_dir, "1001X%d_%s_1_1.txt.gz" % ( i+1, RUN_ID ) )
+			shutil.copy( template, fname )
+			self.files.append( fname )
+		self.size = sum([ os.path.getsize(f) for f in self.files ])
+
+	def Run( self ):
+		from hcidemux.run import Run
+		from hcidemux.runmetadata import RunMetadata
+		run = Run( RUN_ID, self.workdir, metadata=RunMetadata(RUN_ID) )
+		run.datafiles = list(self.files)
+		run.GenerateChecksums()
+		return ( len(self.files), self.size )
+
+class SampleSheetBench(Benchmark):
+	"""Run.GetSampleSheetProjectsSamples on a large IEM sample sheet."""
+	name = 'samplesheet_parse'
+	unit = 'rows'
+	passes = 20
+
+	def Setup( self ):
+		self.num_rows = self.Count(5000)
+		self.run_dir = os.path.join( self.workdir, MISEQ_RUN_ID )
+		os.makedirs( os.path.join( self.run_dir, "Data", "Intensities", "BaseCalls" ) )
+		barcodes = itertools.product( 'ACGT', repeat=8 )
+		samples = [ ( "1001X%d" % (i+1), ''.join(barcodes.next()), "%dR" % ( 1001 + i % 20 ) ) for i in range(self.num_rows) ]
+		runfolder.MakeMiseqSampleSheet( self.run_dir, samples )
+		shutil.move( os.path.join( self.run_dir, "SampleSheet.csv" ),
+			os.path.join( self.run_dir, "Data", "Intensities", "BaseCalls", "created_samplesheet.csv" ) )
+		self.size = os.path.getsize( os.path.join( self.run_dir, "Data", "Intensities", "BaseCalls", "created_samplesheet.csv" ) )
+
+	def Run( self ):
+		from hcidemux.run import Run
+		from hcidemux.runmetadata import RunMetadata
+		run = Run( MISEQ_RUN_ID, self.run_dir, metadata=RunMetadata(MISEQ_RUN_ID) )
+		for i in range(self.passes):
+			run.GetSampleSheetProjectsSamples()
+		return ( self.passes * self.num_rows, self.passes * self.size )
+
+class BclIndexBench(Benchmark):
+	"""bcl.BclReader.CountIndexes reading the index cycles of 4 tiles
+	of gzipped .bcl files. Needs numpy."""
+	name = 'bcl_index_count'
+	unit = 'clusters'
+
+	def Setup( self ):
+		self.clusters = self.Count(20000)
+		reads = [ ( 25, False ), ( 8, True ) ]
+		self.run_dir = runfolder.MakeRunFolder( self.workdir, RUN_ID, reads, lanes=1, bcl_bytes=0 )
+		barcodes = [ ''.join(b) for b in itertools.islice( itertools.product( 'ACGT', repeat=8 ), 0, 4096, 43 ) ]
+		for tile in range(1101,1105):
+			runfolder.WriteBasecalls( self.run_dir, reads, 1, tile, self.clusters, barcodes )
+
+	def Run( self ):
+		from hcidemux.bcl import BclReader
+		counts = BclReader( self.run_dir ).CountIndexes( 1 )
+		clusters = sum( counts.values() )
+		return ( clusters, 8 * clusters )
+
+class MergeBench(Benchmark):
+	"""Run.MergeBclConversions merging the output of 4 bcl conversions
+	(barcode lengths), with projects split between them."""
+	name = 'merge_conversions'
+	unit = 'directories'
+
+	def Setup( self ):
+		self.run_dir = runfolder.MakeRunFolder( self.workdir, RUN_ID, runfolder.PAIRED_END_READS, lanes=8, bcl_bytes=0 )
+		self.samples = self.Count(2000)
+
+	def Reset( self ):
+		for name in os.listdir( self.run_dir ):
+			if name.startswith( "Unaligned" ):
+				shutil.rmtree( os.path.join( self.run_dir, name ) )
+		for i in range( self.samples ):
+			outdir = os.path.join( self.run_dir, "Unaligned_%d" % ( 6 + i % 4 ) )
+			os.makedirs( os.path.join( outdir, "Project_%d" % ( i % 50 ), "Sample_%dX%d" % ( i % 50, i ) ) )
+		# Two lanes per barcode length.
+		for lane in range( 1, 9 ):
+			outdir = os.path.join( self.run_dir, "Unaligned_%d" % ( 6 + (lane-1) // 2 ) )
+			os.makedirs( os.path.join( outdir, "Undetermined_indices", "Sample_lane%d" % lane ) )
+
+	def Run( self ):
+		from hcidemux.run import Run
+		from hcidemux.runmetadata import RunMetadata
+		run = Run( RUN_ID, self.run_dir, metadata=RunMetadata(RUN_ID) )
+		if not run.MergeBclConversions():
+			raise Exception("MergeBclConversions failed.")
+		return ( self.samples, 0 )
+
+class DiscoverBench(Benchmark):
+	"""RunMgr.Discover finding and registering new run folders among
+	other files in a root directory."""
+	name = 'discover'
+	unit = 'runs'
+
+	def Setup( self ):
+		import hcidemux.pipelineparams as params
+		self.num_runs = self.Count(500)
+		self.root = params.root_directories[0]
+		for i in range(self.num_runs):
+			os.mkdir( os.path.join( self.root, "160101_D00550_%04d_AC%07dXX" % ( i+1, i+1 ) ) )
+			runfolder.WriteFile( os.path.join( self.root, "run%d.log" % (i+1) ), "" )
+
+	def Reset( self ):
+		from hcidemux.runmgr import RunMgr
+		self.mgr = RunMgr()
+		c = self.mgr.db_connection.cursor()
+		for table in [ 'run', 'discovery', 'metadata_cache' ]:
+			c.execute( "delete from %s" % table )
+		self.mgr.db_connection.commit()
+
+	def Run( self ):
+		self.mgr.Discover( [ self.root ], full_scan=True )
+		return ( self.num_runs, 0 )
+
+BENCHMARKS = [ FastqReaderBench, FastqWriterBench, UmiPostprocessBench, BarcodeCountBench,
+	LaneReportBench, RenameConcatBench, ChecksumBench, SampleSheetBench, BclIndexBench, MergeBench, DiscoverBench ]
+
+def RunBenchmark( bench_class, workdir, scale, repeat ):
+	"""
+	Runs one benchmark in a child process, so its peak RSS is its own.
+	The child's log output goes to <name>.log in workdir. Returns the
+	result dictionary, or one with an 'error' key.
+	"""
+	( rfd, wfd ) = os.pipe()
+	pid = os.fork()
+	if pid == 0:
+		os.close(rfd)
+		log = os.open( os.path.join( workdir, bench_class.name + ".log" ), os.O_WRONLY|os.O_CREAT|os.O_TRUNC )
+		os.dup2( log, 2 )
+		try:
+			bench_dir = os.path.join( workdir, bench_class.name )
+			os.makedirs( bench_dir )
+			bench = bench_class( bench_dir, scale )
+			bench.Setup()
+			times = []
+			for i in range(repeat):
+				bench.Reset()
+				start = time.time()
+				( items, nbytes ) = bench.Run()
+				times.append( time.time() - start )
+			times.sort()
+			best = times[0]
+			result = {
+				'seconds': best,
+				'median_seconds': times[len(times)/2],
+				'items': items,
+				'unit': bench_class.unit,
+				'bytes': nbytes,
+				'items_per_second': items / best if best else None,
+				'mb_per_second': nbytes / best / 1e6 if best else None,
+				'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+				'tools_peak_rss_kb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+			}
+		except Exception:
+			traceback.print_exc()
+			result = { 'error': traceback.format_exc().strip().split('\n')[-1] }
+		os.write( wfd, json.dumps(result) )
+		os._exit(0)
+	os.close(wfd)
+	data = ''
+	while True:
+		block = os.read( rfd, 65536 )
+		if not block:
+			break
+		data += block
+	os.close(rfd)
+	os.waitpid( pid, 0 )
+	try:
+		return json.loads(data)
+	except ValueError:
+		return { 'error': 'benchmark process died' }
+
+def FormatResult( name, r ):
+	if 'error' in r:
+		return "%-18s ERROR %s" % ( name, r['error'] )
+	if r['mb_per_second']:
+		rate = "%8.1f MB/s" % r['mb_per_second']
+	else:
+		rate = ""
+	return "%-18s %9.3fs %12.0f %s/s %s %8d KB rss %8d KB tools" % ( name, r['seconds'], r['items_per_second'] or 0,
+		r['unit'], rate, r['peak_rss_kb'], r['tools_peak_rss_kb'] )
+
+def RunCommand( args ):
+	scale = 1.0
+	repeat = 3
+	only = None
+	output = None
+	workdir = None
+	keep = False
+	while args:
+		arg = args.pop(0)
+		if arg == '--scale':
+			scale = float(args.pop(0))
+		elif arg == '--repeat':
+			repeat = int(args.pop(0))
+		elif arg == '--only':
+			only = args.pop(0).split(',')
+		elif arg == '--output':
+			output = args.pop(0)
+		elif arg == '--workdir':
+			workdir = args.pop(0)
+		elif arg == '--keep':
+			keep = True
+		else:
+			raise ValueError(arg)
+	benchmarks = BENCHMARKS
+	if only:
+		names = [ b.name for b in BENCHMARKS ]
+		for name in only:
+			if name not in names:
+				sys.stderr.write("Unknown benchmark %s.\n" % name)
+				sys.exit(1)
+		benchmarks = [ b for b in BENCHMARKS if b.name in only ]
+
+	if workdir is None:
+		workdir = tempfile.mkdtemp( prefix="hcidemux-microbench-" )
+	else:
+		workdir = os.path.abspath(workdir)
+		os.makedirs(workdir)
+	# Settings, pipeline database and GNomEx fixture, for the
+	# benchmarks that need them.
+	env = PipelineBenchmark( os.path.join( workdir, "env" ) )
+	env.InstallParams()
+	from hcidemux.gnomexfixture import FixtureBuilder
+	FixtureBuilder( env.fixture ).Close()
+
+	results = {}
+	try:
+		for bench_class in benchmarks:
+			results[bench_class.name] = RunBenchmark( bench_class, workdir, scale, repeat )
+			print FormatResult( bench_class.name, results[bench_class.name] )
+			sys.stdout.flush()
+	finally:
+		if keep:
+			sys.stderr.write("Work directory kept: %s\n" % workdir)
+		else:
+			shutil.rmtree( workdir, ignore_errors=True )
+	if output:
+		ofs = open( output, 'w' )
+		json.dump( {
+			'created': time.strftime("%Y-%m-%d %H:%M:%S"),
+			'host': socket.gethostname(),
+			'python': sys.version.split()[0],
+			'scale': scale,
+			'repeat': repeat,
+			'benchmarks': results,
+		}, ofs, indent=1, sort_keys=True )
+		ofs.close()
+	if [ r for r in results.values() if 'error' in r ]:
+		sys.exit(1)
+
+def Compare( baseline, current, threshold=0.10 ):
+	"""
+	Compares two result dictionaries as saved by the run command.
+	Returns ( report lines, number of regressions ). A benchmark has
+	regressed if its time or its peak RSS grew by more than threshold,
+	or it failed.
+	"""
+	lines = []
+	regressions = 0
+	if baseline.get('scale') != current.get('scale'):
+		lines.append( "Warning: baseline scale %s, current scale %s." % ( baseline.get('scale'), current.get('scale') ) )
+	for name in [ b.name for b in BENCHMARKS ]:
+		if name not in baseline['benchmarks'] or name not in current['benchmarks']:
+			continue
+		old = baseline['benchmarks'][name]
+		new = current['benchmarks'][name]
+		if 'error' in new:
+			lines.append( "%-18s FAILED %s" % ( name, new['error'] ) )
+			regressions += 1
+			continue
+		if 'error' in old:
+			lines.append( "%-18s no baseline" % name )
+			continue
+		time_ratio = new['seconds'] / old['seconds']
+		rss_ratio = float(new['peak_rss_kb']) / old['peak_rss_kb']
+		flags = []
+		if time_ratio > 1 + threshold:
+			flags.append('SLOWER')
+		if rss_ratio > 1 + threshold:
+			flags.append('BIGGER')
+		if flags:
+			regressions += 1
+		elif time_ratio < 1 - threshold:
+			flags.append('faster')
+		lines.append( "%-18s %9.3fs -> %9.3fs %+6.1f%%   %8d -> %8d KB %+6.1f%%   %s" % ( name,
+			old['seconds'], new['seconds'], 100 * (time_ratio-1),
+			old['peak_rss_kb'], new['peak_rss_kb'], 100 * (rss_ratio-1), ' '.join(flags) ) )
+	return ( lines, regressions )
+
+def CompareCommand( args ):
+	threshold = 0.10
+	files = []
+	while args:
+		arg = args.pop(0)
+		if arg == '--threshold':
+			threshold = float(args.pop(0))
+		else:
+			files.append(arg)
+	if len(files) != 2:
+		raise ValueError(files)
+	( baseline, current ) = [ json.load(open(f)) for f in files ]
+	( lines, regressions ) = Compare( baseline, current, threshold )
+	print '\n'.join(lines)
+	if regressions:
+		print "%d benchmark(s) regressed by more than %d%%." % ( regressions, 100 * threshold )
+		sys.exit(1)
+
+def Usage():
+	sys.stderr.write( __doc__ )
+
+def main():
+	args = sys.argv[1:]
+	if not args:
+		Usage()
+		sys.exit(1)
+	command = args.pop(0)
+	try:
+		if command == 'run':
+			RunCommand( args )
+		elif command == 'compare':
+			CompareCommand( args )
+		elif command == 'list':
+			for b in BENCHMARKS:
+				print "%-18s %s" % ( b.name, ' '.join(b.__doc__.split()) )
+		else:
+			raise ValueError(command)
+	except ( IndexError, ValueError ):
+		Usage()
+		sys.exit(1)
+
+if __name__ == "__main__":
+	main()
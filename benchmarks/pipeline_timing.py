@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+"""
+pipeline_timing.py - times every state of the pipeline's run classes
+(PEHiSeqRun, SEHiSeqRun, PatchPcrRun, KappaPcrRun) end to end on synthetic
+run folders, to measure the pipeline's own overhead apart from bcl
+conversion. Everything happens in a scratch directory:
+
+- GNomEx is replaced by a sqlite fixture (hcidemux/gnomexfixture.py).
+- bcl2fastq by benchmarks/fakebcl2fastq.py.
+- email by files in a mail directory.
+- the pipelineparams module by settings pointing into the scratch
+  directory.
+
+Run from the top of the source tree:
+
+	python -m benchmarks.pipeline_timing [--reads N] [--samples N] [--lanes 1|8]
+		[--class RunClass ...] [--distribution link|copy] [--engine bcl2fastq|bcl2fastq2]
+		[--pcr-demultiplexer bcl2fastq|numpy]
+		[--json results.json] [--workdir DIR] [--keep]
+"""
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import sqlite3
+import tempfile
+import traceback
+
+from benchmarks import runfolder
+
+# Programs the pipeline runs by full path.
+REQUIRED_PROGRAMS = [ "/usr/bin/make", "/bin/gzip", "/bin/gunzip", "/usr/bin/find" ]
+
+FACILITY = 'High Throughput Genomics'
+
+# Run folders timed for each run class: ( run id, reads, application ).
+RUN_SPECS = {
+	'PEHiSeqRun': ( '160101_D00550_0101_AC8A1ACXX', runfolder.PAIRED_END_READS, 'Illumina TruSeq DNA' ),
+	'SEHiSeqRun': ( '160101_D00550_0102_BC8A2ACXX', runfolder.SINGLE_END_READS, 'Illumina TruSeq Stranded mRNA' ),
+	'PatchPcrRun': ( '160102_M01234_0007_000000000-AB1CD', runfolder.PATCH_PCR_READS, 'Patch PCR' ),
+	'KappaPcrRun': ( '160102_M01234_0008_000000000-AB2CD', runfolder.KAPPA_PCR_READS, 'Kappa PCR' ),
+}
+RUN_CLASS_ORDER = [ 'PEHiSeqRun', 'SEHiSeqRun', 'PatchPcrRun', 'KappaPcrRun' ]
+
+# Clusters per lane written for the index cycles of HiSeq runs.
+INDEX_QC_CLUSTERS = 2000
+
+class PipelineBenchmark:
+	def __init__( self, workdir, reads=1000, samples=4, lanes=8, distribution='link', engine='bcl2fastq2', pcr_demultiplexer='bcl2fastq' ):
+		self.workdir = workdir
+		self.distribution = distribution
+		self.engine = engine
+		self.pcr_demultiplexer = pcr_demultiplexer
+		self.reads = reads
+		self.samples = samples
+		self.lanes = lanes
+		self.runs_dir = os.path.join( workdir, "runs" )
+		self.bin_dir = os.path.join( workdir, "bin" )
+		self.mail_dir = os.path.join( workdir, "mail" )
+		self.repository_dir = os.path.join( workdir, "repository" )
+		self.fixture = os.path.join( workdir, "gnomex.db" )
+		for d in [ self.runs_dir, self.bin_dir, self.mail_dir, self.repository_dir ]:
+			os.makedirs( d )
+
+	def InstallPrograms( self ):
+		"""Writes configureBclToFastq.pl and bcl2fastq wrappers that run fakebcl2fastq.py."""
+		source_root = os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) )
+		fake = os.path.join( source_root, "benchmarks", "fakebcl2fastq.py" )
+		for program in [ "configureBclToFastq.pl", "bcl2fastq" ]:
+			fname = os.path.join( self.bin_dir, program )
+			runfolder.WriteFile( fname, '#!/bin/sh\nPYTHONPATH=%s exec %s %s %s "$@"\n' % ( source_root, sys.executable, fake, program ) )
+			os.chmod( fname, 0755 )
+
+	def InstallParams( self ):
+		"""Installs a pipelineparams module pointing into the work directory."""
+		params = types.ModuleType('pipelineparams')
+		params.db_file = os.path.join( self.workdir, "pipeline.db" )
+		params.db_user = 'benchmark'
+		params.db_password = 'benchmark'
+		params.root_directories = [ self.runs_dir ]
+		params.bcl2fastq_dir = self.bin_dir
+		params.bcl2fastq2_dir = self.bin_dir
+		params.casava_dir = self.bin_dir
+		params.repository_root_dir = self.repository_dir
+		params.repository_data_root = { FACILITY: os.path.join( self.repository_dir, "Data" ) }
+		params.lab_staff_addresses = { FACILITY: [ 'lab@localhost' ] }
+		params.notify_addresses = [ 'notify@localhost' ]
+		params.archive_addresses = [ 'archive@localhost' ]
+		params.miseq_ids = [ 'M01234' ]
+		params.username = 'benchmark'
+		params.max_run_workers = 0
+		params.distribution_mode = self.distribution
+		params.bcl_conversion_engine = self.engine
+		params.pcr_demultiplexer = self.pcr_demultiplexer
+		import hcidemux
+		hcidemux.pipelineparams = params
+		sys.modules['hcidemux.pipelineparams'] = params
+		sys.modules['pipelineparams'] = params
+
+		os.environ['GNOMEX_SQLITE'] = self.fixture
+		os.environ['PIPELINE_MAIL_DIR'] = self.mail_dir
+		os.environ['FAKE_BCL2FASTQ_READS'] = str(self.reads)
+		os.environ.setdefault( 'LOGNAME', 'benchmark' )
+
+		# Creates the pipeline database and its tables.
+		from hcidemux.runmgr import RunMgr
+		RunMgr()
+
+	def MakeRuns( self, class_names ):
+		"""Registers and creates a run folder for each run class.
+		Returns dictionary of run directories indexed by class name."""
+		from hcidemux.gnomexfixture import FixtureBuilder
+		builder = FixtureBuilder( self.fixture )
+		run_dirs = {}
+		for name in class_names:
+			( run_id, reads, application ) = RUN_SPECS[name]
+			if run_id.split('_')[1].startswith('M'):
+				builder.AddRun( run_id, 1, self.samples, application )
+				run_dir = runfolder.MakeRunFolder( self.runs_dir, run_id, reads, lanes=1, flowcell="MiSeq" )
+				runfolder.MakeMiseqSampleSheet( run_dir, [] )
+			else:
+				samples = [ self.samples ] * self.lanes
+				if name == 'SEHiSeqRun' and self.lanes > 1:
+					# A lane with a single, unbarcoded sample
+					# sends the run through complex bcl
+					# conversion and the merge.
+					samples[0] = 1
+				builder.AddRun( run_id, samples_per_lane=samples, application=application )
+				run_dir = runfolder.MakeRunFolder( self.runs_dir, run_id, reads, lanes=self.lanes )
+			run_dirs[name] = run_dir
+		builder.Close()
+
+		# Index cycles spelling the samples' barcodes, for the early
+		# index QC of the HiSeq runs, and every cycle of the MiSeq runs
+		# if they're demultiplexed straight from their bcl files.
+		for name in class_names:
+			( run_id, reads, application ) = RUN_SPECS[name]
+			if not run_id.split('_')[1].startswith('M'):
+				for ( lane, barcodes ) in self.LaneBarcodes( run_id ).iteritems():
+					runfolder.WriteBasecalls( run_dirs[name], reads, lane, 1101, INDEX_QC_CLUSTERS, barcodes, index_only=True )
+			elif self.pcr_demultiplexer == 'numpy':
+				barcodes = self.LaneBarcodes( run_id )[1]
+				runfolder.WriteBasecalls( run_dirs[name], reads, 1, 1101, self.reads * len(barcodes), barcodes )
+
+		# CopyDataFiles and Qc expect the request and flow cell
+		# directories in the repository to exist.
+		connection = sqlite3.connect( self.fixture, detect_types=sqlite3.PARSE_DECLTYPES )
+		c = connection.cursor()
+		c.execute("select number, createdate from request")
+		for ( number, createdate ) in c.fetchall():
+			d = os.path.join( self.repository_dir, "Data", str(createdate.year), str(number) )
+			if not os.path.exists(d):
+				os.makedirs(d)
+		c.execute("select number, createdate from flowcell")
+		for ( number, createdate ) in c.fetchall():
+			d = os.path.join( self.repository_dir, "FlowCellData", str(createdate.year), str(number) )
+			if not os.path.exists(d):
+				os.makedirs(d)
+		connection.close()
+		return run_dirs
+
+	def LaneBarcodes( self, run_id ):
+		"""Returns the barcodes of a run's samples in the fixture,
+		indexed by lane."""
+		connection = sqlite3.connect( self.fixture )
+		connection.text_factory = str
+		c = connection.cursor()
+		c.execute("""select flowcellchannel.number, sample.barcodesequence, sample.barcodesequenceb
+			from flowcellchannel
+			join sequencelane on sequencelane.idflowcellchannel = flowcellchannel.idflowcellchannel
+			join sample on sample.idsample = sequencelane.idsample
+			where flowcellchannel.filename = ?""", ( run_id, ) )
+		lanes = {}
+		for ( lane, barcode, barcode_b ) in c.fetchall():
+			barcodes = lanes.setdefault( int(lane), [] )
+			if barcode:
+				barcodes.append( barcode + ( '-' + barcode_b if barcode_b else '' ) )
+		connection.close()
+		return lanes
+
+	def TimeRun( self, run_class, run_id, run_dir, max_steps=50 ):
+		"""
+		Drives one run through its state machine, timing each state's
+		transition function. Returns list of dictionaries with keys
+		state, seconds and outcome (success, failure or exception).
+		"""
+		from hcidemux.states import States
+		results = []
+		cwd = os.getcwd()
+		start = time.time()
+		run = run_class( run_id, run_dir )
+		results.append( { 'state':'__init__', 'seconds':time.time()-start, 'outcome':'success' } )
+		steps = 0
+		while run.state in run.transition and steps < max_steps:
+			steps += 1
+			( method, success_state, fail_state ) = run.transition[run.state]
+			start = time.time()
+			try:
+				if method(run):
+					outcome = 'success'
+				else:
+					outcome = 'failure'
+			except Exception:
+				outcome = 'exception'
+				traceback.print_exc()
+			results.append( { 'state':run.state, 'seconds':time.time()-start, 'outcome':outcome } )
+			# Some state functions change directory.
+			os.chdir(cwd)
+			if outcome == 'success':
+				next_state = success_state
+			else:
+				next_state = fail_state
+			if next_state == run.state or next_state == States.error_detected:
+				# Stuck, or failed. The synthetic run should
+				# never get here.
+				break
+			run.state = next_state
+		results.append( { 'state':run.state, 'seconds':0.0, 'outcome':'final' } )
+		return results
+
+	def Run( self, class_names ):
+		"""Times each of the named run classes. Returns dictionary of
+		TimeRun results indexed by class name."""
+		self.InstallPrograms()
+		self.InstallParams()
+		run_dirs = self.MakeRuns( class_names )
+		from hcidemux.pairedendhiseqrun import PEHiSeqRun
+		from hcidemux.singleendhiseqrun import SEHiSeqRun
+		from hcidemux.patchpcrrun import PatchPcrRun
+		from hcidemux.kappapcrrun import KappaPcrRun
+		classes = { 'PEHiSeqRun':PEHiSeqRun, 'SEHiSeqRun':SEHiSeqRun, 'PatchPcrRun':PatchPcrRun, 'KappaPcrRun':KappaPcrRun }
+		results = {}
+		for name in class_names:
+			results[name] = self.TimeRun( classes[name], RUN_SPECS[name][0], run_dirs[name] )
+		return results
+
+def Report( results, ofs=sys.stdout ):
+	for name in RUN_CLASS_ORDER:
+		if name not in results:
+			continue
+		ofs.write( "\n%s\n" % name )
+		total = 0.0
+		for r in results[name]:
+			if r['outcome'] == 'final':
+				ofs.write( "  %-32s final state\n" % r['state'] )
+				continue
+			ofs.write( "  %-32s %9.3fs  %s\n" % ( r['state'], r['seconds'], r['outcome'] ) )
+			total += r['seconds']
+		ofs.write( "  %-32s %9.3fs\n" % ( 'total', total ) )
+
+def Usage():
+	sys.stderr.write( __doc__ )
+
+def main():
+	args = sys.argv[1:]
+	reads = 1000
+	samples = 4
+	lanes = 8
+	class_names = []
+	json_file = None
+	workdir = None
+	keep = False
+	distribution = 'link'
+	engine = 'bcl2fastq2'
+	pcr_demultiplexer = 'bcl2fastq'
+	try:
+		while args:
+			arg = args.pop(0)
+			if arg == '--reads':
+				reads = int(args.pop(0))
+			elif arg == '--samples':
+				samples = int(args.pop(0))
+			elif arg == '--lanes':
+				lanes = int(args.pop(0))
+			elif arg == '--class':
+				class_names.append(args.pop(0))
+			elif arg == '--json':
+				json_file = args.pop(0)
+			elif arg == '--workdir':
+				workdir = args.pop(0)
+			elif arg == '--keep':
+				keep = True
+			elif arg == '--distribution':
+				distribution = args.pop(0)
+			elif arg == '--engine':
+				engine = args.pop(0)
+			elif arg == '--pcr-demultiplexer':
+				pcr_demultiplexer = args.pop(0)
+			else:
+				raise ValueError(arg)
+	except ( IndexError, ValueError ):
+		Usage()
+		sys.exit(1)
+	if lanes not in [ 1, 8 ]:
+		sys.stderr.write("HiSeq flow cells have 1 or 8 lanes.\n")
+		sys.exit(1)
+	for name in class_names:
+		if name not in RUN_SPECS:
+			sys.stderr.write("Unknown run class %s. Choose from %s.\n" % ( name, ', '.join(RUN_CLASS_ORDER) ))
+			sys.exit(1)
+	if not class_names:
+		class_names = RUN_CLASS_ORDER
+	missing = [ p for p in REQUIRED_PROGRAMS if not os.path.exists(p) ]
+	if missing:
+		sys.stderr.write("The pipeline needs %s, not found on this machine.\n" % ', '.join(missing))
+		sys.exit(1)
+
+	if workdir is None:
+		workdir = tempfile.mkdtemp( prefix="hcidemux-bench-" )
+	else:
+		workdir = os.path.abspath(workdir)
+	try:
+		benchmark = PipelineBenchmark( workdir, reads, samples, lanes, distribution, engine, pcr_demultiplexer )
+		results = benchmark.Run( class_names )
+	finally:
+		if not keep:
+			shutil.rmtree( workdir, ignore_errors=True )
+		else:
+			sys.stderr.write("Work directory kept: %s\n" % workdir)
+	Report( results )
+	if json_file:
+		ofs = open( json_file, 'w' )
+		json.dump( { 'reads':reads, 'samples':samples, 'lanes':lanes, 'results':results }, ofs, indent=1 )
+		ofs.close()
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,241 @@
+"""
+runfolder.py - writes synthetic Illumina run folders and demultiplexed
+output for benchmarking the pipeline without a sequencer: RunInfo.xml,
+runParameters.xml, the transfer completion markers, a few small .bcl
+files (or real base calls, for reading them directly), MiSeq
+SampleSheet.csv files, and the gzipped FASTQ files bcl2fastq would
+produce, in both the CASAVA 1.8 layout
+(Unaligned/Project_*/Sample_*, Undetermined_indices) and the bcl2fastq2
+layout (Unaligned/<project>/<sample>_S<n>_L001_R<n>_001.fastq.gz).
+"""
+import os
+import gzip
+import random
+import struct
+
+# HiSeq and MiSeq read layouts: ( number of cycles, is index read ).
+PAIRED_END_READS = [ ( 101, False ), ( 8, True ), ( 101, False ) ]
+SINGLE_END_READS = [ ( 50, False ), ( 8, True ) ]
+# Patch PCR: the random n-mer is read 3, after the index read.
+PATCH_PCR_READS = [ ( 151, False ), ( 8, True ), ( 12, True ), ( 151, False ) ]
+# Kappa PCR: the random n-mer is read 2, before the index read.
+KAPPA_PCR_READS = [ ( 151, False ), ( 12, True ), ( 8, True ), ( 151, False ) ]
+
+def WriteFile( filename, content ):
+	ofs = open( filename, 'w' )
+	ofs.write( content )
+	ofs.close()
+
+def MakeRunFolder( root, run_id, reads, lanes=8, flowcell="HiSeq Flow Cell v4", complete=True, bcl_bytes=1024, tiles=1 ):
+	"""
+	Creates run folder root/run_id. reads lists ( cycles, is_index )
+	for each read. One small .bcl file is written per lane, cycle and
+	tile so the pipeline's bcl compression has something to do. If
+	complete is False the transfer completion markers are left out.
+	Returns the full path of the run folder.
+	"""
+	run_dir = os.path.join( root, run_id )
+	( date, instrument, number, flowcell_id ) = run_id.split('_')
+	basecalls = os.path.join( run_dir, "Data", "Intensities", "BaseCalls" )
+	os.makedirs( basecalls )
+
+	read_elements = ''
+	for i in range(len(reads)):
+		( cycles, is_index ) = reads[i]
+		read_elements += '      <Read Number="%d" NumCycles="%d" IsIndexedRead="%s" />\n' % ( i+1, cycles, is_index and 'Y' or 'N' )
+	WriteFile( os.path.join( run_dir, "RunInfo.xml" ), """<?xml version="1.0"?>
+<RunInfo xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" Version="2">
+  <Run Id="%s" Number="%d">
+    <Flowcell>%s</Flowcell>
+    <Instrument>%s</Instrument>
+    <Date>%s</Date>
+    <Reads>
+%s    </Reads>
+    <FlowcellLayout LaneCount="%d" SurfaceCount="2" SwathCount="2" TileCount="%d" />
+  </Run>
+</RunInfo>
+""" % ( run_id, int(number), flowcell_id[1:], instrument, date, read_elements, lanes, tiles ) )
+
+	WriteFile( os.path.join( run_dir, "runParameters.xml" ), """<?xml version="1.0"?>
+<RunParameters xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">
+  <Setup>
+    <RunID>%s</RunID>
+    <ScannerID>%s</ScannerID>
+    <Flowcell>%s</Flowcell>
+  </Setup>
+</RunParameters>
+""" % ( run_id, instrument, flowcell ) )
+
+	total_cycles = sum([ cycles for ( cycles, is_index ) in reads ])
+	filler = '\0' * bcl_bytes
+	for lane in range(1,lanes+1):
+		for cycle in range(1,total_cycles+1):
+			cycle_dir = os.path.join( basecalls, "L%03d" % lane, "C%d.1" % cycle )
+			os.makedirs( cycle_dir )
+			for tile in range(1,tiles+1):
+				WriteFile( os.path.join( cycle_dir, "s_%d_%d.bcl" % ( lane, 1100+tile ) ), filler )
+
+	if complete:
+		MarkComplete( run_dir, len(reads) )
+	return run_dir
+
+def WriteBasecalls( run_dir, reads, lane, tile, clusters, barcodes=[], compresslevel=1, index_only=False ):
+	"""
+	Writes real base calls for one tile: a gzipped .bcl file per cycle
+	(replacing any filler .bcl file) and a .filter file, on which every
+	tenth cluster fails filter. Data cycles are random; the index cycles
+	of each cluster spell one of barcodes (dual indexes joined with '-'),
+	chosen at random, or are random if there are none. With index_only
+	only the index cycles are written. Seeded from the lane and tile, so
+	repeated runs write identical files.
+	"""
+	rng = random.Random( "%d_%d" % ( lane, tile ) )
+	basecalls = os.path.join( run_dir, "Data", "Intensities", "BaseCalls" )
+	lane_dir = os.path.join( basecalls, "L%03d" % lane )
+	index_reads = [ cycles for ( cycles, is_index ) in reads if is_index ]
+	indexes = [ ''.join( barcode.split('-') ).ljust( sum(index_reads), 'A' ) for barcode in barcodes ]
+	cluster_indexes = [ rng.choice( indexes ) if indexes else None for i in range(clusters) ]
+	cycle = 0
+	index_cycle = 0
+	for ( cycles, is_index ) in reads:
+		for i in range(cycles):
+			cycle += 1
+			if index_only and not is_index:
+				continue
+			calls = []
+			for c in range(clusters):
+				if is_index and cluster_indexes[c] is not None:
+					base = "ACGT".index( cluster_indexes[c][index_cycle] )
+				else:
+					base = rng.randrange(4)
+				calls.append( chr( ( rng.randrange( 2, 42 ) << 2 ) | base ) )
+			if is_index:
+				index_cycle += 1
+			cycle_dir = os.path.join( lane_dir, "C%d.1" % cycle )
+			if not os.path.exists( cycle_dir ):
+				os.makedirs( cycle_dir )
+			name = os.path.join( cycle_dir, "s_%d_%d.bcl" % ( lane, tile ) )
+			if os.path.exists( name ):
+				os.unlink( name )
+			ofs = gzip.open( name + ".gz", 'wb', compresslevel )
+			ofs.write( struct.pack( '<I', clusters ) + ''.join( calls ) )
+			ofs.close()
+	flags = ''.join([ chr( 0 if c % 10 == 9 else 1 ) for c in range(clusters) ])
+	WriteFile( os.path.join( lane_dir, "s_%d_%d.filter" % ( lane, tile ) ), struct.pack( '<III', 0, 3, clusters ) + flags )
+
+def MarkComplete( run_dir, num_reads ):
+	"""Writes the files the sequencer leaves when the transfer is done."""
+	for i in range(1,num_reads+1):
+		WriteFile( os.path.join( run_dir, "Basecalling_Netcopy_complete_Read%d.txt" % i ), "" )
+	WriteFile( os.path.join( run_dir, "RTAComplete.txt" ), "" )
+
+def MakeMiseqSampleSheet( run_dir, samples ):
+	"""
+	Writes the SampleSheet.csv a MiSeq run folder starts with. samples
+	is a list of ( sample id, barcode, project ) tuples. The Patch and
+	Kappa PCR pipelines copy its header into their own sample sheet.
+	"""
+	lines = [ "[Header]", "IEMFileVersion,4", "Workflow,GenerateFASTQ", "Application,FASTQ Only", "",
+		"[Reads]", "151", "151", "", "[Settings]", "", "[Data]",
+		"Sample_ID,Sample_Name,Sample_Plate,Sample_Well,I7_Index_ID,index,I5_Index_ID,index2,Sample_Project,Description" ]
+	for ( sample, barcode, project ) in samples:
+		lines.append( ','.join([ sample, '', '', '', '', barcode, '', '', project, '' ]) )
+	WriteFile( os.path.join( run_dir, "SampleSheet.csv" ), '\n'.join(lines) + '\n' )
+
+class FastqFactory:
+	"""
+	Writes gzipped FASTQ files of random reads. Each file is seeded
+	from its name, so repeated benchmark runs write identical data.
+	"""
+	def __init__( self, num_reads=1000, compresslevel=1 ):
+		self.num_reads = num_reads
+		self.compresslevel = compresslevel
+
+	def Write( self, filename, read_length, barcode='', lane=1, end=1 ):
+		rng = random.Random( os.path.basename(filename) )
+		quality = 'I' * read_length
+		directory = os.path.dirname(filename)
+		if directory and not os.path.exists(directory):
+			os.makedirs(directory)
+		ofs = gzip.open( filename, 'wb', self.compresslevel )
+		for i in range(self.num_reads):
+			if barcode == 'random':
+				read_barcode = ''.join([ rng.choice('ACGT') for j in range(8) ])
+			else:
+				read_barcode = barcode
+			sequence = ''.join([ rng.choice('ACGT') for j in range(read_length) ])
+			ofs.write( "@BENCH:1:FC:%d:1101:%d:%d %d:N:0:%s\n%s\n+\n%s\n" % ( lane, 1000+i, 2000+i, end, read_barcode, sequence, quality ) )
+		ofs.close()
+
+def ReadCasavaSampleSheet( filename ):
+	"""Returns ( lane, sample, barcode, project ) for each row of a
+	CASAVA 1.8 sample sheet as written by Run.CreateSampleSheet."""
+	rows = []
+	for rec in open(filename):
+		f = rec.strip().split(',')
+		if f[0] == 'FCID' or len(f) < 10:
+			continue
+		rows.append( ( int(f[1]), f[2], f[4], f[9] ) )
+	return rows
+
+def ReadIemSampleSheet( filename ):
+	"""Returns ( lane, sample id, sample name, barcode, project ) for
+	each [Data] row of an Illumina Experiment Manager style sample sheet.
+	lane is 1 and the name is the id if the sheet has no such column."""
+	rows = []
+	columns = None
+	for rec in open(filename):
+		f = rec.strip().split(',')
+		if columns is None:
+			if 'Sample_ID' in f:
+				columns = f
+			continue
+		if not ''.join(f):
+			continue
+		row = dict(zip(columns,f))
+		rows.append( ( int(row.get('Lane') or 1), row['Sample_ID'], row.get('Sample_Name') or row['Sample_ID'],
+			row.get('index',''), row.get('Sample_Project','') ) )
+	return rows
+
+def MakeCasavaOutput( output_dir, sample_sheet, data_read_lengths, factory ):
+	"""
+	Writes what CASAVA 1.8 bcl conversion produces for a sample sheet:
+	one FASTQ file per sample, lane and data read under
+	Project_<request>/Sample_<sample>, and the reads with unknown
+	barcodes under Undetermined_indices/Sample_lane<lane>.
+	"""
+	lanes = set()
+	for ( lane, sample, barcode, project ) in ReadCasavaSampleSheet( sample_sheet ):
+		lanes.add(lane)
+		sample_dir = os.path.join( output_dir, "Project_%s" % project, "Sample_%s" % sample )
+		for end in range(1,len(data_read_lengths)+1):
+			fname = "%s_%s_L%03d_R%d_001.fastq.gz" % ( sample, barcode or 'NoIndex', lane, end )
+			factory.Write( os.path.join( sample_dir, fname ), data_read_lengths[end-1], barcode, lane, end )
+	for lane in lanes:
+		fname = "lane%d_Undetermined_L%03d_R1_001.fastq.gz" % ( lane, lane )
+		factory.Write( os.path.join( output_dir, "Undetermined_indices", "Sample_lane%d" % lane, fname ),
+			data_read_lengths[0], 'random', lane, 1 )
+
+def MakeBcl2FastqOutput( output_dir, sample_sheet, output_read_lengths, factory ):
+	"""
+	Writes what bcl2fastq2 produces for a sample sheet: one FASTQ file
+	per sample, lane and output read under <project>/, or
+	<project>/<sample id>/ when the sample name differs from the id, with
+	Illumina's _S<n> sample numbers, and the Undetermined_S0 files of
+	each lane.
+	"""
+	numbers = {}
+	lanes = set()
+	for ( lane, sample_id, sample_name, barcode, project ) in ReadIemSampleSheet( sample_sheet ):
+		lanes.add(lane)
+		n = numbers.setdefault( sample_id, len(numbers)+1 )
+		sample_dir = os.path.join( output_dir, project )
+		if sample_name != sample_id:
+			sample_dir = os.path.join( sample_dir, sample_id )
+		for r in range(1,len(output_read_lengths)+1):
+			fname = "%s_S%d_L%03d_R%d_001.fastq.gz" % ( sample_name, n, lane, r )
+			factory.Write( os.path.join( sample_dir, fname ), output_read_lengths[r-1], barcode, lane, r )
+	for lane in sorted(lanes):
+		for r in range(1,len(output_read_lengths)+1):
+			factory.Write( os.path.join( output_dir, "Undetermined_S0_L%03d_R%d_001.fastq.gz" % ( lane, r ) ),
+				output_read_lengths[r-1], 'random', lane, r )
@@ -4,7 +4,7 @@
 
 import os
 import sys
-import hcidemux.gnomex
+import hcidemux.queries
 import hcidemux.pipelineparams as params
 
 def EraseCommas(s):
@@ -60,40 +60,10 @@ class SampleSheetCreator:
 		in the sample sheet.
 		"""
 		# Select lanes from flow cell that are bar coded.
-		g = hcidemux.gnomex.GNomExConnection()
-		connection = g.GnConnect(params.db_user,params.db_password,asdict=False)
-		c = connection.cursor()
-		try:
-			query = """select flowcell.barcode,
-	flowcellchannel.number,
-	sample.number,
-	genomebuild.genomebuildname,
-	sample.barcodesequence,
-	appuser.firstname, 
-	appuser.lastname,
-	request.number,
-	sample.barcodesequenceb
-from flowcell
-	join flowcellchannel on flowcellchannel.idflowcell=flowcell.idflowcell
-	join sequencelane on sequencelane.idflowcellchannel = 
-		flowcellchannel.idflowcellchannel
-	join sample on sequencelane.idsample = sample.idsample
-	left outer join genomebuild on sequencelane.idgenomebuildalignto = 
-		genomebuild.idgenomebuild
-	join request on sequencelane.idrequest = request.idrequest
-	join appuser on request.idappuser = appuser.idappuser
-where flowcellchannel.filename = '%s'\n""" % self.id
-			if self.lanes:
-			# Append lane selection to where clause.
-				query += "and flowcellchannel.number in (%s)\n" % str(','.join(map(str,self.lanes)))
-	
-			query += "order by flowcellchannel.number, sample.number;"
-			#print query
-			c.execute(query)
-		except pymssql.OperationError:
-			sys.stderr.write( query )
-			raise
-		results = c.fetchall()
+		if self.lanes:
+			results = hcidemux.queries.Execute( 'samplesheet_lanes', ( self.id, self.lanes ) )
+		else:
+			results = hcidemux.queries.Execute( 'samplesheet', ( self.id, ) )
 		# Open file
 		#ofs = open(samplesheet_fname,'w')
 		ofs = sys.stdout
@@ -169,8 +139,6 @@ where flowcellchannel.filename = '%s'\n""" % self.id
 		# Close file.
 		#ofs.close()
 
-		# Close database.
-		connection.close()
 		# Return file name.
 
 if __name__ == "__main__":
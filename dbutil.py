@@ -3,6 +3,7 @@ import sys
 import sqlite3
 
 import hcidemux.pipelineparams as params
+from hcidemux.states import States
 TAB="\t"
 
 def Dump( conn ):
@@ -23,16 +24,35 @@ def AddRun( conn, run_id, dirname ):
 		return
 	print "retval1: %s, retval2: %s" % ( retval1, retval2)
 
+def ForgetMetadata( cursor, run_id ):
+	"""Drops the run's cached GNomEx information, if any."""
+	try:
+		cursor.execute("delete from metadata_cache where id = ?",(run_id,))
+	except sqlite3.OperationalError:
+		# Database predates the metadata_cache table.
+		pass
+
 def ChangeState( conn, run_id, new_state ):
 	cursor = conn.cursor()
 	t = ( new_state, run_id )
 	retval1=cursor.execute("update run set state = '%s' where id = '%s'" % t )
+	if new_state == States.reprocess:
+		# Sample sheet was probably fixed in GNomEx.
+		ForgetMetadata( cursor, run_id )
 	retval2=conn.commit()
 	print "retval1: %s, retval2: %s" % ( retval1, retval2)
 
 def DeleteRun( conn, run_id ):
 	cursor = conn.cursor()
 	retval1=cursor.execute("delete from run where id = '%s'" % run_id )
+	ForgetMetadata( cursor, run_id )
+	# Forget when the root directories were last scanned, so the
+	# run is rediscovered if its folder still exists.
+	try:
+		cursor.execute("delete from discovery")
+	except sqlite3.OperationalError:
+		# Database predates the discovery table.
+		pass
 	retval2=conn.commit()
 	print "retval1: %s, retval2: %s" % ( retval1, retval2)
 
@@ -2,7 +2,9 @@
 # execute_pipeline.py - top level code to run hci_demux pipelines.
 import sys
 import os
-import xml.dom.minidom
+import time
+import signal
+import traceback
 
 try:
 	import sysv_ipc
@@ -11,9 +13,14 @@ except ImportError:
 	sys.exit(1)
 
 from hcidemux.runmgr import RunMgr
+from hcidemux.runwatcher import RunWatcher
+from hcidemux.runmetadata import RunMetadataCache
+from hcidemux.runinfo import GetRunInfo
+import hcidemux.runinfo as runinfo
+import hcidemux.inventory as inventory
+import hcidemux.queries as queries
 from hcidemux.logger import Logger
 import hcidemux.pipelineparams as params
-import hcidemux.gnomex as gnomex
 
 # Run classes:
 from hcidemux.patchpcrrun import PatchPcrRun
@@ -27,52 +34,26 @@ def CountRunDataReads(run_full_path):
 	number of data reads for the sequencing run by parsing the RunInfo.xml
 	file.
 	"""
-	# Parse the RunInfo.xml file.
-	configfile = os.path.join(run_full_path, "RunInfo.xml")
-	doc = xml.dom.minidom.parse(configfile)
-
-	# Get the Read elements from the document.
-	reads=doc.getElementsByTagName("Read")
-
 	# Count the reads that are at least 25 bp long.
-	num_data_reads = 0
-	for read in reads:
-		if int(read.getAttribute('NumCycles')) >= 25:
-			num_data_reads += 1
-	return num_data_reads
+	return GetRunInfo(run_full_path).NumDataReads()
 
-def IdentifyPipeline(run_id,run_full_path):
+def IdentifyPipeline(run_id,run_full_path,metadata):
 	"""
 	IdentifyPipeline(run_id) - given id of a sequencing run (which is the
-	directory name of the run folder, not full path) returns 
-	the class that is to process the run, or None of the type of run
-	isn't recognized.
+	directory name of the run folder, not full path) and its RunMetadata
+	object, returns the class that is to process the run, or None of the
+	type of run isn't recognized.
 	"""
-	# Connect to GNomex.
-	connection = gnomex.GNomExConnection().GnConnect(params.db_user,params.db_password)
-	c = connection.cursor()
-	# Select the sequencing application name(s) in use on the flow cell.
-	query="""select distinct application.application
-		from application 
-		join seqlibprotocolapplication 
-		on application.codeapplication = seqlibprotocolapplication.codeapplication
-		join seqlibprotocol on seqlibprotocol.idseqlibprotocol = seqlibprotocolapplication.idseqlibprotocol
-		join sample on sample.idseqlibprotocol = seqlibprotocol.idseqlibprotocol
-		join sequencelane on sequencelane.idsample = sample.idsample
-		join flowcellchannel on sequencelane.idflowcellchannel = flowcellchannel.idflowcellchannel
-		where flowcellchannel.filename = '%s';"""% run_id
-	c.execute(query)
-	recs=c.fetchall()
-	# recs is a list of tuples each containing a unicode string. Convert
-	# this into a single pipe delimited string.
-	applications = '|'.join(map( lambda x: str(x[0]), recs ))
+	# The sequencing application name(s) in use on the flow cell, as a
+	# single pipe delimited string.
+	applications = '|'.join(map( str, metadata.applications ))
 
 	Logger().Log("Run %s seq applications: %s." % ( run_id, applications ))
 	num_reads = CountRunDataReads(run_full_path)
 	Logger().Log("Run %s has %d data reads." % (run_id,num_reads))
-	if applications.find("Patch PCR") > -1:
+	if metadata.HasApplication("Patch PCR"):
 		return PatchPcrRun
-	elif applications.find("Kappa PCR") > -1:
+	elif metadata.HasApplication("Kappa PCR"):
 		return KappaPcrRun
 	elif num_reads == 2:
 		# This is a standard paired-end HiSeq run.
@@ -105,10 +86,133 @@ def execute(pipeline_class):
 		raise
 
 
+def RunCycle( run_mgr, wait=True, full_scan=False ):
+	"""
+	RunCycle makes one pass of the pipeline: discovers new runs, then
+	advances every active run through its state machine. If wait is
+	False, runs handed to worker processes are left running when
+	RunCycle returns. If full_scan is True every root directory is
+	listed, even those that look unchanged.
+	"""
+	# Discover new sequencing runs and add them to the sqlite 
+	# database.
+	run_mgr.Discover(params.root_directories,full_scan)
+
+	# Process active runs, ie runs not finished or in error state.
+	# A worker from an earlier cycle may still be on some of them.
+	active_runs = [ rec for rec in run_mgr.GetActiveRuns() if not run_mgr.IsBusy(rec[0]) ]
+
+	# Get the GNomEx information for all of them in one go, from the
+	# cache where it is recent enough.
+	snapshot = RunMetadataCache().Get([ ( run_id, run_state ) for (run_id,run_full_path,run_state) in active_runs ])
+
+	for (run_id,run_full_path,run_state) in active_runs:
+		# Identify the class to handle the run and the class
+		# of the run itself.
+		run_class = IdentifyPipeline(run_id,run_full_path,snapshot[run_id])
+		# Create an object of that specific pipeline class.
+		if run_class is None:
+			# We could not find a pipeline for the run.
+			Logger().Log("No pipeline class found for run %s." % run_full_path)
+		else:
+			Logger().Log("Will process run %s with run class %s." % ( run_id, run_class ) )
+			run_object = run_class(run_id,run_full_path,run_state,snapshot[run_id])
+			# Process the run.
+			run_mgr.AddRun( run_object )
+	run_mgr.ProcessRuns(wait)
+	run_mgr.ClearRuns()
+
+	# Forget what was cached about runs that finished or failed.
+	active_dirs = [ dirname for (run_id,dirname,state) in run_mgr.GetActiveRuns() ]
+	runinfo.Prune( active_dirs )
+	inventory.Prune( active_dirs )
+
+	# Show where the GNomEx time went.
+	report = queries.LatencyReport()
+	if report:
+		Logger().Log(["GNomEx query latency this cycle:"]+report)
+	queries.ResetStats()
+
+def OpenDailyLog( log_prefix, current=None ):
+	"""
+	Points stdout and stderr, of this process and of the programs it
+	starts, at log_prefix followed by today's date, unless that's
+	current. Returns the name of the log.
+	"""
+	fname = log_prefix + time.strftime("%Y-%m-%d")
+	if fname != current:
+		sys.stdout.flush()
+		sys.stderr.flush()
+		fd = os.open( fname, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0644 )
+		os.dup2( fd, 1 )
+		os.dup2( fd, 2 )
+		os.close( fd )
+	return fname
+
+def Daemon( run_mgr, log_prefix=None ):
+	"""
+	Daemon runs the pipeline continuously. Between cycles it waits for
+	inotify events on the run directories (new run folders and the
+	Basecalling_Netcopy_complete_Read*.txt / RTAComplete markers), and
+	falls back to a full rescan every params.daemon_rescan_interval
+	seconds in case an event was missed. While workers are busy or runs
+	wait for one, it waits only params.daemon_busy_interval seconds
+	(default 30), since a worker finishing doesn't make an event. With
+	log_prefix, each cycle logs to log_prefix followed by the date, so
+	the log rolls over daily.
+	"""
+	rescan_interval = getattr(params,'daemon_rescan_interval',3600)
+	busy_interval = min( getattr(params,'daemon_busy_interval',30), rescan_interval )
+	log = None
+	if log_prefix:
+		log = OpenDailyLog( log_prefix )
+	watcher = RunWatcher(params.root_directories)
+	Logger().Log("%s - running as a daemon, full rescan every %d seconds." % ( sys.argv[0], rescan_interval ))
+	full_scan = False
+	last_full_scan = time.time()
+	while True:
+		if full_scan:
+			last_full_scan = time.time()
+		if log_prefix:
+			log = OpenDailyLog( log_prefix, log )
+		try:
+			RunCycle(run_mgr,wait=False,full_scan=full_scan)
+		except Exception:
+			# Keep the daemon alive through problems like a
+			# GNomEx outage. The next cycle will try again.
+			Logger().Log(["%s - exception during pipeline cycle. Details:" % sys.argv[0]]+traceback.format_exc().splitlines())
+			run_mgr.ClearRuns()
+		# Only the active runs need their folders watched.
+		watcher.WatchRuns([ dirname for (run_id,dirname,state) in run_mgr.GetActiveRuns() ])
+		until_rescan = max( 0, last_full_scan + rescan_interval - time.time() )
+		busy = run_mgr.ReapWorkers() or run_mgr.deferred
+		if watcher.Wait( min( busy_interval, until_rescan ) if busy else until_rescan ):
+			Logger().Log("Run folder activity detected, starting pipeline cycle.")
+			full_scan = False
+		elif time.time() >= last_full_scan + rescan_interval:
+			Logger().Log("Starting periodic full rescan.")
+			full_scan = True
+		else:
+			Logger().Log("Checking on worker processes and runs waiting for one.")
+			full_scan = False
+
+def Terminate( signum, frame ):
+	"""Turns SIGTERM into SystemExit so the semaphore gets cleaned up."""
+	raise SystemExit("Terminated by signal %d." % signum)
+
 def main():
 	"""
-	main() function for hci_demux package.
+	main() function for hci_demux package. Run with --daemon to keep
+	running and watch for new runs instead of exiting after one pass.
+	--log-prefix PREFIX makes the daemon log to PREFIX followed by the
+	date (process_pipelines.sh's log names).
 	"""
+	args = sys.argv[1:]
+	daemon = '--daemon' in args
+	log_prefix = None
+	if '--log-prefix' in args and args.index('--log-prefix') + 1 < len(args):
+		log_prefix = args[ args.index('--log-prefix') + 1 ]
+
 	# Set up semaphore to guarantee exclusivity.
 	keyval = 43
 	flags = sysv_ipc.IPC_CREX
@@ -119,30 +223,15 @@ def main():
 	except sysv_ipc.ExistentialError:
 		Logger().Log( "%s - program already running." % sys.argv[0] )
 		sys.exit(0)
+	signal.signal(signal.SIGTERM, Terminate)
 
 	try:
 		# Create a generic RunMgr object.
 		run_mgr = RunMgr()
-
-		# Discover new sequencing runs and add them to the sqlite 
-		# database.
-		run_mgr.Discover(params.root_directories)
-
-		# Process active runs, ie runs not finished or in error state.
-		for (run_id,run_full_path,run_state) in run_mgr.GetActiveRuns():
-			# Identify the class to handle the run and the class
-			# of the run itself.
-			run_class = IdentifyPipeline(run_id,run_full_path)
-			# Create an object of that specific pipeline class.
-			if run_class is None:
-				# We could not find a pipeline for the run.
-				Logger().Log("No pipeline class found for run %s." % run_full_path)
-			else:
-				Logger().Log("Will process run %s with run class %s." % ( run_id, run_class ) )
-				run_object = run_class(run_id,run_full_path,run_state)
-				# Process the run.
-				run_mgr.AddRun( run_object )
-		run_mgr.ProcessRuns()
+		if daemon:
+			Daemon(run_mgr,log_prefix)
+		else:
+			RunCycle(run_mgr)
 	except:
 		# Clean up after unforseen errors.
 		Logger().Log("%s - unexpected exception caught." % sys.argv[0])
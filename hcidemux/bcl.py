@@ -0,0 +1,420 @@
+"""
+bcl.py - reads base calls straight from a run folder's BaseCalls
+directory, without running bcl2fastq: per cycle .bcl files (plain,
+.bcl.gz or .bcl.zst), the .cbcl files of newer instruments, the .filter
+files marking the clusters that passed filter, and the .locs or .clocs
+files of cluster positions. Calls are decoded into arrays of tile x
+cycle with numpy, so the index cycles of a run, or a sample of its
+reads, can be looked at in seconds, even before the run completes. Needs numpy; zstd compressed bcl files also need zstandard.
+
+A .bcl file is a 32 bit cluster count followed by a byte per cluster:
+base in the low 2 bits (A, C, G, T), quality in the high 6 bits, 0 for a
+no call. A .filter file is a 32 bit zero, a 32 bit version and a 32 bit
+cluster count (or just the count, in old versions) followed by a byte
+per cluster, bit 0 set for clusters that passed filter. A .cbcl file
+holds all tiles of one surface for one cycle in separately gzipped
+blocks of 4 bit calls with binned qualities.
+"""
+import os
+import re
+import zlib
+import struct
+import collections
+
+import runinfo
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+# Letters of the base numbers.
+BASES = "ACGT"
+
+# Phred quality reported for no calls, as bcl2fastq does.
+NO_CALL_QUALITY = 2
+
+# Layout of .clocs files: bins of 25 x 25 pixels, 82 bins across an
+# image 2048 pixels wide.
+CLOCS_BIN_SIZE = 25
+CLOCS_BINS_PER_ROW = 82
+
+# Bases and qualities of one tile. bases is an array of clusters x cycles
+# ASCII letters (N for no calls), qualities one of clusters x cycles phred
+# scores; each row is a cluster.
+TileCalls = collections.namedtuple( 'TileCalls', [ 'lane', 'tile', 'cycles', 'bases', 'qualities' ] )
+
+def CheckNumpy():
+	if numpy is None:
+		raise ImportError( "Reading bcl files needs numpy." )
+
+def GunzipBytes( data ):
+	"""Uncompresses gzip data of one or more members (bcl.gz files are
+	BGZF, a series of gzip members)."""
+	parts = []
+	while data:
+		d = zlib.decompressobj( 16 + zlib.MAX_WBITS )
+		parts.append( d.decompress( data ) )
+		parts.append( d.flush() )
+		data = d.unused_data
+	return ''.join( parts )
+
+def ReadBytes( filename ):
+	"""Contents of a file, uncompressed according to its name."""
+	ifs = open( filename, 'rb' )
+	try:
+		data = ifs.read()
+	finally:
+		ifs.close()
+	if filename.endswith('.gz'):
+		return GunzipBytes( data )
+	if filename.endswith('.zst'):
+		if zstandard is None:
+			raise IOError( "Can't read %s, zstandard isn't installed." % filename )
+		return zstandard.ZstdDecompressor().decompressobj().decompress( data )
+	return data
+
+def ReadBcl( filename ):
+	"""
+	Returns the raw calls of a .bcl, .bcl.gz or .bcl.zst file as an
+	array of bytes, one per cluster. An uncompressed file is memory
+	mapped rather than read.
+	"""
+	CheckNumpy()
+	if filename.endswith('.bcl'):
+		ifs = open( filename, 'rb' )
+		try:
+			header = ifs.read( 4 )
+		finally:
+			ifs.close()
+		if len(header) < 4:
+			raise ValueError( "%s is too short for a bcl file." % filename )
+		count = struct.unpack( '<I', header )[0]
+		if count == 0:
+			return numpy.zeros( 0, numpy.uint8 )
+		return numpy.memmap( filename, dtype=numpy.uint8, mode='r', offset=4, shape=(count,) )
+	data = ReadBytes( filename )
+	count = struct.unpack( '<I', data[:4] )[0]
+	calls = numpy.frombuffer( data, numpy.uint8, count, 4 )
+	return calls
+
+def ReadFilter( filename ):
+	"""Returns an array of booleans, True for each cluster of a .filter
+	file that passed filter."""
+	CheckNumpy()
+	data = ReadBytes( filename )
+	( first, ) = struct.unpack( '<I', data[:4] )
+	if first == 0:
+		( version, count ) = struct.unpack( '<II', data[4:12] )
+		offset = 12
+	else:
+		count = first
+		offset = 4
+	flags = numpy.frombuffer( data, numpy.uint8, count, offset )
+	return ( flags & 1 ).astype( numpy.bool_ )
+
+def ReadLocs( filename ):
+	"""
+	Returns ( x, y ) arrays of the cluster positions in a .locs file
+	(a 32 bit 1, a float 1.0 and a 32 bit count, then x and y floats
+	per cluster) or a .clocs file (a version byte and a 32 bit bin
+	count, then for each 25 pixel square bin of a 2048 pixel wide image
+	a count byte followed by x and y bytes in tenths of a pixel per
+	cluster).
+	"""
+	CheckNumpy()
+	data = ReadBytes( filename )
+	if filename.endswith('.locs'):
+		( count, ) = struct.unpack( '<I', data[8:12] )
+		xy = numpy.frombuffer( data, '<f4', 2*count, 12 )
+		return ( xy[0::2], xy[1::2] )
+	( num_bins, ) = struct.unpack( '<I', data[1:5] )
+	raw = numpy.frombuffer( data, numpy.uint8, len(data)-5, 5 )
+	bin_numbers = []
+	offsets = []
+	counts = []
+	offset = 0
+	for b in xrange( num_bins ):
+		count = int( raw[offset] )
+		if count:
+			bin_numbers.append( b )
+			offsets.append( offset + 1 )
+			counts.append( count )
+		offset += 1 + 2 * count
+	counts = numpy.array( counts, numpy.intp )
+	bins = numpy.repeat( numpy.array( bin_numbers, numpy.intp ), counts )
+	# Position of each cluster's x byte.
+	starts = numpy.repeat( numpy.array( offsets, numpy.intp ), counts )
+	within = numpy.arange( counts.sum() ) - numpy.repeat( numpy.cumsum( counts ) - counts, counts )
+	xbytes = starts + 2 * within
+	x = CLOCS_BIN_SIZE * ( bins % CLOCS_BINS_PER_ROW ) + raw[xbytes] / 10.0
+	y = CLOCS_BIN_SIZE * ( bins // CLOCS_BINS_PER_ROW ) + raw[xbytes+1] / 10.0
+	return ( x, y )
+
+def DecodeCalls( calls ):
+	"""
+	Decodes raw calls (bcl bytes, any shape) into ( bases, qualities )
+	arrays of the same shape: ASCII base letters, N for no calls, and
+	phred qualities.
+	"""
+	letters = numpy.frombuffer( BASES, numpy.uint8 )
+	bases = letters[ calls & 3 ]
+	qualities = calls >> 2
+	no_call = calls == 0
+	bases[no_call] = ord('N')
+	qualities[no_call] = NO_CALL_QUALITY
+	return ( bases, qualities )
+
+class CbclFile:
+	"""
+	The header of a .cbcl file, listing its tiles, and their blocks read
+	on demand. Read returns a tile's calls in .bcl encoding, with the
+	quality bins mapped to their scores.
+	"""
+	def __init__( self, filename ):
+		self.filename = filename
+		ifs = open( filename, 'rb' )
+		try:
+			( version, header_size, bits_per_call, bits_per_quality, num_bins ) = struct.unpack( '<HIBBI', ifs.read(12) )
+			if bits_per_call != 2 or bits_per_quality != 2:
+				raise ValueError( "%s has %d bit calls and %d bit qualities, only 2 and 2 are supported." % ( filename, bits_per_call, bits_per_quality ) )
+			bins = struct.unpack( '<%dI' % (2*num_bins), ifs.read(8*num_bins) )
+			( num_tiles, ) = struct.unpack( '<I', ifs.read(4) )
+			entries = struct.unpack( '<%dI' % (4*num_tiles), ifs.read(16*num_tiles) )
+			( self.pf_only, ) = struct.unpack( '<B', ifs.read(1) )
+		finally:
+			ifs.close()
+		# Score of each quality bin; bin 0 is only used by no calls.
+		scores = [ 0, 1, 2, 3 ]
+		for i in range(num_bins):
+			scores[bins[2*i]] = bins[2*i+1]
+		self.scores = numpy.array( scores, numpy.uint8 )
+		# ( offset, clusters, compressed size ) indexed by tile number.
+		self.tiles = {}
+		offset = header_size
+		for i in range(num_tiles):
+			( tile, clusters, size, compressed_size ) = entries[4*i:4*i+4]
+			self.tiles[tile] = ( offset, clusters, compressed_size )
+			offset += compressed_size
+
+	def Read( self, tile ):
+		( offset, clusters, compressed_size ) = self.tiles[tile]
+		ifs = open( self.filename, 'rb' )
+		try:
+			ifs.seek( offset )
+			data = GunzipBytes( ifs.read( compressed_size ) )
+		finally:
+			ifs.close()
+		packed = numpy.frombuffer( data, numpy.uint8 )
+		nibbles = numpy.empty( 2 * len(packed), numpy.uint8 )
+		nibbles[0::2] = packed & 0x0f
+		nibbles[1::2] = packed >> 4
+		nibbles = nibbles[:clusters]
+		calls = ( self.scores[ nibbles >> 2 ] << 2 ) | ( nibbles & 3 )
+		calls[ nibbles == 0 ] = 0
+		return calls
+
+class BclReader:
+	"""
+	Reads base calls from the BaseCalls directory of a run folder. Tile
+	numbers are the ones in the file names (1101, ...); cycles are
+	numbered from 1 across all reads, as in the C<cycle>.1 directories.
+	"""
+	def __init__( self, run_dir ):
+		CheckNumpy()
+		self.run_dir = run_dir
+		self.basecalls = os.path.join( run_dir, "Data", "Intensities", "BaseCalls" )
+		# Cycle directories indexed by lane, then by cycle.
+		self.cycle_dirs = {}
+		# CbclFile objects indexed by file name.
+		self.cbcl_files = {}
+
+	def LaneDir( self, lane ):
+		return os.path.join( self.basecalls, "L%03d" % lane )
+
+	def CycleDirs( self, lane ):
+		"""The cycle directories of a lane, indexed by cycle, listed
+		again each time a cycle is missing so a running sequencer's new
+		cycles are found."""
+		dirs = self.cycle_dirs.get( lane, {} )
+		if not dirs:
+			lane_dir = self.LaneDir( lane )
+			for name in os.listdir( lane_dir ):
+				m = re.match( r"C(\d+)\.\d+$", name )
+				if m:
+					dirs[int(m.group(1))] = os.path.join( lane_dir, name )
+			self.cycle_dirs[lane] = dirs
+		return dirs
+
+	def CycleDir( self, lane, cycle ):
+		try:
+			return self.CycleDirs( lane )[cycle]
+		except KeyError:
+			self.cycle_dirs.pop( lane, None )
+		try:
+			return self.CycleDirs( lane )[cycle]
+		except KeyError:
+			raise IOError( "Lane %d has no cycle %d in %s." % ( lane, cycle, self.basecalls ) )
+
+	def Tiles( self, lane ):
+		"""Numbers of the tiles of a lane that have a .filter file."""
+		tiles = set()
+		for dirname in [ self.LaneDir( lane ), self.basecalls ]:
+			if not os.path.isdir( dirname ):
+				continue
+			for name in os.listdir( dirname ):
+				m = re.match( r"s_%d_(\d+)\.filter(\.gz)?$" % lane, name )
+				if m:
+					tiles.add( int(m.group(1)) )
+		return sorted( tiles )
+
+	def FilterFile( self, lane, tile ):
+		for dirname in [ self.LaneDir( lane ), self.basecalls ]:
+			for suffix in [ '', '.gz' ]:
+				filename = os.path.join( dirname, "s_%d_%d.filter%s" % ( lane, tile, suffix ) )
+				if os.path.exists( filename ):
+					return filename
+		raise IOError( "No filter file for lane %d tile %d in %s." % ( lane, tile, self.basecalls ) )
+
+	def Positions( self, lane, tile ):
+		"""
+		Returns ( x, y ) arrays of the positions of all a tile's
+		clusters, as bcl2fastq writes them in read names, from its
+		.locs or .clocs file, or None if it has neither.
+		"""
+		intensities = os.path.dirname( self.basecalls )
+		for dirname in [ os.path.join( intensities, "L%03d" % lane ), self.LaneDir( lane ) ]:
+			for suffix in [ '.locs', '.clocs' ]:
+				filename = os.path.join( dirname, "s_%d_%d%s" % ( lane, tile, suffix ) )
+				if os.path.exists( filename ):
+					( x, y ) = ReadLocs( filename )
+					return ( numpy.rint( 10 * x + 1000 ).astype( numpy.int64 ), numpy.rint( 10 * y + 1000 ).astype( numpy.int64 ) )
+		return None
+
+	def PassingFilter( self, lane, tile ):
+		"""Array of booleans, True for each cluster of a tile that passed
+		filter."""
+		return ReadFilter( self.FilterFile( lane, tile ) )
+
+	def CycleCalls( self, lane, tile, cycle ):
+		"""Raw calls of a tile in one cycle, and whether they include
+		clusters that didn't pass filter."""
+		cycle_dir = self.CycleDir( lane, cycle )
+		base = os.path.join( cycle_dir, "s_%d_%d.bcl" % ( lane, tile ) )
+		for suffix in [ '', '.gz', '.zst' ]:
+			if os.path.exists( base + suffix ):
+				return ( ReadBcl( base + suffix ), True )
+		cbcl = os.path.join( cycle_dir, "L%03d_%d.cbcl" % ( lane, int(str(tile)[0]) ) )
+		if os.path.exists( cbcl ):
+			cbcl_file = self.cbcl_files.get( cbcl )
+			if cbcl_file is None:
+				cbcl_file = CbclFile( cbcl )
+				self.cbcl_files[cbcl] = cbcl_file
+			return ( cbcl_file.Read( tile ), not cbcl_file.pf_only )
+		raise IOError( "No bcl file for lane %d tile %d cycle %d in %s." % ( lane, tile, cycle, cycle_dir ) )
+
+	def ReadTile( self, lane, tile, cycles, passing_filter=True ):
+		"""
+		Returns the TileCalls of a tile for the given cycles. With
+		passing_filter only the clusters that passed filter are
+		included. Raises IOError if a cycle's file isn't there (yet).
+		"""
+		cycles = list( cycles )
+		passed = None
+		raw = None
+		for ( i, cycle ) in enumerate( cycles ):
+			( calls, all_clusters ) = self.CycleCalls( lane, tile, cycle )
+			if passing_filter and all_clusters:
+				if passed is None:
+					passed = ReadFilter( self.FilterFile( lane, tile ) )
+				if len(passed) != len(calls):
+					raise ValueError( "Lane %d tile %d cycle %d has %d clusters, its filter file %d." % ( lane, tile, cycle, len(calls), len(passed) ) )
+				calls = calls[passed]
+			if raw is None:
+				raw = numpy.empty( ( len(calls), len(cycles) ), numpy.uint8 )
+			elif len(calls) != raw.shape[0]:
+				raise ValueError( "Lane %d tile %d cycle %d has %d clusters, cycle %d %d." % ( lane, tile, cycle, len(calls), cycles[0], raw.shape[0] ) )
+			raw[:,i] = calls
+		if raw is None:
+			raw = numpy.empty( ( 0, 0 ), numpy.uint8 )
+		( bases, qualities ) = DecodeCalls( raw )
+		return TileCalls( lane, tile, cycles, bases, qualities )
+
+	def IndexCycles( self ):
+		"""Lists of the cycles of each index read, from RunInfo.xml."""
+		reads = []
+		first = 1
+		for read in runinfo.GetRunInfo( self.run_dir ).reads:
+			if read.is_index:
+				reads.append( range( first, first + read.cycles ) )
+			first += read.cycles
+		return reads
+
+	def CountIndexes( self, lane, tiles=None, index_cycles=None ):
+		"""
+		Counts the index sequences of the clusters that passed filter in
+		a lane (or the given tiles of it). Dual indexes are joined with
+		'-', as in sample sheets. index_cycles defaults to IndexCycles().
+		Returns a dictionary of counts indexed by sequence.
+		"""
+		if index_cycles is None:
+			index_cycles = self.IndexCycles()
+		cycles = sum( index_cycles, [] )
+		if not cycles:
+			return {}
+		if tiles is None:
+			tiles = self.Tiles( lane )
+		counts = collections.defaultdict( int )
+		for tile in tiles:
+			bases = self.ReadTile( lane, tile, cycles ).bases
+			if not len(bases):
+				continue
+			( sequences, tile_counts ) = numpy.unique( Sequences( bases ), return_counts=True )
+			for ( seq, count ) in zip( sequences, tile_counts ):
+				counts[str(seq)] += int(count)
+		if len(index_cycles) > 1:
+			joined = collections.defaultdict( int )
+			for ( seq, count ) in counts.iteritems():
+				parts = []
+				first = 0
+				for read in index_cycles:
+					parts.append( seq[first:first+len(read)] )
+					first += len(read)
+				joined['-'.join(parts)] += count
+			counts = joined
+		return dict( counts )
+
+	def SampleReads( self, lane, cycles, count, tiles=None ):
+		"""
+		Returns up to count ( sequence, quality ) pairs of clusters that
+		passed filter, spread evenly over the tiles and over the
+		clusters of each tile. Qualities are phred+33 strings.
+		"""
+		if tiles is None:
+			tiles = self.Tiles( lane )
+		if not tiles:
+			return []
+		reads = []
+		per_tile = -( -count // len(tiles) )
+		for tile in tiles:
+			calls = self.ReadTile( lane, tile, cycles )
+			clusters = len(calls.bases)
+			if not clusters:
+				continue
+			rows = numpy.unique( numpy.linspace( 0, clusters - 1, min( per_tile, clusters ) ).astype( numpy.intp ) )
+			sequences = Sequences( calls.bases[rows] )
+			qualities = Sequences( calls.qualities[rows] + 33 )
+			reads.extend( zip( sequences, qualities ) )
+		return reads[:count]
+
+def Sequences( array ):
+	"""Rows of a 2 dimensional array of bytes as strings."""
+	array = numpy.ascontiguousarray( array, numpy.uint8 )
+	if array.shape[1] == 0:
+		return [ '' ] * array.shape[0]
+	return array.view( 'S%d' % array.shape[1] ).ravel()
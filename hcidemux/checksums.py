@@ -0,0 +1,138 @@
+"""
+checksums.py - MD5 checksums of data files, and their .md5 files in
+md5sum's format. ChecksumService hashes a batch of files on several
+threads (hashlib releases the GIL while it digests large buffers), telling
+the kernel each file will be read sequentially. Stages that already read
+or write a file's bytes use a StreamingChecksum instead, so the file never
+has to be read again just to checksum it.
+"""
+import os
+import hashlib
+import threading
+
+from logger import Logger
+
+# posix_fadvise is in the os module from python 3.3. On python 2.7 call
+# the C library's, if it can be found.
+try:
+	from os import posix_fadvise, POSIX_FADV_SEQUENTIAL
+except ImportError:
+	POSIX_FADV_SEQUENTIAL = 2
+	try:
+		import ctypes
+		import ctypes.util
+		libc = ctypes.CDLL( ctypes.util.find_library('c'), use_errno=True )
+		posix_fadvise = libc.posix_fadvise
+		posix_fadvise.argtypes = [ ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int ]
+	except ( ImportError, OSError, AttributeError, TypeError ):
+		posix_fadvise = None
+
+# Read buffer size.
+BUFFER_SIZE = 4 * 1024 * 1024
+
+def AdviseSequential( f ):
+	"""Hints that the open file f will be read from start to end, so
+	the kernel reads ahead aggressively."""
+	if posix_fadvise is not None:
+		try:
+			posix_fadvise( f.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL )
+		except OSError:
+			pass
+
+def HashFile( filename ):
+	"""Returns the MD5 hex digest of a file."""
+	md5 = hashlib.md5()
+	ifs = open( filename, 'rb' )
+	AdviseSequential( ifs )
+	while True:
+		block = ifs.read( BUFFER_SIZE )
+		if not block:
+			break
+		md5.update( block )
+	ifs.close()
+	return md5.hexdigest()
+
+def WriteChecksumFile( filename, md5 ):
+	"""Writes filename.md5 in md5sum's format, atomically, so a reader
+	never sees a partial file. Returns its name."""
+	md5file = filename + ".md5"
+	tmpfile = "%s.tmp%d" % ( md5file, os.getpid() )
+	ofs = open( tmpfile, 'w' )
+	ofs.write( "%s  %s\n" % ( md5, os.path.basename(filename) ) )
+	ofs.close()
+	os.rename( tmpfile, md5file )
+	return md5file
+
+def ReadChecksumFile( filename ):
+	"""Returns the MD5 recorded in filename.md5, or None."""
+	try:
+		ifs = open( filename + ".md5" )
+		f = ifs.readline().split()
+		ifs.close()
+	except IOError:
+		return None
+	if f and len(f[0]) == 32:
+		return f[0]
+	return None
+
+class StreamingChecksum:
+	"""
+	Checksum hook for a stage that streams a file's data: pass every
+	block to Update, then call Finish with the file's name to get the
+	digest and write the .md5 file.
+	"""
+	def __init__( self ):
+		self.md5 = hashlib.md5()
+		self.nbytes = 0
+
+	def Update( self, block ):
+		self.md5.update( block )
+		self.nbytes += len(block)
+
+	def HexDigest( self ):
+		return self.md5.hexdigest()
+
+	def Finish( self, filename ):
+		digest = self.md5.hexdigest()
+		WriteChecksumFile( filename, digest )
+		return digest
+
+class ChecksumService(Logger):
+	"""
+	Computes the MD5 checksums of a batch of files on several threads
+	and writes their .md5 files. Checksums are kept in the results
+	dictionary indexed by file name.
+	"""
+	def __init__( self ):
+		self.files = []
+		self.results = {}
+		self.errors = []
+		self.lock = threading.Lock()
+
+	def AddFile( self, filename ):
+		self.files.append( filename )
+
+	def Worker( self ):
+		while True:
+			with self.lock:
+				if not self.files:
+					return
+				filename = self.files.pop(0)
+			try:
+				digest = HashFile( filename )
+				WriteChecksumFile( filename, digest )
+				with self.lock:
+					self.results[filename] = digest
+			except ( IOError, OSError ), e:
+				self.Log( "PROBLEM! Can't checksum %s: %s" % ( filename, e ) )
+				with self.lock:
+					self.errors.append( filename )
+
+	def Run( self, numthreads=5 ):
+		"""Checksums all the files added. Returns True if all succeeded."""
+		threads = [ threading.Thread( target=self.Worker ) for i in range( min( numthreads, len(self.files) ) ) ]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		return not self.errors
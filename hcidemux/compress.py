@@ -0,0 +1,278 @@
+"""
+compress.py - compresses and uncompresses run folder files (bcl, text
+and control files) in this process's own pool of worker processes
+instead of forking gzip or gunzip once per file. Each worker handles a
+batch of files, so the cost of starting work is paid once per batch
+rather than once per small file. Files are compressed with gzip, or with
+zstd if the zstandard module is installed and asked for. Each finished
+file is recorded in a manifest in the run folder, so an interrupted
+stage skips the files it already did when it's run again.
+"""
+import os
+import gzip
+import shutil
+import multiprocessing
+
+from logger import Logger
+
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+
+# File name suffix of each codec.
+SUFFIXES = { 'gzip': '.gz', 'zstd': '.zst' }
+
+# Default compression level of each codec. 6 is gzip's own default.
+DEFAULT_LEVELS = { 'gzip': 6, 'zstd': 3 }
+
+# Name of the manifest file, in the top directory of the run folder.
+MANIFEST_NAME = "compression_manifest.txt"
+
+# Files in a batch: at most this many, and at most this many bytes.
+BATCH_FILES = 256
+BATCH_BYTES = 256 * 1024 * 1024
+
+# Copy buffer size.
+BUFFER_SIZE = 1024 * 1024
+
+def Codecs():
+	"""Returns the names of the codecs available."""
+	if zstandard is None:
+		return [ 'gzip' ]
+	return [ 'gzip', 'zstd' ]
+
+def CodecOf( filename ):
+	"""Returns the codec of a compressed file, from its name, or None."""
+	for ( codec, suffix ) in SUFFIXES.iteritems():
+		if filename.endswith( suffix ):
+			return codec
+	return None
+
+def CopyStream( ifs, ofs ):
+	while True:
+		block = ifs.read( BUFFER_SIZE )
+		if not block:
+			break
+		ofs.write( block )
+
+def CompressFile( src, dest, codec, level ):
+	"""Compresses src into dest."""
+	ifs = open( src, 'rb' )
+	try:
+		if codec == 'zstd':
+			ofs = open( dest, 'wb' )
+			try:
+				zstandard.ZstdCompressor( level=level ).copy_stream( ifs, ofs )
+			finally:
+				ofs.close()
+		else:
+			ofs = gzip.GzipFile( dest, 'wb', level )
+			try:
+				CopyStream( ifs, ofs )
+			finally:
+				ofs.close()
+	finally:
+		ifs.close()
+
+def UncompressFile( src, dest, codec ):
+	"""Uncompresses src into dest."""
+	ofs = open( dest, 'wb' )
+	try:
+		if codec == 'zstd':
+			ifs = open( src, 'rb' )
+			try:
+				zstandard.ZstdDecompressor().copy_stream( ifs, ofs )
+			finally:
+				ifs.close()
+		else:
+			ifs = gzip.open( src, 'rb' )
+			try:
+				CopyStream( ifs, ofs )
+			finally:
+				ifs.close()
+	finally:
+		ofs.close()
+
+def Convert( src, dest, codec, level, compress ):
+	"""
+	Compresses or uncompresses src into dest, then removes src, like
+	gzip and gunzip. dest gets src's permissions and times and appears
+	under its own name only once it's complete. Returns dest's size.
+	"""
+	tmpfile = dest + ".partial"
+	try:
+		if compress:
+			CompressFile( src, tmpfile, codec, level )
+		else:
+			UncompressFile( src, tmpfile, codec )
+		shutil.copystat( src, tmpfile )
+	except:
+		if os.path.exists( tmpfile ):
+			os.unlink( tmpfile )
+		raise
+	os.rename( tmpfile, dest )
+	os.unlink( src )
+	return os.path.getsize( dest )
+
+def ConvertBatch( args ):
+	"""
+	Worker process entry point. Converts a batch of ( src, dest ) pairs
+	and returns a list of ( src, dest, size, error ), error being None
+	on success.
+	"""
+	( batch, codec, level, compress ) = args
+	results = []
+	for ( src, dest ) in batch:
+		try:
+			results.append( ( src, dest, Convert( src, dest, codec, level, compress ), None ) )
+		except ( IOError, OSError, EOFError ), e:
+			results.append( ( src, dest, None, str(e) ) )
+		except Exception, e:
+			# zstandard raises its own error type.
+			results.append( ( src, dest, None, "%s: %s" % ( e.__class__.__name__, e ) ) )
+	return results
+
+def Batches( files, sizes ):
+	"""Splits ( src, dest ) pairs into batches of at most BATCH_FILES
+	files and BATCH_BYTES bytes (a single larger file is a batch)."""
+	batch = []
+	nbytes = 0
+	for ( pair, size ) in zip( files, sizes ):
+		if batch and ( len(batch) >= BATCH_FILES or nbytes + size > BATCH_BYTES ):
+			yield batch
+			batch = []
+			nbytes = 0
+		batch.append( pair )
+		nbytes += size
+	if batch:
+		yield batch
+
+class Manifest:
+	"""
+	Record of the files a compression stage finished, one line per file:
+	the output file's path relative to the run folder, its size and its
+	codec ('none' for uncompressed output). Later lines override earlier
+	ones.
+	"""
+	def __init__( self, run_dir ):
+		self.run_dir = run_dir
+		self.filename = os.path.join( run_dir, MANIFEST_NAME )
+		self.done = {}
+		try:
+			ifs = open( self.filename )
+		except IOError:
+			return
+		for line in ifs:
+			f = line.rstrip("\n").split("\t")
+			if len(f) == 3 and f[1].isdigit():
+				self.done[f[0]] = ( int(f[1]), f[2] )
+		ifs.close()
+
+	def IsDone( self, dest, codec ):
+		"""True if dest was completed and is still there, unchanged."""
+		rec = self.done.get( os.path.relpath( dest, self.run_dir ) )
+		if rec is None or rec[1] != codec:
+			return False
+		try:
+			return os.path.getsize( dest ) == rec[0]
+		except OSError:
+			return False
+
+	def Record( self, results, codec ):
+		"""Appends the ( dest, size ) pairs completed."""
+		if not results:
+			return
+		ofs = open( self.filename, 'a' )
+		for ( dest, size ) in results:
+			name = os.path.relpath( dest, self.run_dir )
+			self.done[name] = ( size, codec )
+			ofs.write( "%s\t%d\t%s\n" % ( name, size, codec ) )
+		ofs.close()
+
+class Compressor(Logger):
+	"""
+	Compresses or uncompresses a set of files under a run folder on a
+	pool of worker processes. Files the manifest shows were already done
+	are skipped (only the leftover source, if any, is removed). The
+	removed and added lists name the files replaced, for the run folder
+	inventory.
+	"""
+	def __init__( self, run_dir, codec='gzip', level=None, processes=8 ):
+		if codec not in Codecs():
+			raise ValueError( "Compression codec %s is not available." % codec )
+		self.run_dir = run_dir
+		self.codec = codec
+		self.level = level if level is not None else DEFAULT_LEVELS[codec]
+		self.processes = processes
+		self.manifest = Manifest( run_dir )
+		self.removed = []
+		self.added = []
+		self.errors = []
+
+	def Compress( self, files, sizes ):
+		"""Compresses files, whose sizes are given. Returns True if all
+		succeeded."""
+		suffix = SUFFIXES[self.codec]
+		return self.Run( [ ( f, f + suffix ) for f in files ], sizes, self.codec, True )
+
+	def Uncompress( self, files, sizes ):
+		"""Uncompresses files, each with the codec its suffix names.
+		Returns True if all succeeded."""
+		ok = True
+		for codec in SUFFIXES.keys():
+			suffix = SUFFIXES[codec]
+			pairs = [ ( ( f, f[:-len(suffix)] ), size ) for ( f, size ) in zip( files, sizes ) if f.endswith( suffix ) ]
+			if not pairs:
+				continue
+			if codec not in Codecs():
+				self.Log( "PROBLEM! Can't uncompress %d %s files, zstandard isn't installed." % ( len(pairs), suffix ) )
+				self.errors.extend( [ pair[0][0] for pair in pairs ] )
+				ok = False
+				continue
+			if not self.Run( [ p[0] for p in pairs ], [ p[1] for p in pairs ], codec, False ):
+				ok = False
+		return ok
+
+	def Run( self, pairs, sizes, codec, compress ):
+		manifest_codec = codec if compress else 'none'
+		todo = []
+		todo_sizes = []
+		for ( ( src, dest ), size ) in zip( pairs, sizes ):
+			if self.manifest.IsDone( dest, manifest_codec ):
+				# Interrupted between finishing dest and removing src.
+				if os.path.exists( src ):
+					os.unlink( src )
+				self.removed.append( src )
+				continue
+			todo.append( ( src, dest ) )
+			todo_sizes.append( size )
+		skipped = len(pairs) - len(todo)
+		if skipped:
+			self.Log( "Skipping %d files already done according to %s." % ( skipped, self.manifest.filename ) )
+		if not todo:
+			return True
+		jobs = [ ( batch, codec, self.level, compress ) for batch in Batches( todo, todo_sizes ) ]
+		pool = multiprocessing.Pool( min( self.processes, len(jobs) ) )
+		errors = 0
+		try:
+			for results in pool.imap_unordered( ConvertBatch, jobs ):
+				done = []
+				for ( src, dest, size, error ) in results:
+					if error is None:
+						done.append( ( dest, size ) )
+						self.removed.append( src )
+						self.added.append( dest )
+					else:
+						self.Log( "PROBLEM! Can't convert %s: %s" % ( src, error ) )
+						self.errors.append( src )
+						errors += 1
+				self.manifest.Record( done, manifest_codec )
+			pool.close()
+		except:
+			pool.terminate()
+			raise
+		finally:
+			pool.join()
+		self.Log( "%s %d files with %s on %d processes." % ( "Compressed" if compress else "Uncompressed", len(todo) - errors, codec, min( self.processes, len(jobs) ) ) )
+		return errors == 0
@@ -0,0 +1,117 @@
+"""
+concatenate.py - joins the gzipped FASTQ chunks bcl2fastq writes for a
+sample into one file per sample and read, in this process. Each output
+file is copied with large buffered reads and writes, its parts in chunk
+number order, and its MD5 checksum and size are computed during the copy
+so they don't have to be read again.
+"""
+import os
+import re
+import gzip
+import threading
+
+from logger import Logger
+from checksums import StreamingChecksum, AdviseSequential
+
+# Copy buffer size. Large buffers keep the number of system calls down
+# and let hashlib release the GIL while it digests them.
+BUFFER_SIZE = 4 * 1024 * 1024
+
+def ChunkNumber( filename ):
+	"""Returns the chunk number of a bcl2fastq output file name like
+	1001X1_ACGTACGT_L001_R1_003.fastq.gz, or None."""
+	m = re.search( r"_(\d+)\.fastq\.gz$", filename )
+	if m:
+		return int(m.group(1))
+	return None
+
+def FindChunks( dirname, sample, lane, end ):
+	"""
+	Returns the full names of the gzipped FASTQ chunks for a sample,
+	lane and read in a CASAVA 1.8 Sample_ directory, ordered by chunk
+	number rather than by name.
+	"""
+	pattern = re.compile( r"%s_.*_L%03d_R%d_\d+\.fastq\.gz$" % ( re.escape(sample), lane, end ) )
+	names = [ name for name in os.listdir(dirname) if pattern.match(name) ]
+	names.sort( key=ChunkNumber )
+	return [ os.path.join( dirname, name ) for name in names ]
+
+def Concatenate( parts, dest ):
+	"""
+	Copies parts, in the order given, into dest, and writes its .md5
+	file. Returns ( MD5 hex digest, bytes written ). With no parts dest
+	is an empty gzip file. dest only appears under its own name once it
+	is complete.
+	"""
+	checksum = StreamingChecksum()
+	tmpfile = dest + ".partial"
+	if not parts:
+		gzip.open( tmpfile, 'wb' ).close()
+		ifs = open( tmpfile, 'rb' )
+		checksum.Update( ifs.read() )
+		ifs.close()
+	else:
+		ofs = open( tmpfile, 'wb' )
+		try:
+			for part in parts:
+				expected = os.path.getsize( part )
+				copied = 0
+				ifs = open( part, 'rb' )
+				AdviseSequential( ifs )
+				while True:
+					block = ifs.read( BUFFER_SIZE )
+					if not block:
+						break
+					ofs.write( block )
+					checksum.Update( block )
+					copied += len(block)
+				ifs.close()
+				if copied != expected:
+					raise IOError( "Read %d of %d bytes from %s." % ( copied, expected, part ) )
+		finally:
+			ofs.close()
+		if os.path.getsize( tmpfile ) != checksum.nbytes:
+			raise IOError( "Wrote %d bytes to %s, expected %d." % ( os.path.getsize(tmpfile), dest, checksum.nbytes ) )
+	os.rename( tmpfile, dest )
+	return ( checksum.Finish( dest ), checksum.nbytes )
+
+class Concatenator(Logger):
+	"""
+	Runs a batch of concatenations on a few threads. The work is disk
+	bound, so a handful of threads keeps the disks busy; more only add
+	seeks. Results are kept in the results dictionary, indexed by output
+	file name: ( MD5 hex digest, bytes ).
+	"""
+	def __init__( self ):
+		self.jobs = []
+		self.results = {}
+		self.errors = []
+		self.lock = threading.Lock()
+
+	def AddJob( self, parts, dest ):
+		self.jobs.append( ( parts, dest ) )
+
+	def Worker( self ):
+		while True:
+			with self.lock:
+				if not self.jobs:
+					return
+				( parts, dest ) = self.jobs.pop(0)
+			try:
+				result = Concatenate( parts, dest )
+				with self.lock:
+					self.results[dest] = result
+				self.Log( "Wrote %s, %d bytes from %d files." % ( dest, result[1], len(parts) ) )
+			except ( IOError, OSError ), e:
+				self.Log( "PROBLEM! Can't create %s: %s" % ( dest, e ) )
+				with self.lock:
+					self.errors.append( ( dest, str(e) ) )
+
+	def Run( self, numthreads=4 ):
+		"""Runs all the jobs added. Returns True if all succeeded."""
+		threads = [ threading.Thread( target=self.Worker ) for i in range( min( numthreads, len(self.jobs) ) ) ]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		return not self.errors
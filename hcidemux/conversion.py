@@ -0,0 +1,261 @@
+"""
+conversion.py - the programs that convert a run's bcl files into FASTQ
+files. Run.BclConvert picks an engine with GetEngine and calls its Convert
+method, whichever program is installed:
+
+	Casava18Engine     configureBclToFastq.pl and make, CASAVA 1.8, for
+	                   HiSeq v3 flow cells.
+	Bcl2Fastq18Engine  configureBclToFastq.pl and make, bcl2fastq 1.8.4.
+	Bcl2Fastq2Engine   bcl2fastq 2.x, with its thread counts worked out
+	                   from the machine's cores and load. Its output is
+	                   arranged like 1.8's, so the rest of the pipeline
+	                   doesn't need to know which program ran.
+
+params.bcl_conversion_engine chooses between 'bcl2fastq2' (the default)
+and 'bcl2fastq' (1.8.4) for flow cells other than HiSeq v3.
+"""
+import os
+import re
+import subprocess
+import multiprocessing
+
+import pipelineparams as params
+from logger import Logger
+
+# Flow cell version that needs CASAVA.
+CASAVA_FLOWCELL = "HiSeq Flow Cell v3"
+
+def ConversionThreads( cores=None, lanes=1, samples=1 ):
+	"""
+	Returns bcl2fastq2's ( loading, processing, writing ) thread counts.
+	Processing threads get the cores; loading and writing threads,
+	which mostly wait for the disks, a few more. If cores isn't given it's
+	the cores of the machine (or params.bcl_convert_cores) not already
+	busy according to the load average, but at least a quarter of them.
+	Writing threads can't outnumber the samples, and loading threads
+	are only useful up to one per lane.
+	"""
+	if cores is None:
+		total = getattr(params,'bcl_convert_cores',None) or multiprocessing.cpu_count()
+		try:
+			load = int( os.getloadavg()[0] )
+		except OSError:
+			load = 0
+		cores = max( total - load, total // 4, 1 )
+	loading = max( 1, min( 4, cores // 4, lanes ) )
+	writing = max( 1, min( 4, cores // 4, samples ) )
+	return ( loading, cores, writing )
+
+def ReadSampleSheet( sample_sheet ):
+	"""Returns the rows of a bcl2fastq 1.8 sample sheet (FCID,Lane,
+	SampleID,...) as lists of fields, without the header."""
+	rows = []
+	ifs = open( sample_sheet )
+	for rec in ifs:
+		f = rec.strip().split(',')
+		if f[0] == 'FCID' or len(f) < 10:
+			continue
+		rows.append( f )
+	ifs.close()
+	return rows
+
+def CountIemSamples( sample_sheet ):
+	"""Returns the number of [Data] rows of an Illumina Experiment
+	Manager style sample sheet, at least 1."""
+	count = 0
+	in_data = False
+	header = False
+	ifs = open( sample_sheet )
+	for rec in ifs:
+		line = rec.strip()
+		if line.startswith('['):
+			in_data = line.startswith('[Data]')
+			header = in_data
+		elif in_data and line.strip(','):
+			if header:
+				header = False
+			else:
+				count += 1
+	ifs.close()
+	return max( count, 1 )
+
+class Engine(Logger):
+	"""
+	A bcl conversion program, converting bcl files for a run. Each
+	engine defines
+
+		Convert( sample_sheet, output_dir, use_bases_mask=None,
+		         mismatches=1, jobs=None, lanes=None )
+
+	which converts the lanes of sample_sheet into FASTQ files in
+	output_dir, laid out as bcl2fastq 1.8 does. use_bases_mask and
+	mismatches are passed to the program; jobs is the number of cores to
+	use (None for the engine's choice) and lanes, if not None, restricts
+	conversion to those lanes. It returns True on success.
+	"""
+	name = None
+
+	def __init__( self, run ):
+		self.run = run
+
+	def RunProgram( self, args, cwd, log_dir, log_name ):
+		"""Runs a program with its output going to log_name.out and
+		.err in log_dir. Returns its exit status."""
+		child_stdout=open(os.path.join(log_dir,log_name+".out"),'w')
+		child_stderr=open(os.path.join(log_dir,log_name+".err"),'w')
+		try:
+			p = subprocess.Popen(args=args,cwd=cwd,stdout=child_stdout,stderr=child_stderr)
+			return p.wait()
+		finally:
+			child_stdout.close()
+			child_stderr.close()
+
+class Bcl2Fastq18Engine(Engine):
+	"""bcl2fastq 1.8.4: configureBclToFastq.pl writes a Makefile, then
+	make -j jobs (default 8) converts."""
+	name = 'bcl2fastq'
+
+	def ProgramDir( self ):
+		return params.bcl2fastq_dir
+
+	def ExtraArgs( self ):
+		return [ "--ignore-missing-bcl", "--ignore-missing-stats", "--no-eamss" ]
+
+	def UncompressBcls( self, sample_sheet, use_bases_mask ):
+		"""bcl2fastq 1.8.4 reads .bcl.gz files itself, so only zstd
+		files are uncompressed unless params.bcl2fastq_reads_gzipped_bcls
+		is False."""
+		return self.run.UncompressBcls( sample_sheet, use_bases_mask, getattr(params,'bcl2fastq_reads_gzipped_bcls',True) )
+
+	def Convert( self, sample_sheet, output_dir, use_bases_mask=None, mismatches=1, jobs=None, lanes=None ):
+		self.Log(["Running configureBclToFastq on run", self.run.id])
+		child_args=[os.path.join(self.ProgramDir(),"configureBclToFastq.pl"),
+			"--input-dir",os.path.join(self.run.dirname,"Data","Intensities","BaseCalls"),
+			"--positions-format",".clocs",
+			"--sample-sheet",sample_sheet,
+			"--output-dir",output_dir,
+			"--mismatches",`mismatches`,
+		] + self.ExtraArgs()
+		if use_bases_mask:
+			child_args.append( "--use-bases-mask" )
+			child_args.append( use_bases_mask )
+		if lanes is not None:
+			child_args.append( "--tiles" )
+			child_args.append( self.run.TilesOption(lanes) )
+		self.run.Log(child_args)
+		if not self.UncompressBcls( sample_sheet, use_bases_mask ):
+			return False
+		log_name = os.path.splitext( self.run.ConvertLogName(output_dir,"out") )[0]
+		retval = self.RunProgram( child_args, self.run.dirname, self.run.dirname, log_name )
+		# If configure successful...
+		if retval == 0:
+			# Run make in the Unaligned directory.
+			self.Log(["Running make (to convert bcl files) on run",self.run.id])
+			retval = self.RunProgram( ["/usr/bin/make","-j",`jobs or 8`], output_dir, output_dir, "make" )
+		return retval == 0
+
+class Casava18Engine(Bcl2Fastq18Engine):
+	"""CASAVA 1.8, for HiSeq v3 flow cells. It has no
+	--ignore-missing-bcl and doesn't read .bcl.gz files, so every bcl
+	file of the run, in every lane and cycle, is uncompressed."""
+	name = 'casava'
+
+	def ProgramDir( self ):
+		return params.casava_dir
+
+	def ExtraArgs( self ):
+		return []
+
+	def UncompressBcls( self, sample_sheet, use_bases_mask ):
+		return self.run.UncompressBcls( sample_sheet, all_files=True )
+
+class Bcl2Fastq2Engine(Engine):
+	"""
+	bcl2fastq 2.x. The 1.8 sample sheet is rewritten in 2.x's format,
+	with Sample_Project Project_<request> and Sample_ID Sample_<sample>,
+	so the FASTQ files land in Project_<request>/Sample_<sample> as with
+	1.8. The undetermined reads are linked into
+	Undetermined_indices/Sample_lane<lane> for the QC report. bcl2fastq2
+	reads .bcl.gz files itself, so only zstd bcl files are uncompressed.
+	"""
+	name = 'bcl2fastq2'
+
+	def WriteSampleSheet( self, sample_sheet ):
+		"""Writes sample_sheet in bcl2fastq2's format next to it.
+		Returns the new file's name and the rows."""
+		rows = ReadSampleSheet( sample_sheet )
+		fname = re.sub( r"\.csv$", "_bcl2fastq2.csv", sample_sheet )
+		ofs = open( fname, 'w' )
+		ofs.write( "[Header]\nIEMFileVersion,4\n\n[Data]\n" )
+		ofs.write( "Lane,Sample_ID,Sample_Name,index,index2,Sample_Project,Description\n" )
+		for f in rows:
+			indexes = ( f[4].split('-') + [ '' ] )[:2]
+			ofs.write( ','.join( [ f[1], "Sample_"+f[2], f[2], indexes[0], indexes[1], "Project_"+f[9], f[5] ] ) + "\n" )
+		ofs.close()
+		return ( fname, rows )
+
+	def LinkUndetermined( self, output_dir ):
+		"""Links Undetermined_S0_L00<lane>_R1_*.fastq.gz into
+		Undetermined_indices/Sample_lane<lane>, named as 1.8 names them."""
+		for name in os.listdir( output_dir ):
+			m = re.match( r"Undetermined_S0_L(\d+)_R1_(\d+)\.fastq\.gz$", name )
+			if not m:
+				continue
+			lane = int(m.group(1))
+			dest_dir = os.path.join( output_dir, "Undetermined_indices", "Sample_lane%d" % lane )
+			if not os.path.exists( dest_dir ):
+				os.makedirs( dest_dir )
+			dest = os.path.join( dest_dir, "lane%d_Undetermined_L%03d_R1_%s.fastq.gz" % ( lane, lane, m.group(2) ) )
+			if os.path.exists( dest ):
+				os.unlink( dest )
+			os.link( os.path.join( output_dir, name ), dest )
+
+	def Convert( self, sample_sheet, output_dir, use_bases_mask=None, mismatches=1, jobs=None, lanes=None ):
+		( sheet2, rows ) = self.WriteSampleSheet( sample_sheet )
+		( loading, processing, writing ) = ConversionThreads( jobs,
+			lanes=len(set([ f[1] for f in rows ])) or 1, samples=len(rows) or 1 )
+		self.Log(["Running bcl2fastq2 on run", self.run.id, "with", loading, "loading,", processing, "processing and", writing, "writing threads"])
+		if not os.path.exists( output_dir ):
+			os.makedirs( output_dir )
+		child_args=[os.path.join(params.bcl2fastq2_dir,"bcl2fastq"),
+			"--runfolder-dir",self.run.dirname,
+			"--output-dir",output_dir,
+			"--sample-sheet",sheet2,
+			"--barcode-mismatches",`mismatches`,
+			"--ignore-missing-bcls",
+			"--ignore-missing-filter",
+			"--ignore-missing-positions",
+			"--ignore-missing-controls",
+			"--minimum-trimmed-read-length","0",
+			"--mask-short-adapter-reads","0",
+			"-r",`loading`,
+			"-p",`processing`,
+			"-w",`writing`,
+		]
+		if use_bases_mask:
+			child_args.append( "--use-bases-mask" )
+			child_args.append( use_bases_mask )
+		if lanes is not None:
+			child_args.append( "--tiles" )
+			child_args.append( self.run.TilesOption(lanes) )
+		self.run.Log(child_args)
+		if not self.run.UncompressBcls( sample_sheet, use_bases_mask, keep_gzipped=True ):
+			return False
+		log_name = os.path.splitext( self.run.ConvertLogName(output_dir,"out") )[0]
+		if self.RunProgram( child_args, self.run.dirname, self.run.dirname, log_name ) != 0:
+			return False
+		self.LinkUndetermined( output_dir )
+		return True
+
+# Engines indexed by params.bcl_conversion_engine value.
+ENGINES = { 'bcl2fastq': Bcl2Fastq18Engine, 'bcl2fastq2': Bcl2Fastq2Engine }
+
+def GetEngine( run ):
+	"""Returns the engine converting run's bcl files."""
+	if run.FlowCellVersion() == CASAVA_FLOWCELL:
+		return Casava18Engine( run )
+	name = getattr(params,'bcl_conversion_engine','bcl2fastq2')
+	try:
+		return ENGINES[name]( run )
+	except KeyError:
+		raise ValueError( "Unknown bcl conversion engine %s." % name )
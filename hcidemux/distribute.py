@@ -0,0 +1,203 @@
+"""
+distribute.py - puts data files into the GNomEx repository without
+copying them when the repository and the run folder are on the same file
+system: a hard link if possible, otherwise a reflink (FICLONE, on file
+systems like XFS and btrfs that share blocks between files). Files on
+another device are copied in one pass on several threads, each copy
+verified by size and against the checksum made when the file was
+written, instead of decompressing the copy to check it.
+"""
+import os
+import errno
+import fcntl
+import shutil
+import threading
+
+from logger import Logger
+from checksums import StreamingChecksum, AdviseSequential, HashFile
+
+# ioctl request number of FICLONE, from linux/fs.h.
+FICLONE = 0x40049409
+
+def SameDevice( path1, path2 ):
+	"""True if the two paths are on the same file system."""
+	return os.stat(path1).st_dev == os.stat(path2).st_dev
+
+def Reflink( src, dest ):
+	"""Makes dest a copy-on-write clone of src. Raises IOError if the
+	file system can't do it."""
+	ifs = open( src, 'rb' )
+	try:
+		ofs = open( dest, 'wb' )
+		try:
+			fcntl.ioctl( ofs.fileno(), FICLONE, ifs.fileno() )
+		finally:
+			ofs.close()
+	except:
+		if os.path.exists(dest):
+			os.unlink(dest)
+		raise
+	finally:
+		ifs.close()
+
+def LinkInto( src, destdir ):
+	"""
+	Places src in destdir under the same name by hard link or reflink,
+	replacing any file already there. Returns 'hardlink' or 'reflink',
+	or None if neither is possible and the file must be copied.
+	"""
+	if not SameDevice( src, destdir ):
+		return None
+	dest = os.path.join( destdir, os.path.basename(src) )
+	if os.path.exists(dest) and os.path.samefile( src, dest ):
+		return 'hardlink'
+	# Build under a temporary name and rename, so a file already in
+	# the repository is replaced in one step.
+	tmpfile = "%s.link%d" % ( dest, os.getpid() )
+	if os.path.exists(tmpfile):
+		os.unlink(tmpfile)
+	try:
+		os.link( src, tmpfile )
+		how = 'hardlink'
+	except OSError, e:
+		if e.errno not in [ errno.EPERM, errno.EMLINK, errno.EXDEV, errno.EACCES ]:
+			raise
+		try:
+			Reflink( src, tmpfile )
+			how = 'reflink'
+		except IOError:
+			return None
+	os.rename( tmpfile, dest )
+	return how
+
+def LinkTree( src, dest ):
+	"""Recreates directory src as dest, with its files hard linked or
+	reflinked where possible and copied otherwise."""
+	os.makedirs( dest )
+	for name in os.listdir( src ):
+		path = os.path.join( src, name )
+		if os.path.isdir( path ):
+			LinkTree( path, os.path.join( dest, name ) )
+		elif not LinkInto( path, dest ):
+			shutil.copy2( path, os.path.join( dest, name ) )
+
+# Copy buffer size.
+BUFFER_SIZE = 4 * 1024 * 1024
+
+def CopyVerified( src, dest, known_md5=None, reread=False ):
+	"""
+	Copies src to dest in one pass, hashing the data as it goes, and
+	renames it into place once verified: the size written must match
+	the source, and the hash must match known_md5 (the checksum made
+	when the file was created) if given. With reread the destination
+	is read back and hashed too. Returns the MD5 hex digest. Raises
+	IOError if verification fails.
+	"""
+	tmpfile = "%s.copy%d" % ( dest, os.getpid() )
+	checksum = StreamingChecksum()
+	ifs = open( src, 'rb' )
+	AdviseSequential( ifs )
+	try:
+		ofs = open( tmpfile, 'wb' )
+		try:
+			while True:
+				block = ifs.read( BUFFER_SIZE )
+				if not block:
+					break
+				ofs.write( block )
+				checksum.Update( block )
+			ofs.flush()
+			os.fsync( ofs.fileno() )
+		finally:
+			ofs.close()
+	finally:
+		ifs.close()
+	try:
+		digest = checksum.HexDigest()
+		nbytes = checksum.nbytes
+		if nbytes != os.path.getsize(src) or os.path.getsize(tmpfile) != nbytes:
+			raise IOError( "Size mismatch copying %s to %s." % ( src, dest ) )
+		if known_md5 and digest != known_md5:
+			raise IOError( "Checksum of %s is %s, expected %s." % ( src, digest, known_md5 ) )
+		if reread and HashFile( tmpfile ) != digest:
+			raise IOError( "Checksum of copy %s doesn't match %s." % ( dest, src ) )
+	except:
+		os.unlink( tmpfile )
+		raise
+	shutil.copymode( src, tmpfile )
+	os.rename( tmpfile, dest )
+	return digest
+
+class ByteBudget:
+	"""
+	Limits the number of bytes being copied at once. A file larger than
+	the whole budget is let through when nothing else is in flight.
+	"""
+	def __init__( self, limit ):
+		self.limit = limit
+		self.inflight = 0
+		self.condition = threading.Condition()
+
+	def Acquire( self, n ):
+		with self.condition:
+			while self.inflight and self.inflight + n > self.limit:
+				self.condition.wait()
+			self.inflight += n
+
+	def Release( self, n ):
+		with self.condition:
+			self.inflight -= n
+			self.condition.notify_all()
+
+class Copier(Logger):
+	"""
+	Copies a batch of files into the repository on several threads,
+	with CopyVerified. Failed copies are retried. Checksums of the
+	copies are kept in the results dictionary, indexed by destination.
+	"""
+	def __init__( self, max_inflight_bytes=8*1024**3, retries=3, reread=False ):
+		self.jobs = []
+		self.results = {}
+		self.errors = []
+		self.retries = retries
+		self.reread = reread
+		self.budget = ByteBudget( max_inflight_bytes )
+		self.lock = threading.Lock()
+
+	def AddJob( self, src, dest, known_md5=None ):
+		self.jobs.append( ( src, dest, known_md5 ) )
+
+	def Copy( self, src, dest, known_md5 ):
+		size = os.path.getsize( src )
+		self.budget.Acquire( size )
+		try:
+			for attempt in range( 1, self.retries+1 ):
+				try:
+					digest = CopyVerified( src, dest, known_md5, self.reread )
+					with self.lock:
+						self.results[dest] = digest
+					self.Log( "Copied %s to %s." % ( src, dest ) )
+					return
+				except ( IOError, OSError ), e:
+					self.Log( "PROBLEM! Copy %d of %s to %s failed: %s" % ( attempt, src, dest, e ) )
+			with self.lock:
+				self.errors.append( ( src, dest ) )
+		finally:
+			self.budget.Release( size )
+
+	def Worker( self ):
+		while True:
+			with self.lock:
+				if not self.jobs:
+					return
+				( src, dest, known_md5 ) = self.jobs.pop(0)
+			self.Copy( src, dest, known_md5 )
+
+	def Run( self, numthreads=6 ):
+		"""Copies all the files added. Returns True if all succeeded."""
+		threads = [ threading.Thread( target=self.Worker ) for i in range( min( numthreads, len(self.jobs) ) ) ]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		return not self.errors
@@ -2,6 +2,7 @@ import os
 import sys
 import smtplib
 import string
+import tempfile
 from email.MIMEMultipart import MIMEMultipart
 from email.MIMEText import MIMEText
 from email.MIMEImage import MIMEImage
@@ -26,6 +27,15 @@ class Emailer:
 				Content_Disposition='attachment; filename="%s"' % os.path.basename(f),
 				Name=os.path.basename(f)))
 
+		# If PIPELINE_MAIL_DIR is set, save the message there
+		# instead of sending it. Used for testing and benchmarking.
+		mail_dir = os.environ.get('PIPELINE_MAIL_DIR')
+		if mail_dir:
+			fd, fname = tempfile.mkstemp( suffix='.eml', dir=mail_dir )
+			os.write( fd, msg.as_string() )
+			os.close( fd )
+			return {}
+
 		s = smtplib.SMTP('hci-mail.hci.utah.edu')
 
 		# Send the message.
@@ -12,22 +12,11 @@ import sys
 import os
 import re
 import threading
-import xml.sax.xmlreader
-import xml.sax.handler
 from logger import Logger
+import runinfo
 
 TAB = '\t'
 
-class RunInfoHandler( xml.sax.handler.ContentHandler ):
-	'''XML parser event handler to count number of bases sequenced
-	in this run.'''
-	def __init__( self ):
-		self.numbases = 0
-
-	def startElement(self,name,attrs):
-		if name == 'Read' and attrs.getValue('IsIndexedRead') == 'N':
-			self.numbases += int(attrs.getValue('NumCycles'))
-
 class ReadCounter(threading.Thread,Logger):
 	def __init__( self, command, semaphore, sample, lane, barcode, parent ):
 		threading.Thread.__init__(self)
@@ -106,9 +95,7 @@ class IndexingEvaluator(Logger):
 	def CountBases( self ):
 		'''Parses the RunInfo.xml file in the run directory to
 		determine how many bases of sequence data produced per read.'''
-		handler=RunInfoHandler()
-		xml.sax.parse(os.path.join(self.run_folder_name,"RunInfo.xml"),handler)
-		self.numbases = handler.numbases
+		self.numbases = runinfo.GetRunInfo(self.run_folder_name).DataCycles()
 
 	def StoreReadCount( self, numreads, barcode, lane ):
 		'''Stores result of counting reads on a sample's file.'''
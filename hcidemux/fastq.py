@@ -75,6 +75,12 @@ class Writer:
 		self.ofs.write(sequence_object.spacer + "\n")
 		self.ofs.write(sequence_object.quality + "\n")
 	
+	def write_text(self,text):
+		"""
+		write_text writes reads already formatted as Fastq records.
+		"""
+		self.ofs.write(text)
+
 	def close(self):
 		"""
 		close closes the Fastq file.
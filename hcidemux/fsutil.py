@@ -0,0 +1,49 @@
+"""
+fsutil.py - file system helpers shared by the pipeline classes.
+"""
+import os
+
+# os.scandir is new in python 3.5. On python 2.7 use the scandir module
+# from PyPI if it's installed, and plain os.listdir otherwise.
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+class ListdirEntry(object):
+	"""Stand-in for os.DirEntry when no scandir implementation is
+	available. Every type check costs a stat() call."""
+	def __init__( self, dirname, name ):
+		self.name = name
+		self.path = os.path.join( dirname, name )
+
+	def is_dir( self, follow_symlinks=True ):
+		if not follow_symlinks and os.path.islink(self.path):
+			return False
+		return os.path.isdir( self.path )
+
+	def is_file( self, follow_symlinks=True ):
+		if not follow_symlinks and os.path.islink(self.path):
+			return False
+		return os.path.isfile( self.path )
+
+	def is_symlink( self ):
+		return os.path.islink( self.path )
+
+	def stat( self, follow_symlinks=True ):
+		if follow_symlinks:
+			return os.stat( self.path )
+		return os.lstat( self.path )
+
+def ScanDir( dirname ):
+	"""
+	Returns an iterable of os.DirEntry-like objects for the entries
+	of dirname. With a real scandir the entry types come from the
+	directory listing itself, so no per-entry stat() is needed.
+	"""
+	if scandir is not None:
+		return scandir( dirname )
+	return [ ListdirEntry( dirname, name ) for name in os.listdir( dirname ) ]
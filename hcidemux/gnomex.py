@@ -1,8 +1,69 @@
 #!/usr/bin/env python
 
-import pymssql
 import re
 import os
+import atexit
+import contextlib
+import sqlite3
+
+try:
+	import pymssql
+except ImportError:
+	# Only needed for the real GNomEx server.
+	pymssql = None
+
+class SqliteCursor:
+	"""
+	Cursor for a local sqlite GNomEx stand-in that accepts the pymssql
+	parameter style (%s placeholders, a single value or a tuple of
+	values), so pipeline queries run unchanged against it.
+	"""
+	def __init__( self, cursor, asdict ):
+		self.cursor = cursor
+		self.asdict = asdict
+
+	def execute( self, query, args=None ):
+		query = query.replace('%s','?').replace('%%','%')
+		if args is None:
+			args = ()
+		elif not isinstance(args,(tuple,list)):
+			args = (args,)
+		self.cursor.execute( query, args )
+
+	def MakeRow( self, rec ):
+		if not self.asdict:
+			return rec
+		return dict( zip( [ d[0] for d in self.cursor.description ], rec ) )
+
+	def fetchall( self ):
+		return [ self.MakeRow(rec) for rec in self.cursor.fetchall() ]
+
+	def fetchone( self ):
+		rec = self.cursor.fetchone()
+		if rec is None:
+			return None
+		return self.MakeRow(rec)
+
+	@property
+	def rowcount( self ):
+		return self.cursor.rowcount
+
+class SqliteConnection:
+	"""Connection to a sqlite file holding a subset of the GNomEx
+	tables, such as one made by gnomexfixture.py."""
+	def __init__( self, filename, asdict=False ):
+		self.connection = sqlite3.connect( filename, detect_types=sqlite3.PARSE_DECLTYPES )
+		self.connection.text_factory = str
+		self.asdict = asdict
+
+	def cursor( self ):
+		return SqliteCursor( self.connection.cursor(), self.asdict )
+
+	def commit( self ):
+		self.connection.commit()
+
+	def close( self ):
+		self.connection.close()
 
 class GNomExConnection:
 
@@ -15,8 +76,18 @@ class GNomExConnection:
 		Returns a database connection. Next step is to call its 
 		cursor() method, then cursor.execute(query) and cursor.fetchall()
 		for example.
+
+		If the GNOMEX_SQLITE environment variable names a sqlite
+		file, that file is used instead of the GNomEx server. This
+		allows the pipeline to run off the production network.
 		'''
-		
+		fixture = os.environ.get('GNOMEX_SQLITE')
+		if fixture:
+			if not os.path.exists(fixture):
+				raise IOError("GNomEx sqlite fixture %s not found." % fixture)
+			return SqliteConnection(fixture,asdict)
+		if pymssql is None:
+			raise ImportError("pymssql is required to connect to GNomEx. Set GNOMEX_SQLITE to use a local fixture instead.")
 		try:
 			host=os.environ['DBHOST']
 		except KeyError:
@@ -24,6 +95,122 @@ class GNomExConnection:
 		database='GNomEx'
 		return pymssql.connect(host=host,user=db_user,password=db_password,database=database,as_dict=asdict)
 	
+class GNomExPool:
+	"""
+	Keeps a few open GNomEx connections for reuse, so a pipeline cycle
+	over many runs doesn't log in to the database server once per query.
+	Connections are opened only when first needed, checked with a
+	trivial query before being handed out again, and closed by
+	CloseAll. A pool is tied to the process that created it: after a
+	fork the child quietly forgets its parent's connections instead of
+	using them.
+	"""
+	# Number of idle connections kept open per pool.
+	max_idle = 2
+
+	def __init__( self, db_user, db_password ):
+		self.db_user = db_user
+		self.db_password = db_password
+		self.pid = os.getpid()
+		# Idle connections, as ( asdict, connection ) tuples.
+		self.idle = []
+		# Connections inherited from a parent process, never used.
+		self.inherited = []
+		# Number of connections opened over the life of the pool.
+		self.opened = 0
+
+	def CheckFork( self ):
+		if self.pid != os.getpid():
+			# These belong to the parent process. Keep references so
+			# they aren't closed (logging the parent out) when
+			# garbage collected here.
+			self.inherited = self.idle
+			self.idle = []
+			self.pid = os.getpid()
+
+	def Healthy( self, connection ):
+		"""Returns True if connection still answers queries."""
+		try:
+			c = connection.cursor()
+			c.execute("select 1")
+			c.fetchall()
+			return True
+		except Exception:
+			return False
+
+	def Acquire( self, asdict=False ):
+		"""Returns an open connection, reusing an idle one if possible."""
+		self.CheckFork()
+		while True:
+			match = [ i for i in range(len(self.idle)) if self.idle[i][0] == asdict ]
+			if not match:
+				break
+			(asdict,connection) = self.idle.pop(match[-1])
+			if self.Healthy(connection):
+				return connection
+			self.Discard(connection)
+		self.opened += 1
+		return GNomExConnection().GnConnect(self.db_user,self.db_password,asdict=asdict)
+
+	def Release( self, connection, asdict=False ):
+		"""Returns a connection obtained from Acquire to the pool."""
+		self.CheckFork()
+		if len(self.idle) < self.max_idle:
+			self.idle.append( ( asdict, connection ) )
+		else:
+			self.Discard(connection)
+
+	def Discard( self, connection ):
+		try:
+			connection.close()
+		except Exception:
+			pass
+
+	@contextlib.contextmanager
+	def Connection( self, asdict=False ):
+		"""
+		Context manager handing out a pooled connection:
+
+			with pool.Connection() as connection:
+				c = connection.cursor()
+				...
+
+		The connection goes back to the pool at the end of the block,
+		or is closed if the block raised an exception.
+		"""
+		connection = self.Acquire(asdict)
+		try:
+			yield connection
+		except:
+			self.Discard(connection)
+			raise
+		self.Release(connection,asdict)
+
+	def CloseAll( self ):
+		"""Closes all idle connections."""
+		self.CheckFork()
+		for (asdict,connection) in self.idle:
+			self.Discard(connection)
+		self.idle = []
+
+# Pools shared within this process, indexed by ( user, password ).
+pools = {}
+
+def GetPool( db_user, db_password ):
+	"""Returns the shared GNomExPool for the given credentials."""
+	key = ( db_user, db_password )
+	if key not in pools:
+		pools[key] = GNomExPool(db_user,db_password)
+	return pools[key]
+
+def CloseAll():
+	"""Closes the idle connections of all shared pools. Called at exit,
+	and by the pipeline before forking worker processes."""
+	for pool in pools.values():
+		pool.CloseAll()
+
+atexit.register(CloseAll)
+
 def test():
 	g = GNomExConnection()
 	connection = g.GnConnect(db_user="bmilash",db_password="123zxc",asdict=False)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""
+gnomexfixture.py - builds a sqlite file holding the subset of the GNomEx
+schema the pipeline queries (flow cells, channels, sequence lanes, samples,
+requests, users, labs, genome builds, applications, core facilities), filled
+with made-up runs. Point the GNOMEX_SQLITE environment variable at the file
+and the pipeline runs without the GNomEx server, for example to benchmark
+whole pipeline cycles on a laptop.
+"""
+import os
+import sys
+import random
+import sqlite3
+import datetime
+
+schema = [
+	"create table corefacility (idcorefacility integer primary key, facilityname)",
+	"create table flowcell (idflowcell integer primary key, barcode, number, createdate timestamp, idcorefacility)",
+	"create table flowcellchannel (idflowcellchannel integer primary key, idflowcell, number, filename)",
+	"create table lab (idlab integer primary key, firstname, lastname)",
+	"create table appuser (idappuser integer primary key, firstname, lastname)",
+	"create table project (idproject integer primary key, name)",
+	"create table request (idrequest integer primary key, number, idappuser, idlab, idproject, createdate timestamp)",
+	"create table organism (idorganism integer primary key, organism)",
+	"create table genomebuild (idgenomebuild integer primary key, genomebuildname)",
+	"create table application (codeapplication primary key, application)",
+	"create table seqlibprotocol (idseqlibprotocol integer primary key, seqlibprotocol)",
+	"create table seqlibprotocolapplication (idseqlibprotocol, codeapplication)",
+	"create table seqruntype (idseqruntype integer primary key, seqruntype)",
+	"create table numbersequencingcycles (idnumbersequencingcycles integer primary key, numbersequencingcycles)",
+	"create table sample (idsample integer primary key, number, name, barcodesequence, barcodesequenceb, idrequest, idseqlibprotocol, idorganism)",
+	"create table sequencelane (idsequencelane integer primary key, idflowcellchannel, idsample, idgenomebuildalignto, idrequest, idseqruntype, idnumbersequencingcycles)",
+	"create index flowcellchannel_filename on flowcellchannel (filename)",
+	"create index flowcell_barcode on flowcell (barcode)",
+	"create index sequencelane_channel on sequencelane (idflowcellchannel)",
+]
+
+# Sequencing applications offered by the fixture, by code. The pipeline
+# recognizes the Patch PCR and Kappa PCR ones by name.
+applications = [
+	( 'TRUSEQ', 'Illumina TruSeq DNA' ),
+	( 'RNASEQ', 'Illumina TruSeq Stranded mRNA' ),
+	( 'PATCH', 'Patch PCR' ),
+	( 'KAPPA', 'Kappa PCR' ),
+]
+
+class FixtureBuilder:
+	"""
+	Writes made-up GNomEx records to a sqlite file. The records for a
+	run are generated from a seeded random number generator, so the
+	same arguments always produce the same fixture.
+	"""
+	def __init__( self, filename, seed=1 ):
+		exists = os.path.exists(filename)
+		self.connection = sqlite3.connect( filename, detect_types=sqlite3.PARSE_DECLTYPES )
+		self.connection.text_factory = str
+		self.random = random.Random(seed)
+		if not exists:
+			self.CreateSchema()
+
+	def CreateSchema( self ):
+		c = self.connection.cursor()
+		for statement in schema:
+			c.execute(statement)
+		c.execute("insert into corefacility values (1,'High Throughput Genomics')")
+		c.execute("insert into lab values (1,'Ada','Lovelace')")
+		c.execute("insert into appuser values (1,'Charles','Babbage')")
+		c.execute("insert into project values (1,'Benchmark')")
+		c.execute("insert into organism values (1,'Human')")
+		c.execute("insert into genomebuild values (1,'hg38')")
+		c.execute("insert into seqruntype values (1,'Paired-end reads')")
+		c.execute("insert into numbersequencingcycles values (1,125)")
+		for i in range(len(applications)):
+			c.execute("insert into application values (?,?)",applications[i])
+			c.execute("insert into seqlibprotocol values (?,?)",(i+1,applications[i][1]))
+			c.execute("insert into seqlibprotocolapplication values (?,?)",(i+1,applications[i][0]))
+		self.connection.commit()
+
+	def NextId( self, table, column ):
+		c = self.connection.cursor()
+		c.execute("select coalesce(max(%s),0)+1 from %s" % ( column, table ))
+		return c.fetchone()[0]
+
+	def Barcode( self, length ):
+		return ''.join([ self.random.choice('ACGT') for i in range(length) ])
+
+	def AddRun( self, run_id, lanes=None, samples_per_lane=4, application='Illumina TruSeq DNA', dual_index=False ):
+		"""
+		Registers a run folder: a flow cell with the given number of
+		lanes (8 for HiSeq, 1 for MiSeq run ids by default), each with
+		samples_per_lane samples of one new request. samples_per_lane
+		may also be a list with the number of samples for each lane.
+		Returns the list of sample numbers.
+		"""
+		instrument = run_id.split('_')[1]
+		if lanes is None and isinstance(samples_per_lane,(list,tuple)):
+			lanes = len(samples_per_lane)
+		elif lanes is None:
+			if instrument.startswith('M'):
+				lanes = 1
+			else:
+				lanes = 8
+		# Flow cell barcode as the pipeline derives it from the run id.
+		barcode = run_id.split('_')[-1]
+		if barcode[0] in ['A','B']:
+			barcode = barcode[1:]
+		codes = [ code for ( code, name ) in applications if name == application ]
+		if not codes:
+			raise ValueError("Unknown application %s." % application)
+		idseqlibprotocol = [ a[0] for a in applications ].index(codes[0]) + 1
+
+		c = self.connection.cursor()
+		now = datetime.datetime.now()
+		idflowcell = self.NextId('flowcell','idflowcell')
+		c.execute("insert into flowcell values (?,?,?,?,1)",
+			(idflowcell,barcode,'%dF' % idflowcell,now))
+		idrequest = self.NextId('request','idrequest')
+		c.execute("insert into request values (?,?,1,1,1,?)",
+			(idrequest,'%dR' % (idrequest + 1000),now))
+		idsample = self.NextId('sample','idsample')
+		samples = []
+		if isinstance(samples_per_lane,(list,tuple)):
+			lane_samples = list(samples_per_lane)
+			lanes = len(lane_samples)
+		else:
+			lane_samples = [ samples_per_lane ] * lanes
+		for lane in range(1,lanes+1):
+			idflowcellchannel = self.NextId('flowcellchannel','idflowcellchannel')
+			c.execute("insert into flowcellchannel values (?,?,?,?)",
+				(idflowcellchannel,idflowcell,lane,run_id))
+			for i in range(lane_samples[lane-1]):
+				number = '%dX%d' % ( idrequest + 1000, idsample )
+				if lane_samples[lane-1] > 1:
+					barcode_a = self.Barcode(8)
+				else:
+					barcode_a = None
+				if dual_index and lane_samples[lane-1] > 1:
+					barcode_b = self.Barcode(8)
+				else:
+					barcode_b = None
+				c.execute("insert into sample values (?,?,?,?,?,?,?,1)",
+					(idsample,number,'Sample %d' % idsample,barcode_a,barcode_b,idrequest,idseqlibprotocol))
+				c.execute("insert into sequencelane values (null,?,?,1,?,1,1)",
+					(idflowcellchannel,idsample,idrequest))
+				samples.append(number)
+				idsample += 1
+		self.connection.commit()
+		return samples
+
+	def Close( self ):
+		self.connection.close()
+
+def Usage():
+	sys.stderr.write("Use: %s [--dual-index] fixture.db run_id[:lanes[:samples_per_lane[:application]]] ...\n" % sys.argv[0])
+	sys.stderr.write("Applications: %s\n" % ', '.join([ name for ( code, name ) in applications ]))
+
+def main():
+	args = sys.argv[1:]
+	dual_index = '--dual-index' in args
+	if dual_index:
+		args.remove('--dual-index')
+	if len(args) < 2 or '--help' in args:
+		Usage()
+		sys.exit(1)
+	builder = FixtureBuilder(args[0])
+	for spec in args[1:]:
+		f = spec.split(':')
+		lanes = None
+		samples_per_lane = 4
+		application = 'Illumina TruSeq DNA'
+		if len(f) > 1 and f[1]:
+			lanes = int(f[1])
+		if len(f) > 2 and f[2]:
+			samples_per_lane = int(f[2])
+		if len(f) > 3:
+			application = f[3]
+		samples = builder.AddRun( f[0], lanes, samples_per_lane, application, dual_index )
+		print "%s: %d samples" % ( f[0], len(samples) )
+	builder.Close()
+
+if __name__ == "__main__":
+	main()
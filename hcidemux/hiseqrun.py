@@ -1,13 +1,12 @@
 import os
-import xml.dom.minidom
 import pipelineparams as params
 
 from run import Run
 
 class HiSeqRun(Run):
 	
-	def __init__( self, id, full_path_of_run_dir, state=None ):
-		Run.__init__(self,id, full_path_of_run_dir, state)
+	def __init__( self, id, full_path_of_run_dir, state=None, metadata=None ):
+		Run.__init__(self,id, full_path_of_run_dir, state, metadata)
 		self.DetermineRunType()
 	
 	def DetermineRunType(self):
@@ -25,21 +24,10 @@ class HiSeqRun(Run):
 		index reads in member variables num_data_reads and
 		num_index_reads. Brett Milash.
 		"""
-		# Parse the RunInfo.xml file.
-		configfile = os.path.join(self.dirname, "RunInfo.xml")
-		doc = xml.dom.minidom.parse(configfile)
-
-		# Get the Read elements from the document.
-		reads=doc.getElementsByTagName("Read")
-
 		# Count the reads that are at least 25 bp long.
-		self.num_data_reads = 0
-		self.num_index_reads = 0
-		for read in reads:
-			if int(read.getAttribute('NumCycles')) >= 25:
-				self.num_data_reads += 1
-			else:
-				self.num_index_reads += 1
+		info = self.RunInfo()
+		self.num_data_reads = info.NumDataReads()
+		self.num_index_reads = info.NumIndexReads()
 
 		if self.num_data_reads == 1:
 			self.IsPaired = False
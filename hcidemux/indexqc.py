@@ -0,0 +1,177 @@
+"""
+indexqc.py - early barcode QC: counts the index sequences of a few tiles
+of each barcoded lane, read straight from the bcl files as soon as the
+index cycles are on disk, and compares them with the lane's samples in
+GNomEx. A wrong barcode or a sample sheet with index 2 in the wrong
+orientation then shows up while the run is still sequencing, rather than
+in the QC report after bcl conversion.
+
+A lane is flagged if fewer than params.early_index_qc_min_matched
+(default 0.5) of its clusters match one of its barcodes with at most one
+mismatch, if a sample has next to no clusters, or if an unexpected
+barcode is more frequent than one of the expected ones (the rule the QC
+report marks 'Problem!' by).
+"""
+import collections
+
+# Mismatches allowed when matching an index sequence to a barcode, as
+# in bcl conversion.
+MISMATCHES = 1
+
+# Unexpected index sequences listed per lane.
+TOP_UNEXPECTED = 10
+
+# A sample has next to no clusters if it has less than this fraction of
+# an even share of the lane.
+MISSING_FRACTION = 0.01
+
+# An unexpected index sequence is only worth reporting if it has at
+# least this fraction of the lane's clusters.
+UNEXPECTED_FRACTION = 0.01
+
+COMPLEMENT = { 'A':'T', 'C':'G', 'G':'C', 'T':'A', 'N':'N' }
+
+def ReverseComplement( seq ):
+	return ''.join([ COMPLEMENT.get(c,'N') for c in reversed(seq) ])
+
+def ExpectedBarcodes( records, lanes_on_disk=[] ):
+	"""
+	Returns { lane: { barcode: sample } } for the lanes with more than
+	one sample, from the flow cell's sample sheet records (see
+	RunMetadata.SampleSheetRecords). Dual barcodes are joined with '-'.
+	A flow cell registered with lane 1 only that has lane 2 on disk
+	(a rapid run) gets lane 1's samples in lane 2 too, as in
+	Run.CreateSampleSheet.
+	"""
+	lanes = collections.defaultdict( dict )
+	for rec in records:
+		( lane, sample, barcode, barcode_b ) = ( int(rec[1]), rec[2], rec[4], rec[8] )
+		if not barcode:
+			continue
+		barcode = barcode.strip()
+		if barcode_b:
+			barcode += '-' + barcode_b.strip()
+		lanes[lane][barcode] = sample
+	if lanes.keys() == [ 1 ] and 2 in lanes_on_disk:
+		lanes[2] = dict( lanes[1] )
+	return dict([ ( lane, barcodes ) for ( lane, barcodes ) in lanes.iteritems() if len(barcodes) > 1 ])
+
+def Variants( barcode ):
+	"""barcode and every sequence one mismatch away from it (N included)."""
+	variants = set([ barcode ])
+	for i in range(len(barcode)):
+		if barcode[i] == '-':
+			continue
+		for c in 'ACGTN':
+			variants.add( barcode[:i] + c + barcode[i+1:] )
+	return variants
+
+def Layout( barcode ):
+	"""Lengths of a barcode's parts."""
+	return tuple([ len(part) for part in barcode.split('-') ])
+
+def Truncate( seq, layout ):
+	"""
+	Cuts an index sequence (index reads joined with '-') down to a
+	barcode layout, or returns None if it has too few index reads.
+	"""
+	parts = seq.split('-')
+	if len(parts) < len(layout):
+		return None
+	return '-'.join([ parts[i][:layout[i]] for i in range(len(layout)) ])
+
+class LaneCheck:
+	"""
+	Index sequence counts of one lane matched up with its barcodes.
+	Attributes: lane, total (clusters counted), counts (clusters
+	indexed by barcode), unexpected (list of ( count, sequence ) for the
+	most frequent sequences matching no barcode), problems (list of
+	messages, empty if the lane looks right), hints.
+	"""
+	def __init__( self, lane, observed, barcodes, min_matched=0.5 ):
+		self.lane = lane
+		self.barcodes = barcodes
+		self.total = sum( observed.values() )
+		( self.counts, others ) = self.Match( observed, barcodes.keys() )
+		self.unexpected = sorted([ ( count, seq ) for ( seq, count ) in others.iteritems() ], reverse=True )[:TOP_UNEXPECTED]
+		self.problems = []
+		self.hints = []
+		if self.total == 0:
+			self.problems.append( "No clusters passing filter." )
+			return
+		matched = sum( self.counts.values() )
+		if matched < min_matched * self.total:
+			self.problems.append( "Only %.1f%% of clusters match the lane's barcodes." % ( 100.0 * matched / self.total ) )
+		even_share = float(self.total) / len(barcodes)
+		missing = [ barcode for barcode in sorted(barcodes) if self.counts[barcode] < MISSING_FRACTION * even_share ]
+		for barcode in missing:
+			self.problems.append( "Sample %s (%s) has %d clusters." % ( barcodes[barcode], barcode, self.counts[barcode] ) )
+		least = min( self.counts.values() )
+		for ( count, seq ) in self.unexpected:
+			if count > least and count >= UNEXPECTED_FRACTION * self.total:
+				self.problems.append( "Unexpected index %s (%.1f%%) is more frequent than a sample's barcode." % ( seq, 100.0 * count / self.total ) )
+		if self.problems:
+			self.hints = self.Hints( observed, matched )
+
+	def Match( self, observed, barcodes ):
+		"""Returns clusters per barcode and per unmatched sequence."""
+		tables = collections.defaultdict( dict )
+		ambiguous = set()
+		for barcode in barcodes:
+			table = tables[Layout(barcode)]
+			for variant in Variants( barcode ):
+				if variant in table and table[variant] != barcode:
+					ambiguous.add( variant )
+				table[variant] = barcode
+		for table in tables.values():
+			for variant in ambiguous:
+				table.pop( variant, None )
+		counts = dict([ ( barcode, 0 ) for barcode in barcodes ])
+		others = collections.defaultdict( int )
+		layouts = tables.keys()
+		for ( seq, count ) in observed.iteritems():
+			for layout in layouts:
+				barcode = tables[layout].get( Truncate( seq, layout ) )
+				if barcode is not None:
+					counts[barcode] += count
+					break
+			else:
+				others[ Truncate( seq, layouts[0] ) or seq ] += count
+		return ( counts, others )
+
+	def Hints( self, observed, matched ):
+		"""Tries the common sample sheet mistakes: returns messages for
+		the ones under which a lot more clusters match."""
+		hints = []
+		dual = [ barcode for barcode in self.barcodes if '-' in barcode ]
+		# ( name, change, number of indexes a barcode needs for it ).
+		# Barcodes with fewer indexes (single ones in a lane that
+		# mixes single and dual barcodes) are left as they are.
+		tries = [ ( "index 1 reverse complemented", lambda p: [ ReverseComplement(p[0]) ] + p[1:], 1 ) ]
+		if dual:
+			tries.append( ( "index 2 reverse complemented", lambda p: p[:1] + [ ReverseComplement(p[1]) ] + p[2:], 2 ) )
+			tries.append( ( "index 1 and index 2 swapped", lambda p: [ p[1], p[0] ] + p[2:], 2 ) )
+		for ( name, change, needed ) in tries:
+			changed = []
+			for barcode in self.barcodes:
+				parts = barcode.split('-')
+				changed.append( '-'.join( change( parts ) ) if len(parts) >= needed else barcode )
+			( counts, others ) = self.Match( observed, changed )
+			if sum( counts.values() ) > matched + 0.2 * self.total:
+				hints.append( "With %s, %.1f%% of clusters would match." % ( name, 100.0 * sum( counts.values() ) / self.total ) )
+		return hints
+
+def Report( run_id, checks, tiles ):
+	"""Text of the early QC report for a run's LaneCheck objects."""
+	lines = [ "Early barcode QC for run %s, from the index reads of %d tile(s) per lane." % ( run_id, tiles ), "" ]
+	for check in checks:
+		status = 'Problem!' if check.problems else 'OK'
+		lines.append( "Lane %d: %s (%d clusters)" % ( check.lane, status, check.total ) )
+		for message in check.problems + check.hints:
+			lines.append( "    " + message )
+		for barcode in sorted( check.counts, key=lambda b: -check.counts[b] ):
+			lines.append( "    %s\t%s\t%.1f%%" % ( check.barcodes[barcode], barcode, 100.0 * check.counts[barcode] / max( check.total, 1 ) ) )
+		for ( count, seq ) in check.unexpected:
+			lines.append( "    unexpected\t%s\t%.1f%%" % ( seq, 100.0 * count / max( check.total, 1 ) ) )
+		lines.append( "" )
+	return "\n".join( lines )
@@ -0,0 +1,171 @@
+"""
+inventory.py - an index of the files in a run folder, built with one
+directory walk and shared by the stages that used to run their own find
+over the whole tree (compressing and uncompressing files, cleanup). The
+index is refreshed incrementally: a directory whose modification time
+hasn't changed still has the same entries, so only changed directories
+are listed again. Stages that add, rename or remove files themselves
+record the change so their own work doesn't count as a change.
+"""
+import os
+import time
+import fnmatch
+
+from fsutil import ScanDir
+
+# A directory modified this recently (seconds) may change again within
+# the resolution of its modification time, so it's listed again on the
+# next refresh whatever its time says.
+RACY_INTERVAL = 2
+
+# File name extensions of compressed files.
+COMPRESSED_SUFFIXES = ( '.gz', '.zst' )
+
+def IsCompressed( filename ):
+	return filename.endswith( COMPRESSED_SUFFIXES )
+
+class DirectoryListing:
+	"""The files and subdirectories of one directory, as of its
+	modification time mtime."""
+	def __init__( self, mtime ):
+		self.mtime = None
+		self.files = set()
+		self.subdirs = set()
+		self.SetMtime( mtime )
+
+	def SetMtime( self, mtime ):
+		if time.time() - mtime < RACY_INTERVAL:
+			mtime = None
+		self.mtime = mtime
+
+class RunInventory:
+	"""
+	Index of the files under a run folder. Symbolic links to directories
+	aren't followed, as with find.
+	"""
+	def __init__( self, root ):
+		self.root = root
+		# DirectoryListing objects indexed by directory path.
+		self.dirs = {}
+		# File sizes looked up so far, indexed by path.
+		self.sizes = {}
+		# Number of directories listed by the last Refresh.
+		self.listed = 0
+		self.Refresh()
+
+	def ListDirectory( self, path, mtime ):
+		listing = DirectoryListing( mtime )
+		for entry in ScanDir( path ):
+			if entry.is_dir( follow_symlinks=False ):
+				listing.subdirs.add( entry.name )
+			else:
+				listing.files.add( entry.name )
+		self.dirs[path] = listing
+		self.listed += 1
+		return listing
+
+	def Refresh( self ):
+		"""Brings the index up to date, listing again only the
+		directories that changed since they were last listed."""
+		self.listed = 0
+		seen = set()
+		stack = [ self.root ]
+		while stack:
+			path = stack.pop()
+			try:
+				mtime = os.stat( path ).st_mtime
+			except OSError:
+				continue
+			seen.add( path )
+			listing = self.dirs.get( path )
+			if listing is None or listing.mtime != mtime:
+				if listing is not None:
+					for name in listing.files:
+						self.sizes.pop( os.path.join( path, name ), None )
+				listing = self.ListDirectory( path, mtime )
+			for name in listing.subdirs:
+				stack.append( os.path.join( path, name ) )
+		# Forget directories that have gone away.
+		for path in self.dirs.keys():
+			if path not in seen:
+				del self.dirs[path]
+
+	def Files( self, pattern=None, compressed=None, under=None ):
+		"""
+		Returns the full paths of the files whose names match the
+		shell-style pattern (all files if None). If compressed is True
+		or False, only compressed or only uncompressed files. If under
+		is given, only files in that directory and below it.
+		"""
+		results = []
+		for ( path, listing ) in self.dirs.iteritems():
+			if under is not None and path != under and not path.startswith( under + os.sep ):
+				continue
+			names = listing.files
+			if pattern is not None:
+				names = fnmatch.filter( names, pattern )
+			for name in names:
+				if compressed is not None and IsCompressed(name) != compressed:
+					continue
+				results.append( os.path.join( path, name ) )
+		results.sort()
+		return results
+
+	def Size( self, filename ):
+		"""Size of a file in the index, looked up the first time it's
+		asked for."""
+		try:
+			return self.sizes[filename]
+		except KeyError:
+			size = os.lstat( filename ).st_size
+			self.sizes[filename] = size
+			return size
+
+	def TotalSize( self, pattern=None, compressed=None ):
+		return sum([ self.Size(f) for f in self.Files( pattern, compressed ) ])
+
+	def Changed( self, removed=[], added=[] ):
+		"""
+		Records files this process removed or created (a rename is
+		both), and takes the modification times of their directories
+		as the new up to date ones.
+		"""
+		touched = set()
+		for filename in removed:
+			( path, name ) = os.path.split( filename )
+			if path in self.dirs:
+				self.dirs[path].files.discard( name )
+				self.sizes.pop( filename, None )
+				touched.add( path )
+		for filename in added:
+			( path, name ) = os.path.split( filename )
+			if path in self.dirs:
+				self.dirs[path].files.add( name )
+				touched.add( path )
+		for path in touched:
+			try:
+				self.dirs[path].SetMtime( os.stat( path ).st_mtime )
+			except OSError:
+				del self.dirs[path]
+
+# Inventories indexed by run folder.
+inventories = {}
+
+def GetInventory( run_dir ):
+	"""Returns the up to date inventory of a run folder, building it
+	the first time."""
+	try:
+		inventory = inventories[run_dir]
+		inventory.Refresh()
+	except KeyError:
+		inventory = RunInventory( run_dir )
+		inventories[run_dir] = inventory
+	return inventory
+
+def Prune( run_dirs ):
+	"""Drops the inventories of run folders other than run_dirs, so a
+	long running process doesn't keep every run it ever saw."""
+	keep = set( run_dirs )
+	for run_dir in inventories.keys():
+		if run_dir not in keep:
+			del inventories[run_dir]
@@ -0,0 +1,192 @@
+"""
+merge.py - merges the output directories of a flow cell's bcl
+conversions (Unaligned_<barcode length>, one per barcode length) into
+Unaligned. MergePlan works out every move before anything is moved:
+
+	Project_*        if it isn't in Unaligned yet, the conversion with
+	                 the most samples in it moves it whole; the Sample_*
+	                 directories of the others then move into it.
+	Sample_lane*     in Undetermined_indices, moves into
+	                 Unaligned/Undetermined_indices.
+
+A destination that already exists or that two moves share, or a source
+on another file system, is a conflict, and nothing is moved while there
+are any. The moves are renames within one file system, done on a few
+threads, each thread taking all the moves into one directory, and each
+move is checked to have moved the same directory. Each merge appends to
+merge_manifest.txt in Unaligned a header line with the time, then a line
+per move: planned, then moved, failed or skipped.
+"""
+import os
+import re
+import time
+import threading
+
+from logger import Logger
+from fsutil import ScanDir
+
+# Name of the manifest file, in the merged directory.
+MANIFEST_NAME = "merge_manifest.txt"
+
+def Subdirectories( dirname, pattern ):
+	"""Returns the sorted names of the directories in dirname matching
+	pattern, or an empty list if dirname doesn't exist."""
+	if not os.path.isdir( dirname ):
+		return []
+	return sorted([ entry.name for entry in ScanDir( dirname )
+		if re.match( pattern, entry.name ) and entry.is_dir( follow_symlinks=False ) ])
+
+def Identity( path ):
+	"""( device, inode ) of path itself."""
+	st = os.lstat( path )
+	return ( st.st_dev, st.st_ino )
+
+class MergePlan(Logger):
+	"""
+	The moves merging output_dirs into merged_dir, in two stages: the
+	Project_ directories moving whole, then the directories moving
+	into the merged directory's Project_ and Undetermined_indices
+	directories. Attributes: stages (two lists of ( src, dest )), moves
+	(all of them), conflicts (list of messages), errors (list of ( src,
+	dest, message ) for the moves that failed).
+	"""
+	def __init__( self, run_dir, output_dirs, merged_dir ):
+		self.run_dir = run_dir
+		self.merged_dir = merged_dir
+		self.undetermined_dir = os.path.join( merged_dir, "Undetermined_indices" )
+		self.manifest = os.path.join( merged_dir, MANIFEST_NAME )
+		self.stages = [ [], [] ]
+		self.conflicts = []
+		self.errors = []
+		self.devices = {}
+		self.lock = threading.Lock()
+		self.Plan( output_dirs )
+		self.moves = self.stages[0] + self.stages[1]
+
+	def Plan( self, output_dirs ):
+		# Conversions having each Project_ directory.
+		projects = {}
+		for outputdir in output_dirs:
+			for project in Subdirectories( outputdir, r"Project_" ):
+				projects.setdefault( project, [] ).append( outputdir )
+		for project in sorted( projects ):
+			dest = os.path.join( self.merged_dir, project )
+			samples = [ ( outputdir, Subdirectories( os.path.join( outputdir, project ), r"Sample_" ) ) for outputdir in projects[project] ]
+			if not os.path.lexists( dest ):
+				samples.sort( key=lambda ( outputdir, names ): -len(names) )
+				self.AddMove( 0, os.path.join( samples[0][0], project ), dest, False )
+				taken = set( samples[0][1] )
+				samples = samples[1:]
+			elif os.path.isdir( dest ):
+				taken = set( os.listdir( dest ) )
+			else:
+				self.conflicts.append( "%s exists and isn't a directory." % dest )
+				continue
+			for ( outputdir, names ) in samples:
+				for sample in names:
+					self.AddMove( 1, os.path.join( outputdir, project, sample ), os.path.join( dest, sample ), sample in taken )
+		# Undetermined reads, used by the QC report.
+		taken = set( os.listdir( self.undetermined_dir ) ) if os.path.isdir( self.undetermined_dir ) else set()
+		for outputdir in output_dirs:
+			src_dir = os.path.join( outputdir, "Undetermined_indices" )
+			for sample in Subdirectories( src_dir, r"Sample_lane" ):
+				self.AddMove( 1, os.path.join( src_dir, sample ), os.path.join( self.undetermined_dir, sample ), sample in taken )
+		# Two moves to one place.
+		dests = {}
+		for ( src, dest ) in self.stages[0] + self.stages[1]:
+			if dest in dests:
+				self.conflicts.append( "%s and %s would both move to %s." % ( dests[dest], src, dest ) )
+			dests[dest] = src
+
+	def AddMove( self, stage, src, dest, exists ):
+		"""Adds a move of src to dest. exists tells whether dest exists."""
+		if exists:
+			self.conflicts.append( "Can't move %s: %s already exists." % ( src, dest ) )
+		elif self.Device( os.path.dirname( src ) ) != self.Device( self.run_dir ):
+			self.conflicts.append( "Can't move %s: it's on another file system." % src )
+		self.stages[stage].append( ( src, dest ) )
+
+	def Device( self, dirname ):
+		if dirname not in self.devices:
+			self.devices[dirname] = os.stat( dirname ).st_dev
+		return self.devices[dirname]
+
+	def RecordMoves( self, status, moves, header=None ):
+		"""Appends moves to the manifest with their status (planned,
+		moved, failed or skipped), after a header line if given. After
+		a header, later lines override earlier ones."""
+		ofs = open( self.manifest, 'a' )
+		if header:
+			ofs.write( "# %s\n" % header )
+		for ( src, dest ) in moves:
+			ofs.write( "%s\t%s\t%s\n" % ( status, os.path.relpath( src, self.run_dir ), os.path.relpath( dest, self.run_dir ) ) )
+		ofs.close()
+
+	def Move( self, src, dest ):
+		"""Renames src to dest and checks that dest is what src was.
+		Raises OSError if not."""
+		before = Identity( src )
+		os.rename( src, dest )
+		if os.path.lexists( src ) or Identity( dest ) != before:
+			raise OSError( "%s didn't end up at %s." % ( src, dest ) )
+
+	def Worker( self, jobs, done ):
+		while True:
+			with self.lock:
+				if not jobs:
+					return
+				moves = jobs.pop(0)
+			for ( src, dest ) in moves:
+				try:
+					self.Move( src, dest )
+					with self.lock:
+						done.append( ( src, dest ) )
+				except OSError, e:
+					self.Log( "PROBLEM! Can't move %s to %s: %s" % ( src, dest, e ) )
+					with self.lock:
+						self.errors.append( ( src, dest, str(e) ) )
+
+	def RunStage( self, moves, numthreads ):
+		"""Makes moves, those into each directory on one thread. Returns
+		the moves made."""
+		into = {}
+		for ( src, dest ) in moves:
+			into.setdefault( os.path.dirname( dest ), [] ).append( ( src, dest ) )
+		# Biggest directories first.
+		jobs = sorted( into.values(), key=lambda job: -len(job) )
+		done = []
+		threads = [ threading.Thread( target=self.Worker, args=( jobs, done ) ) for i in range( min( numthreads, len(jobs) ) ) ]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		return done
+
+	def Execute( self, numthreads=8 ):
+		"""
+		Makes the moves on numthreads threads. Does nothing if there are
+		conflicts. Moves into a Project_ directory whose own move failed
+		are skipped. Returns True if every move was made.
+		"""
+		if self.conflicts:
+			for message in self.conflicts:
+				self.Log( "PROBLEM! " + message )
+			return False
+		for dirname in [ self.merged_dir, self.undetermined_dir ]:
+			if not os.path.exists( dirname ):
+				os.mkdir( dirname )
+		start = time.time()
+		header = "Merge of %d directories into %s started %s." % ( len(self.moves), os.path.relpath( self.merged_dir, self.run_dir ), time.strftime( "%Y-%m-%d %H:%M:%S", time.localtime( start ) ) )
+		self.RecordMoves( "planned", self.moves, header )
+		done = self.RunStage( self.stages[0], numthreads )
+		# Nothing moves into a Project_ directory that didn't get there.
+		missing = set([ dest for ( src, dest, message ) in self.errors ])
+		skipped = [ ( src, dest ) for ( src, dest ) in self.stages[1] if os.path.dirname( dest ) in missing ]
+		for ( src, dest ) in skipped:
+			self.Log( "PROBLEM! Not moving %s: %s isn't there." % ( src, os.path.dirname( dest ) ) )
+		done += self.RunStage( [ move for move in self.stages[1] if os.path.dirname( move[1] ) not in missing ], numthreads )
+		self.RecordMoves( "moved", done )
+		self.RecordMoves( "failed", [ ( src, dest ) for ( src, dest, message ) in self.errors ] )
+		self.RecordMoves( "skipped", skipped )
+		self.Log( "Merged %d of %d directories into %s in %.2f seconds." % ( len(done), len(self.moves), self.merged_dir, time.time() - start ) )
+		return not self.errors and not skipped
@@ -12,23 +12,12 @@ import sys
 import os
 import re
 import threading
-import xml.sax.xmlreader
-import xml.sax.handler
 from logger import Logger
+import runinfo
 import gzip
 
 TAB = '\t'
 
-class RunInfoHandler( xml.sax.handler.ContentHandler ):
-	'''XML parser event handler to count number of bases sequenced
-	in this run.'''
-	def __init__( self ):
-		self.numbases = 0
-
-	def startElement(self,name,attrs):
-		if name == 'Read' and attrs.getValue('IsIndexedRead') == 'N':
-			self.numbases += int(attrs.getValue('NumCycles'))
-
 class ReadCounter(threading.Thread,Logger):
 	def __init__( self, command, semaphore, sample, lane, barcode, parent ):
 		threading.Thread.__init__(self)
@@ -104,9 +93,7 @@ class MiseqIndexingEvaluator(Logger):
 	def CountBases( self ):
 		'''Parses the RunInfo.xml file in the run directory to
 		determine how many bases of sequence data produced per read.'''
-		handler=RunInfoHandler()
-		xml.sax.parse(os.path.join(self.run_folder_name,"RunInfo.xml"),handler)
-		self.numbases = handler.numbases
+		self.numbases = runinfo.GetRunInfo(self.run_folder_name).DataCycles()
 
 	def StoreReadCount( self, numreads, barcode, lane ):
 		'''Stores result of counting reads on a sample's file.'''
@@ -2,18 +2,21 @@ from hiseqrun import HiSeqRun
 from states import States
 
 class PEHiSeqRun(HiSeqRun):
-	def __init__( self, id, full_path_of_run_dir, state=None ):
-		HiSeqRun.__init__(self,id, full_path_of_run_dir, state)
+	def __init__( self, id, full_path_of_run_dir, state=None, metadata=None ):
+		HiSeqRun.__init__(self,id, full_path_of_run_dir, state, metadata)
 		self.type_of_runs = "Paired End HiSeq"
 		self.isPaired = True
 		self.transition = {
 			# curr_state, function, success_state, fail_state
 			States.new: (HiSeqRun.CheckRegisteredVerbose,
-				States.wait_for_data,
+				States.early_index_qc,
 				States.check_registered ),
 			States.check_registered: (HiSeqRun.CheckRegisteredSilent,
-				States.wait_for_data,
+				States.early_index_qc,
 				States.check_registered),
+			States.early_index_qc: (HiSeqRun.EarlyIndexQc,
+				States.wait_for_data,
+				States.early_index_qc),
 			States.wait_for_data: (HiSeqRun.CheckTransferComplete,
 				States.make_sample_sheet,
 				States.wait_for_data),
@@ -7,11 +7,12 @@ import fastq
 import pipelineparams as params
 from states import States
 from run import Run
+import conversion
 
 class PatchPcrRun(Run):
 
-	def __init__( self, id, full_path_of_run_dir, state=None ):
-		Run.__init__(self, id, full_path_of_run_dir, state )
+	def __init__( self, id, full_path_of_run_dir, state=None, metadata=None ):
+		Run.__init__(self, id, full_path_of_run_dir, state, metadata )
 		self.type_of_runs = "PatchPcr"
 		self.transition = {
 			# curr_state, function, success_state, fail_state
@@ -66,19 +67,7 @@ class PatchPcrRun(Run):
 		Determines if a miseq run is a patch pcr run.
 		"""
 		#self.Log("Checking if run %s is a patch pcr run." % self.id)
-		query = """select distinct application.codeapplication, flowcellchannel.filename, application.application
-from application 
-join seqlibprotocolapplication 
-	on application.codeapplication = seqlibprotocolapplication.codeapplication
-join seqlibprotocol on seqlibprotocol.idseqlibprotocol = seqlibprotocolapplication.idseqlibprotocol
-join sample on sample.idseqlibprotocol = seqlibprotocol.idseqlibprotocol
-join sequencelane on sequencelane.idsample = sample.idsample
-join flowcellchannel on sequencelane.idflowcellchannel = flowcellchannel.idflowcellchannel
-where application.application like '%%Patch PCR%%' and 
-	flowcellchannel.filename = '%s';""" % self.id
-		c = self.Query(query)
-		results = c.fetchall()
-		is_patchpcr = len(results)>0
+		is_patchpcr = self.Metadata().HasApplication('Patch PCR')
 		if is_patchpcr:
 			self.Log("Run %s is a patch pcr run." % self.id)
 		#else:
@@ -101,27 +90,9 @@ where application.application like '%%Patch PCR%%' and
 			self.Log("Sample sheet for run %s already exists." % self.id)
 			return True
 
-		# Select lanes from flow cell that are bar coded.
-		try:
-			query = """select sample.number,
-	sample.barcodesequence,
-	request.number
-from flowcell
-	join flowcellchannel on flowcellchannel.idflowcell=flowcell.idflowcell
-	join sequencelane on sequencelane.idflowcellchannel = 
-		flowcellchannel.idflowcellchannel
-	join sample on sequencelane.idsample = sample.idsample
-	left outer join genomebuild on sequencelane.idgenomebuildalignto = 
-		genomebuild.idgenomebuild
-	join request on sequencelane.idrequest = request.idrequest
-	join appuser on request.idappuser = appuser.idappuser
-where flowcellchannel.filename = '%s'
-order by flowcellchannel.number, sample.number;""" % self.id
-			c = self.Query( query )
-		except pymssql.OperationError:
-			print query
-			raise
-		results = c.fetchall()
+		# Select the flow cell's samples from GNomEx, bypassing the
+		# cache, as ( sample, barcode, request ).
+		results = [ ( rec[2], rec[4], rec[7] ) for rec in self.Metadata(fresh=True).SampleSheetRecords() ]
 		# Open file
 		ofs = open(self.sample_sheet,'w')
 		# Copy the header from the existing sample sheet.
@@ -153,9 +124,13 @@ order by flowcellchannel.number, sample.number;""" % self.id
 
 	def PatchPcrDemultiplex( self ):
 		"""
-		Calls bcl2fastq2 program to demultiplex the run.
+		Calls bcl2fastq2 program to demultiplex the run, or
+		demultiplexes it directly (see Run.PcrDemultiplexer).
 		"""
 		self.Log("Demultiplexing patch PCR run %s." % self.id)
+		demultiplexer = self.PcrDemultiplexer( 1, 2 )
+		if demultiplexer:
+			return demultiplexer.Run()
 		# Set minimum read length to the length of the bar code 
 		# read carrying the random n-mer. This will always be the 
 		# 3rd read.
@@ -184,6 +159,8 @@ order by flowcellchannel.number, sample.number;""" % self.id
 			"--use-bases-mask",use_bases_mask,
 			"--minimum-trimmed-read-length", `min_read_length`
 		]
+		( loading, processing, writing ) = conversion.ConversionThreads( samples=conversion.CountIemSamples(self.sample_sheet) )
+		child_args += [ "-r", `loading`, "-p", `processing`, "-w", `writing` ]
 		p = subprocess.Popen(args=child_args,cwd=child_dir,stdout=child_stdout,stderr=child_stderr)
 		retval = p.wait()
 		child_stdout.close()
@@ -242,6 +219,12 @@ order by flowcellchannel.number, sample.number;""" % self.id
 		the file with the _2 suffix, and appends the random n-mer sequence
 		to the read names of the data read(s).
 		"""
+		demultiplexer = self.PcrDemultiplexer( 1, 2 )
+		if demultiplexer:
+			# Demultiplexing already wrote the final files.
+			self.datafiles += [ f for f in demultiplexer.OutputFiles() if f not in self.datafiles ]
+			return self.GenerateChecksums()
+
 		# Get projects and samples for this run from the sample sheet.
 		projects=self.GetSampleSheetProjectsSamples()
 
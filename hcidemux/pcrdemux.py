@@ -0,0 +1,240 @@
+"""
+pcrdemux.py - demultiplexes a MiSeq Patch PCR or Kappa PCR run in this
+process, straight from its bcl files (see bcl), instead of running
+bcl2fastq and then reading every read back to append the random n-mer
+to its name. Each tile's index cycles are read into an array and matched
+against the samples' barcodes all at once: every barcode, and every
+sequence one mismatch away from it, is encoded as a number, and each
+cluster's index is looked up in the sorted table of those numbers. Each
+sample's data reads are then written straight to its final gzipped
+FASTQ files, <sample>_<run>_1_1.txt.gz (and _1_2.txt.gz for a second
+data read), named as bcl2fastq names them with "-<n-mer>" appended.
+Reads whose index matches no sample are counted, not written. Meant for
+small runs: one read of a tile at a time is held in memory.
+"""
+import os
+import struct
+
+import bcl
+import fastq
+import runinfo
+import indexqc
+from logger import Logger
+
+# Codes of the bases in index keys. N (or anything else) is a base of its
+# own, so an N counts as a mismatch.
+BASE_CODES = dict([ ( c, i ) for ( i, c ) in enumerate( "ACGTN" ) ])
+
+def ReadSamples( sample_sheet ):
+	"""Returns ( Sample_ID, index ) for each [Data] row of a MiSeq sample
+	sheet, in order."""
+	samples = []
+	ifs = open( sample_sheet )
+	for rec in ifs:
+		if rec.startswith("Sample_ID"):
+			break
+	for rec in ifs:
+		f = rec.strip().split(',')
+		if len(f) > 5 and f[0]:
+			samples.append( ( f[0], f[5].strip() ) )
+	ifs.close()
+	return samples
+
+def CodeTable():
+	"""Array translating ASCII base letters to base codes."""
+	table = bcl.numpy.empty( 256, bcl.numpy.int64 )
+	table.fill( BASE_CODES['N'] )
+	for ( c, code ) in BASE_CODES.iteritems():
+		table[ord(c)] = code
+	return table
+
+def IndexKeys( bases ):
+	"""Encodes each row of an array of base letters as a number, base
+	code times 5 ** position summed over the row."""
+	numpy = bcl.numpy
+	weights = numpy.array([ 5 ** i for i in range( bases.shape[1] ) ], numpy.int64 )
+	return CodeTable()[bases].dot( weights )
+
+def SequenceKey( seq ):
+	return sum([ BASE_CODES.get( c, BASE_CODES['N'] ) * 5 ** i for ( i, c ) in enumerate( seq ) ])
+
+def BarcodeTable( barcodes ):
+	"""
+	Returns ( keys, samples ) arrays: the sorted keys of every barcode
+	and every sequence one mismatch away from it, and the number of the
+	barcode each one matches. Sequences one mismatch away from two
+	barcodes match neither.
+	"""
+	numpy = bcl.numpy
+	owner = {}
+	ambiguous = set()
+	for ( i, barcode ) in enumerate( barcodes ):
+		for variant in indexqc.Variants( barcode ):
+			key = SequenceKey( variant )
+			if owner.get( key, i ) != i:
+				ambiguous.add( key )
+			owner[key] = i
+	for key in ambiguous:
+		del owner[key]
+	keys = numpy.array( sorted( owner.keys() ), numpy.int64 )
+	samples = numpy.array([ owner[key] for key in keys ], numpy.intp )
+	return ( keys, samples )
+
+def Assign( keys, table ):
+	"""Returns the number of the barcode each index key matches, -1 for
+	none."""
+	numpy = bcl.numpy
+	( table_keys, table_samples ) = table
+	if not len(table_keys):
+		return numpy.zeros( len(keys), numpy.intp ) - 1
+	pos = numpy.searchsorted( table_keys, keys )
+	pos[ pos == len(table_keys) ] = 0
+	return numpy.where( table_keys[pos] == keys, table_samples[pos], -1 )
+
+class PcrDemultiplexer(Logger):
+	"""
+	Demultiplexes lane 1 of a MiSeq run. index_read and nmer_read are
+	the numbers (from 0) of the reads, in RunInfo.xml's order, holding
+	the sample barcode and the random n-mer; the others are data reads.
+	"""
+	lane = 1
+
+	def __init__( self, run_dir, run_id, sample_sheet, index_read, nmer_read, output_dir ):
+		self.run_dir = run_dir
+		self.run_id = run_id
+		self.output_dir = output_dir
+		self.samples = ReadSamples( sample_sheet )
+		self.info = runinfo.GetRunInfo( run_dir )
+		# Cycles of each read, and the read number bcl2fastq gives it
+		# (the index read doesn't count).
+		self.data_reads = []
+		self.index_cycles = None
+		self.nmer_cycles = None
+		first = 1
+		number = 0
+		for ( i, read ) in enumerate( self.info.reads ):
+			cycles = range( first, first + read.cycles )
+			first += read.cycles
+			if i == index_read:
+				self.index_cycles = cycles
+				continue
+			number += 1
+			if i == nmer_read:
+				self.nmer_cycles = cycles
+			else:
+				self.data_reads.append( ( number, cycles ) )
+
+	def Problem( self ):
+		"""Returns the reason the run can't be demultiplexed this way, or
+		None if it can."""
+		if bcl.numpy is None:
+			return "numpy isn't installed"
+		if self.index_cycles is None or self.nmer_cycles is None:
+			return "RunInfo.xml doesn't list the index and n-mer reads"
+		if not self.samples:
+			return "the sample sheet has no samples"
+		names = [ self.SampleName( sample ) for ( sample, barcode ) in self.samples ]
+		if len(set(names)) != len(names):
+			return "sample names aren't unique"
+		lengths = set([ len(barcode) for ( sample, barcode ) in self.samples ])
+		if len(lengths) != 1:
+			return "barcodes are of different lengths"
+		if lengths.pop() > len(self.index_cycles):
+			return "barcodes are longer than the index read"
+		if len(self.samples) > 1 and '' in [ barcode for ( sample, barcode ) in self.samples ]:
+			return "a sample has no barcode"
+		return None
+
+	def SampleName( self, sample ):
+		"""GNomEx sample number of a Sample_ID."""
+		return sample.split("_")[0]
+
+	def OutputFiles( self ):
+		"""Names of the FASTQ files written: for each sample, one per
+		data read."""
+		return [ os.path.join( self.output_dir, "%s_%s_1_%d.txt.gz" % ( self.SampleName(sample), self.run_id, end+1 ) )
+			for ( sample, barcode ) in self.samples for end in range(len(self.data_reads)) ]
+
+	def Run( self ):
+		"""Demultiplexes every tile. Returns True on success, False if
+		a file couldn't be read or written."""
+		numpy = bcl.numpy
+		reader = bcl.BclReader( self.run_dir )
+		tiles = reader.Tiles( self.lane )
+		if not tiles:
+			self.Log( "PROBLEM! No tiles with filter files in %s." % reader.LaneDir( self.lane ) )
+			return False
+		barcodes = [ barcode for ( sample, barcode ) in self.samples ]
+		table = BarcodeTable( barcodes )
+		if not os.path.exists( self.output_dir ):
+			os.makedirs( self.output_dir )
+		names = self.OutputFiles()
+		ends = len(self.data_reads)
+		writers = []
+		counts = numpy.zeros( len(self.samples) + 1, numpy.int64 )
+		self.Log( "Demultiplexing %d tiles of run %s into %d samples." % ( len(tiles), self.run_id, len(self.samples) ) )
+		failed = False
+		try:
+			for name in names:
+				writers.append( fastq.Writer( name ) )
+			for tile in tiles:
+				counts += self.DemultiplexTile( reader, tile, table, len(barcodes[0]), writers, ends )
+		except ( IOError, OSError, ValueError, struct.error ), e:
+			# A missing or short bcl, filter or locs file, or a gzip
+			# that died.
+			self.Log( "PROBLEM! Can't demultiplex run %s: %s" % ( self.run_id, e ) )
+			failed = True
+		finally:
+			for ( name, writer ) in zip( names, writers ):
+				try:
+					writer.close()
+				except IOError:
+					# gzip is gone; its exit status tells.
+					pass
+				# Writer doesn't wait for gzip to finish.
+				if writer.p and writer.p.wait() != 0:
+					self.Log( "PROBLEM! gzip writing %s exited with status %d." % ( name, writer.p.returncode ) )
+					failed = True
+		if failed:
+			return False
+		for ( i, ( sample, barcode ) ) in enumerate( self.samples ):
+			self.Log( "Sample %s (%s): %d reads." % ( sample, barcode or 'no barcode', counts[i] ) )
+		self.Log( "Undetermined: %d reads." % counts[-1] )
+		return True
+
+	def DemultiplexTile( self, reader, tile, table, barcode_length, writers, ends ):
+		"""Writes one tile's reads to the samples' files. Returns an
+		array of the reads of each sample, undetermined last."""
+		numpy = bcl.numpy
+		index = reader.ReadTile( self.lane, tile, self.index_cycles ).bases
+		clusters = len(index)
+		assigned = Assign( IndexKeys( index[:,:barcode_length] ), table )
+		assigned[ assigned < 0 ] = len(self.samples)
+		counts = numpy.bincount( assigned, minlength=len(self.samples)+1 )
+		if not clusters:
+			return counts
+		# Clusters of each sample, in cluster order.
+		order = numpy.argsort( assigned, kind='mergesort' )
+		bounds = numpy.concatenate( ( [ 0 ], numpy.cumsum( counts ) ) )
+		indexes = bcl.Sequences( index ).tolist()
+		nmers = bcl.Sequences( reader.ReadTile( self.lane, tile, self.nmer_cycles ).bases ).tolist()
+		passed = reader.PassingFilter( self.lane, tile )
+		positions = reader.Positions( self.lane, tile )
+		if positions is not None and len(positions[0]) == len(passed):
+			( x, y ) = ( positions[0][passed].tolist(), positions[1][passed].tolist() )
+		else:
+			# No cluster positions: number the clusters instead.
+			( x, y ) = ( numpy.nonzero( passed )[0].tolist(), [ 0 ] * clusters )
+		prefix = "@%s:%s:%s:%d:%d:" % ( self.info.instrument, self.info.run_number, self.info.flowcell_id, self.lane, tile )
+		for ( end, ( number, cycles ) ) in enumerate( self.data_reads ):
+			calls = reader.ReadTile( self.lane, tile, cycles )
+			sequences = bcl.Sequences( calls.bases ).tolist()
+			qualities = bcl.Sequences( calls.qualities + 33 ).tolist()
+			del calls
+			for s in range(len(self.samples)):
+				rows = order[bounds[s]:bounds[s+1]].tolist()
+				if not rows:
+					continue
+				writers[s*ends+end].write_text( ''.join([ "%s%d:%d %d:N:0:%s-%s\n%s\n+\n%s\n" %
+					( prefix, x[r], y[r], number, indexes[r], nmers[r], sequences[r], qualities[r] ) for r in rows ]) )
+		return counts
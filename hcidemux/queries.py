@@ -0,0 +1,262 @@
+"""
+queries.py - registry of the named, parameterized GNomEx queries used by
+the pipeline and its utilities. Values are always passed to the database
+driver as parameters rather than pasted into the SQL text, so each
+statement's text is the same from run to run. Execute keeps per-query
+call counts and latencies; LatencyReport lists the slowest queries.
+"""
+import time
+import collections
+
+import gnomex
+import pipelineparams as params
+
+class Statement:
+	"""
+	One named GNomEx query. sql uses %s placeholders. An argument that
+	is a list or tuple expands its placeholder to one %s per element,
+	for "in (...)" conditions. columns names the result columns, and is
+	used for the dict and namedtuple row types.
+	"""
+	def __init__( self, name, sql, columns ):
+		self.name = name
+		self.sql = sql
+		self.columns = tuple(columns)
+		# Result row class for rowtype 'namedtuple'.
+		self.row_class = collections.namedtuple( ''.join([ w.capitalize() for w in name.split('_') ]), self.columns )
+
+	def Bind( self, args ):
+		"""Returns ( sql, args ) ready for cursor.execute."""
+		parts = self.sql.split('%s')
+		if len(parts) - 1 != len(args):
+			raise ValueError("Query %s takes %d arguments, %d given." % ( self.name, len(parts)-1, len(args) ))
+		sql = parts[0]
+		flat = []
+		for i in range(len(args)):
+			if isinstance(args[i],(list,tuple)):
+				if not args[i]:
+					raise ValueError("Query %s: empty list for argument %d." % ( self.name, i+1 ))
+				sql += ','.join(['%s'] * len(args[i]))
+				flat.extend(args[i])
+			else:
+				sql += '%s'
+				flat.append(args[i])
+			sql += parts[i+1]
+		return ( sql, tuple(flat) )
+
+	def MakeRows( self, results, rowtype ):
+		if rowtype == 'tuple':
+			return results
+		elif rowtype == 'dict':
+			return [ dict(zip(self.columns,rec)) for rec in results ]
+		elif rowtype == 'namedtuple':
+			return [ self.row_class(*rec) for rec in results ]
+		raise ValueError("Unknown row type %s." % rowtype)
+
+# Registered statements, indexed by name.
+statements = {}
+
+# Latency statistics indexed by statement name:
+# [ calls, total seconds, slowest call seconds, rows returned ].
+stats = {}
+
+def Register( name, sql, columns ):
+	"""Adds a named statement to the registry and returns it."""
+	statements[name] = Statement( name, sql, columns )
+	return statements[name]
+
+def Execute( name, args=(), rowtype='tuple', connection=None ):
+	"""
+	Runs a registered statement with the given arguments and returns
+	its rows as tuples, dictionaries or named tuples according to
+	rowtype. Uses a pooled GNomEx connection unless one is given.
+	"""
+	statement = statements[name]
+	( sql, flat ) = statement.Bind( args )
+	if connection is None:
+		with gnomex.GetPool(params.db_user,params.db_password).Connection() as connection:
+			return Execute( name, args, rowtype, connection )
+	start = time.time()
+	c = connection.cursor()
+	c.execute( sql, flat )
+	results = c.fetchall()
+	elapsed = time.time() - start
+	s = stats.setdefault( name, [ 0, 0.0, 0.0, 0 ] )
+	s[0] += 1
+	s[1] += elapsed
+	s[2] = max( s[2], elapsed )
+	s[3] += len(results)
+	return statement.MakeRows( results, rowtype )
+
+def LatencyReport( limit=10 ):
+	"""Returns list of report lines for the queries with the most
+	total time spent, slowest first."""
+	names = stats.keys()
+	names.sort( key=lambda name: stats[name][1], reverse=True )
+	lines = []
+	for name in names[:limit]:
+		( calls, total, slowest, rows ) = stats[name]
+		lines.append( "%-24s %5d calls %8.3fs total %8.3fs mean %8.3fs max %7d rows" %
+			( name, calls, total, total/calls, slowest, rows ) )
+	return lines
+
+def ResetStats():
+	stats.clear()
+
+#
+# Pipeline queries.
+#
+
+# GNomEx information about a batch of run folders (RunMetadataFetcher).
+Register( 'run_channels', """select flowcellchannel.filename,
+	flowcellchannel.number,
+	flowcell.barcode,
+	flowcell.number,
+	flowcell.createdate,
+	corefacility.facilityname
+from flowcellchannel
+	left outer join flowcell on flowcellchannel.idflowcell = flowcell.idflowcell
+	left outer join corefacility on flowcell.idcorefacility = corefacility.idcorefacility
+where flowcellchannel.filename in (%s)""",
+	[ 'filename', 'lane', 'flowcell_barcode', 'flowcell_number', 'flowcell_createdate', 'facilityname' ] )
+
+Register( 'run_samples', """select flowcellchannel.filename,
+	flowcellchannel.number,
+	flowcell.barcode,
+	sample.number,
+	genomebuild.genomebuildname,
+	sample.barcodesequence,
+	sample.barcodesequenceb,
+	appuser.firstname,
+	appuser.lastname,
+	request.number,
+	samplerequest.number,
+	samplerequest.createdate
+from flowcellchannel
+	join sequencelane on sequencelane.idflowcellchannel =
+		flowcellchannel.idflowcellchannel
+	join sample on sequencelane.idsample = sample.idsample
+	left outer join flowcell on flowcellchannel.idflowcell = flowcell.idflowcell
+	left outer join genomebuild on sequencelane.idgenomebuildalignto =
+		genomebuild.idgenomebuild
+	left outer join request on sequencelane.idrequest = request.idrequest
+	left outer join appuser on request.idappuser = appuser.idappuser
+	left outer join request samplerequest on sample.idrequest = samplerequest.idrequest
+where flowcellchannel.filename in (%s)
+order by flowcellchannel.filename, flowcellchannel.number, sample.number""",
+	[ 'filename', 'lane', 'flowcell_barcode', 'sample', 'genome', 'barcode', 'barcode_b',
+	'firstname', 'lastname', 'request', 'sample_request', 'sample_request_date' ] )
+
+Register( 'run_applications', """select distinct flowcellchannel.filename, application.application
+from application
+	join seqlibprotocolapplication
+		on application.codeapplication = seqlibprotocolapplication.codeapplication
+	join seqlibprotocol on seqlibprotocol.idseqlibprotocol = seqlibprotocolapplication.idseqlibprotocol
+	join sample on sample.idseqlibprotocol = seqlibprotocol.idseqlibprotocol
+	join sequencelane on sequencelane.idsample = sample.idsample
+	join flowcellchannel on sequencelane.idflowcellchannel = flowcellchannel.idflowcellchannel
+where flowcellchannel.filename in (%s)""",
+	[ 'filename', 'application' ] )
+
+# Flow cell number and date, for the QC file location.
+Register( 'flowcell_by_barcode', "select number, createdate from flowcell where barcode = %s",
+	[ 'number', 'createdate' ] )
+
+# Sample sheet contents for a run folder, all lanes or selected lanes
+# (create_samplesheet.py, write_iem_samplesheet.py).
+samplesheet_sql = """select flowcell.barcode,
+	flowcellchannel.number,
+	sample.number,
+	genomebuild.genomebuildname,
+	sample.barcodesequence,
+	appuser.firstname,
+	appuser.lastname,
+	request.number,
+	sample.barcodesequenceb
+from flowcell
+	join flowcellchannel on flowcellchannel.idflowcell=flowcell.idflowcell
+	join sequencelane on sequencelane.idflowcellchannel =
+		flowcellchannel.idflowcellchannel
+	join sample on sequencelane.idsample = sample.idsample
+	left outer join genomebuild on sequencelane.idgenomebuildalignto =
+		genomebuild.idgenomebuild
+	join request on sequencelane.idrequest = request.idrequest
+	join appuser on request.idappuser = appuser.idappuser
+where flowcellchannel.filename = %s
+%s order by flowcellchannel.number, sample.number"""
+samplesheet_columns = [ 'flowcell_barcode', 'lane', 'sample', 'genome', 'barcode',
+	'firstname', 'lastname', 'request', 'barcode_b' ]
+Register( 'samplesheet', samplesheet_sql.replace('\n%s ','\n'), samplesheet_columns )
+Register( 'samplesheet_lanes', samplesheet_sql.replace('\n%s ','\nand flowcellchannel.number in (%s)\n'), samplesheet_columns )
+
+#
+# Utility queries.
+#
+
+# Labs of the requests on a run (utils/runlabs.py).
+Register( 'request_labs', """select request.number,lab.firstname,lab.lastname
+from request,lab
+where request.idlab=lab.idlab
+and request.number in (%s)""",
+	[ 'number', 'firstname', 'lastname' ] )
+
+# An investigator's analyses (utils/gnomex_analysis_dump.py).
+Register( 'lab_analyses', """select lab.firstname labfirst,
+	lab.lastname lablast,
+	appuser.firstname userfirst,
+	appuser.lastname userlast,
+	AnalysisGroup.name groupname,
+	Analysis.number analnumber,
+	Analysis.name analname,
+	organism.organism,
+	genomebuild.genomebuildname
+from lab
+	join Analysis on Analysis.idLab = lab.idlab
+	join appuser on appuser.idappuser = Analysis.idappuser
+	join AnalysisGroupItem on AnalysisGroupItem.idAnalysis = Analysis.idAnalysis
+	left join AnalysisGroup on AnalysisGroupItem.idAnalysisGroup = AnalysisGroup.idAnalysisGroup
+	join organism on organism.idorganism = Analysis.idorganism
+	join AnalysisGenomeBuild on AnalysisGenomeBuild.idAnalysis = Analysis.idAnalysis
+	left join genomebuild on AnalysisGenomeBuild.idgenomebuild = genomebuild.idgenomebuild
+where lab.firstname = %s and lab.lastname = %s
+order by analnumber""",
+	[ 'labfirst', 'lablast', 'userfirst', 'userlast', 'groupname', 'analnumber', 'analname',
+	'organism', 'genomebuildname' ] )
+
+# An investigator's sequencing requests (utils/gnomex_request_dump.py).
+# Uses codeapplication from the seqlibprotocolapplication table, since
+# this is the one recorded by the sequencing lab rather than the one
+# requested by the user (which may be incorrect).
+Register( 'lab_requests', """select lab.firstname labfirst,
+	lab.lastname lablast,
+	appuser.firstname userfirst,
+	appuser.lastname userlast,
+	request.number reqnum,
+	project.name projname,
+	sample.number samnum,
+	sample.name samname,
+	organism.organism,
+	genomebuild.genomebuildname,
+	seqlibprotocolapplication.codeapplication,
+	request.createdate,
+	numbersequencingcycles.numbersequencingcycles,
+	seqruntype.seqruntype
+from lab
+	join request on request.idlab = lab.idlab
+	join appuser on appuser.idappuser = request.idappuser
+	join project on request.idproject = project.idproject
+	join sample on sample.idrequest = request.idrequest
+	join organism on sample.idorganism = organism.idorganism
+	join sequencelane on sequencelane.idsample = sample.idsample
+	left outer join genomebuild on sequencelane.idgenomebuildalignto = genomebuild.idgenomebuild
+	join seqruntype on sequencelane.idseqruntype = seqruntype.idseqruntype
+	join numbersequencingcycles on sequencelane.idnumbersequencingcycles = numbersequencingcycles.idnumbersequencingcycles
+	join seqlibprotocol on sample.idseqlibprotocol = seqlibprotocol.idseqlibprotocol
+	join seqlibprotocolapplication on seqlibprotocol.idseqlibprotocol = seqlibprotocolapplication.idseqlibprotocol
+	join application on seqlibprotocolapplication.codeapplication = application.codeapplication
+where lab.firstname = %s
+	and lab.lastname = %s
+order by userlast, samnum""",
+	[ 'labfirst', 'lablast', 'userfirst', 'userlast', 'reqnum', 'projname', 'samnum', 'samname',
+	'organism', 'genomebuildname', 'codeapplication', 'createdate', 'numbersequencingcycles',
+	'seqruntype' ] )
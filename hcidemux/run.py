@@ -1,17 +1,35 @@
-import xml.dom.minidom
 import socket
 import subprocess
 import os
 import re
 import sys
+import shutil
+import fnmatch
+import threading
+import traceback
+import multiprocessing
 
 import pipelineparams as params
-import gnomex
+import queries
 from states import States
 from emailer import Emailer
 from simultaneousjobrunner import SimultaneousJobRunner
-
-connection = gnomex.GNomExConnection().GnConnect(params.db_user,params.db_password)
+from runmetadata import RunMetadataCache
+import runinfo
+from concatenate import Concatenator, FindChunks
+import distribute
+import checksums
+import inventory
+import compress
+import conversion
+import bcl
+import indexqc
+import pcrdemux
+import merge
+
+# Copy of the sample sheet data files were made from, kept in the Unaligned
+# directory for lane selective reprocessing.
+DISTRIBUTED_SAMPLESHEET = "distributed_samplesheet.csv"
 
 def EraseCommas(s):
 	"""Removes all commas in string s."""
@@ -20,11 +38,27 @@ def EraseCommas(s):
 	else:
 		return s
 
+def PartitionCores( weights, cores ):
+	"""
+	Divides cores among jobs in proportion to their weights, at least one
+	each. Returns the list of each job's share.
+	"""
+	total = float(sum(weights)) or 1.0
+	shares = [ max( 1, int( cores * w / total ) ) for w in weights ]
+	# Hand out the cores lost to rounding down, biggest jobs first.
+	spare = cores - sum(shares)
+	order = sorted( range(len(weights)), key=lambda i: -weights[i] )
+	while spare > 0 and order:
+		for i in order[:spare]:
+			shares[i] += 1
+		spare -= len(order[:spare])
+	return shares
+
 class Run(Emailer,SimultaneousJobRunner):
 	"""Information about one sequencing run including its current
 	state in the pipeline."""
 
-	def __init__( self, id, full_path_of_run_dir, state=None ):
+	def __init__( self, id, full_path_of_run_dir, state=None, metadata=None ):
 		self.id = id
 		self.dirname = full_path_of_run_dir
 		if state is None:
@@ -36,9 +70,18 @@ class Run(Emailer,SimultaneousJobRunner):
 		self.IsPaired = None
 		# List of full pathnames of all data files produced by this run, following rename.
 		self.datafiles=[]
+		# MD5 checksums of data files already computed, with their
+		# .md5 files written, indexed by data file name.
+		self.checksums={}
+		# Serializes bcl file uncompression between concurrent
+		# conversions.
+		self.bcl_lock = threading.Lock()
 		self.output_dirs=[]
 		# List of Lane objects.
 		self.lanes = []
+		# RunMetadata object with this run's GNomEx information,
+		# normally fetched for all active runs at once.
+		self.metadata = metadata
 		SimultaneousJobRunner.__init__( self, verbose=True )
 		self.InitializeCoreFacility()
 	
@@ -53,32 +96,37 @@ class Run(Emailer,SimultaneousJobRunner):
 		else:
 			return 1
 
-	def Query( self, query ):
+	def Query( self, name, args=(), rowtype='tuple' ):
 		"""
-		Runs a SQL query against GNomEx, and retuns a cursor from
-		which the results can be retrieved.
+		Runs a named query from the queries module against GNomEx,
+		and returns the list of result rows.
 		"""
-		global connection
-		c = connection.cursor()
-		c.execute(query)
-		return c
+		return queries.Execute( name, args, rowtype )
 	
+	def Metadata( self, fresh=False ):
+		"""
+		Returns the RunMetadata object holding this run's GNomEx
+		information. If none was supplied when the run was created,
+		or fresh is True, it is fetched now and the cache updated.
+		"""
+		if self.metadata is None or fresh:
+			self.metadata = RunMetadataCache().Refresh(self.id)
+		return self.metadata
+
+	def RunInfo( self ):
+		"""
+		Returns the runinfo.RunInfo object describing the run folder's
+		reads, instrument and flow cell, reparsed only when
+		RunInfo.xml or runParameters.xml change.
+		"""
+		return runinfo.GetRunInfo(self.dirname)
+
 	def InitializeCoreFacility( self ):
 		"""
 		InitializeCoreFacility identifies which core facility
 		started this run.
 		"""
-		self.corefacilityname = None
-		query="""select distinct facilityname
-		from corefacility
-		join flowcell on flowcell.idcorefacility = corefacility.idcorefacility
-		join flowcellchannel on flowcellchannel.idflowcell = flowcell.idflowcell
-		and flowcellchannel.filename = '%s';""" % self.id
-		recs=self.Query(query).fetchall()
-		try:
-			self.corefacilityname = recs[0][0]
-		except:
-			self.corefacilityname = 'Unknown'
+		self.corefacilityname = self.Metadata().CoreFacilityName() or 'Unknown'
 		#self.Log("Run %s came from core facility '%s'." % (self.id,self.corefacilityname))
 
 	def FromAddr( self ):
@@ -108,12 +156,7 @@ class Run(Emailer,SimultaneousJobRunner):
 
 	def CheckRegisteredSilent( self ):
 		"""Boolean function to test if run folder actually registered in GNomEx."""
-		g = gnomex.GNomExConnection()
-		connection = g.GnConnect(params.db_user,params.db_password)
-		c = connection.cursor()
-		c.execute("select count(*) from flowcellchannel where filename = %s", self.id)
-		results = c.fetchall()
-		numlanes = results[0][0]
+		numlanes = self.Metadata().NumLanes()
 		# 2013/07/15: Flow cells can now either have 8 lanes (HiSeq2000)
 		# or 1 lane (HiSeq2500). Permit either of these styles of
 		# flow cell here. Brett Milash.
@@ -153,9 +196,7 @@ class Run(Emailer,SimultaneousJobRunner):
 		RTA 1.12 creates a data transfer complete file for each read
 		in the run. This function checks if the last file for the
 		run is present."""
-		configfile = os.path.join(self.dirname, "RunInfo.xml")
-		doc = xml.dom.minidom.parse(configfile)
-		numreads=len(doc.getElementsByTagName("Read"))
+		numreads=len(self.RunInfo().reads)
 		done_file=os.path.join(self.dirname,"Basecalling_Netcopy_complete_Read%d.txt"%numreads)
 		print(done_file)
 		if os.path.exists(done_file):
@@ -167,6 +208,100 @@ class Run(Emailer,SimultaneousJobRunner):
 			self.Log(["Run", self.id, "complete-file",done_file,"doesn't exist."])
 			return False
 	
+	def IndexCyclesDone( self ):
+		"""True once the run's index cycles are all on disk: the transfer
+		of the last index read is complete, or every lane has a cycle
+		directory past the last index cycle."""
+		info = self.RunInfo()
+		last_read = None
+		last_cycle = 0
+		for read in info.reads:
+			last_cycle += read.cycles
+			if read.is_index:
+				last_read = read.number
+				index_end = last_cycle
+		if last_read is None:
+			return False
+		if os.path.exists(os.path.join(self.dirname,"Basecalling_Netcopy_complete_Read%d.txt"%last_read)):
+			return True
+		basecalls = os.path.join(self.dirname,"Data","Intensities","BaseCalls")
+		for lane in range(1,(info.lane_count or 1)+1):
+			if not os.path.exists(os.path.join(basecalls,"L%03d"%lane,"C%d.1"%(index_end+1))):
+				return False
+		return True
+
+	def EarlyIndexQc( self ):
+		"""
+		Once the index cycles are on disk, counts the index sequences of
+		a few tiles of each barcoded lane and checks them against the
+		lane's samples in GNomEx (see indexqc). Writes the results to
+		early_index_qc_<run>.txt in the run folder, and emails the lab
+		staff if a lane looks wrong, so the samples can be fixed before
+		the sample sheet is made. Returns False while waiting for the
+		index cycles. The check is skipped (returning True) if it's
+		turned off with params.early_index_qc, numpy isn't installed,
+		the run has no index reads, or the base calls can't be read.
+		"""
+		if not getattr(params,'early_index_qc',True):
+			return True
+		if bcl.numpy is None:
+			self.Log(["Skipping early index QC of run",self.id,", numpy isn't installed."])
+			return True
+		if not [ read for read in self.RunInfo().reads if read.is_index ]:
+			self.Log(["Skipping early index QC of run",self.id,", it has no index reads."])
+			return True
+		if not self.IndexCyclesDone():
+			if self.CheckTransferComplete(notify=False):
+				return True
+			self.Log(["Run",self.id,"index cycles not complete yet."])
+			return False
+		# The check is advisory: whatever goes wrong with it, the run
+		# goes on.
+		try:
+			self.CheckIndexes()
+		except Exception:
+			self.Log(["PROBLEM! Early index QC of run",self.id,"failed. Details:"]+traceback.format_exc().splitlines())
+		return True
+
+	def CheckIndexes( self ):
+		"""The early index QC proper, see EarlyIndexQc."""
+		try:
+			reader = bcl.BclReader( self.dirname )
+			lanes_on_disk = [ lane for lane in range(1,(self.RunInfo().lane_count or 1)+1) if os.path.isdir(reader.LaneDir(lane)) ]
+			expected = indexqc.ExpectedBarcodes( self.Metadata(fresh=True).SampleSheetRecords(), lanes_on_disk )
+			num_tiles = getattr(params,'early_index_qc_tiles',2)
+			checks = []
+			for lane in sorted(expected.keys()):
+				tiles = reader.Tiles( lane )
+				if len(tiles) > num_tiles:
+					# Spread the sample over the surfaces and swaths.
+					tiles = [ tiles[i*len(tiles)//num_tiles] for i in range(num_tiles) ]
+				if not tiles:
+					self.Log(["PROBLEM! No tiles found for lane",lane,"of run",self.id,"for early index QC."])
+					continue
+				counts = reader.CountIndexes( lane, tiles )
+				checks.append( indexqc.LaneCheck( lane, counts, expected[lane], getattr(params,'early_index_qc_min_matched',0.5) ) )
+		except ( IOError, OSError, ValueError ), e:
+			self.Log(["PROBLEM! Can't do early index QC of run",self.id,":",str(e)])
+			return
+		if not checks:
+			return
+		report = indexqc.Report( self.id, checks, num_tiles )
+		report_file = os.path.join(self.dirname,"early_index_qc_%s.txt"%self.id)
+		ofs = open(report_file,'w')
+		ofs.write(report)
+		ofs.close()
+		problem_lanes = [ check.lane for check in checks if check.problems ]
+		if problem_lanes:
+			self.Log(["PROBLEM! Early index QC of run",self.id,"found problems in lanes",problem_lanes,", see",report_file])
+			subject = "HiSeq Pipeline Problem! Barcodes (%s)" % self.id
+			message = "The index reads of run %s don't match the samples entered in GNomEx for lane(s) %s.\n" % (self.id,', '.join(map(str,problem_lanes)))
+			message += "Please check the samples' barcodes in GNomEx. The sample sheet is made from GNomEx when the run finishes.\n\n"
+			message += report
+			self.NotifyLabStaff( subject, message )
+		else:
+			self.Log(["Early index QC of run",self.id,"found no problems, see",report_file])
+
 	def CheckSingleIndexLength( self ):
 		if self.sample_sheet is None:
 			# Try to find the sample sheet. It should exist.
@@ -203,24 +338,17 @@ class Run(Emailer,SimultaneousJobRunner):
 		Returns a tuple with the lengths of each read in the run 
 		read from the RunInfo.xml file.
 		"""
-		lengths=[]
-		doc = xml.dom.minidom.parse(os.path.join(self.dirname,"RunInfo.xml"))
-		reads=doc.getElementsByTagName("Read")
-		for read in reads:
-			lengths.append(int(read.getAttribute("NumCycles")))
-		return tuple(lengths)
+		return self.RunInfo().ReadLengths()
 
 	def FlowCellVersion( self ):
 		"""Returns run's flow cell version from the 
 		runParameters.xml file."""
-		# Look in the runParameters.xml document for the Flowcell element to determine flow cell type.
-		doc = xml.dom.minidom.parse(os.path.join(self.dirname,"runParameters.xml"))
-		e=doc.getElementsByTagName("Flowcell")[0]
-		flowcell=e.firstChild.nodeValue
-		return flowcell
-
-	def BclConvert( self, sample_sheet=None, output_dir=None, use_bases_mask=None, compress_bcls=True, mismatches=1 ):
-		"""Converts the bcl files into compressed Fastq."""
+		return self.RunInfo().flowcell_version
+
+	def BclConvert( self, sample_sheet=None, output_dir=None, use_bases_mask=None, compress_bcls=True, mismatches=1, jobs=None ):
+		"""Converts the bcl files into compressed Fastq, with the engine
+		conversion.GetEngine picks, using jobs cores (None to let the
+		engine decide)."""
 		# Generate a sample sheet if it is not already present.
 		if sample_sheet:
 			self.sample_sheet = sample_sheet
@@ -230,113 +358,112 @@ class Run(Emailer,SimultaneousJobRunner):
 			self.Log(["PROBLEM! Can't locate or create sample sheet .csv file in", self.dirname, "for barcoded run", self.id] )
 			return False
 
-		flowcell = self.FlowCellVersion()
-		print(self.FlowCellVersion())
-		if flowcell == "HiSeq Flow Cell v3":
-			# V3 flowcell processing.
-			# Run the configureBclToFastq.pl scripts.
-			self.Log(["Running configureBclToFastq on run", self.id])
-			child_dir=self.dirname
-			if not output_dir:
-				output_dir = os.path.join( self.dirname, "Unaligned" )
-			child_stdout=open(os.path.join(child_dir,"bcltofastq.out"),'w')
-			child_stderr=open(os.path.join(child_dir,"bcltofastq.err"),'w')
-			child_args=[os.path.join(params.casava_dir,"configureBclToFastq.pl"),
-				"--input-dir",os.path.join(self.dirname,"Data","Intensities","BaseCalls"),
-				"--positions-format",".clocs",
-				"--sample-sheet",self.sample_sheet,
-				"--output-dir",output_dir,
-				"--mismatches",`mismatches`,
-			]
-			if use_bases_mask:
-				child_args.append( "--use-bases-mask" )
-				child_args.append( use_bases_mask )
-			p = subprocess.Popen(args=child_args,cwd=child_dir,stdout=child_stdout,stderr=child_stderr)
-			retval = p.wait()
-			child_stdout.close()
-			child_stderr.close()
-		else:
-			# V4 and other types of flowcell processing.
-			# Run the configureBclToFastq.pl scripts.
-			self.Log(["Running configureBclToFastq on run", self.id])
-			#basecallsdir=$rundir/Data/Intensities/BaseCalls
-			#configureBclToFastq.pl --input-dir=$basecallsdir \
-			#	--output-dir=$rundir/Unaligned \
-			#	--sample-sheet=$basecallsdir/created_samplesheet.csv \
-			#	--positions-format=.clocs \
-			#	--mismatches 1 \
-			#	--no-eamss
-			child_dir=self.dirname
-			if not output_dir:
-				output_dir = os.path.join( self.dirname, "Unaligned" )
-			child_stdout=open(os.path.join(child_dir,"bcltofastq.out"),'w')
-			child_stderr=open(os.path.join(child_dir,"bcltofastq.err"),'w')
-			child_args=[os.path.join(params.bcl2fastq_dir,"configureBclToFastq.pl"),
-				"--input-dir",os.path.join(self.dirname,"Data","Intensities","BaseCalls"),
-				"--positions-format",".clocs",
-				"--sample-sheet",self.sample_sheet,
-				"--output-dir",output_dir,
-				"--mismatches",`mismatches`,
-				"--ignore-missing-bcl",
-				"--ignore-missing-stats",
-				"--no-eamss",
-			]
+		# When reprocessing, convert only the lanes whose samples
+		# changed. The other lanes' files are taken from the previous
+		# conversion when the data files are distributed.
+		# Concurrent conversions (see BclConvertComplex) share
+		# self.sample_sheet, so use a local copy from here on.
+		convert_sheet = sample_sheet or self.sample_sheet
+		lanes = self.ReprocessLanes()
+		if lanes is not None:
+			( convert_sheet, numrows ) = self.WriteLaneSampleSheet( convert_sheet, lanes )
+			if numrows == 0:
+				self.Log(["No changed lanes in sample sheet",sample_sheet or self.sample_sheet,"for run",self.id,", skipping bcl conversion"])
+				if not output_dir:
+					output_dir = os.path.join( self.dirname, "Unaligned" )
+				if not os.path.exists(output_dir):
+					os.makedirs(output_dir)
+				return True
+			self.Log(["Reprocessing only lanes",lanes,"of run",self.id])
+
+		engine = conversion.GetEngine(self)
+		if not output_dir:
+			output_dir = os.path.join( self.dirname, "Unaligned" )
+		if engine.name != 'casava' and not use_bases_mask:
 			# Determine the use_bases_mask. Even during a simple
 			# BCL conversion, if the bar code read length is longer
 			# than required, then Illumina's method for guessing the
 			# mask will fail. Brett Milash, 8/24/2016.
-			if not use_bases_mask:
-				barcode_len,is_dual_index=self.DetermineBarcodeLength()
-				use_bases_mask = self.UseBasesMask(barcode_len,is_dual_index)
-				self.Log(["Using use_bases_mask:",use_bases_mask])
-			if use_bases_mask:
-				child_args.append( "--use-bases-mask" )
-				child_args.append( use_bases_mask )
-			print(" ".join(child_args))
-			p = subprocess.Popen(args=child_args,cwd=child_dir,stdout=child_stdout,stderr=child_stderr)
-			retval = p.wait()
-			child_stdout.close()
-			child_stderr.close()
-		# If configure successful...
-		if retval == 0:
-			# Run make in the Unaligned directory.
-			self.Log(["Running make (to convert bcl files) on run",self.id])
-			child_dir = output_dir
-			child_stdout=open(os.path.join(child_dir,"make.out"),'w')
-			child_stderr=open(os.path.join(child_dir,"make.err"),'w')
-			child_args=["/usr/bin/make","-j","8"]
-			p = subprocess.Popen(args=child_args,cwd=child_dir,stdout=child_stdout,stderr=child_stderr)
-			retval = p.wait()
-			child_stdout.close()
-			child_stderr.close()
-		if retval == 0 and compress_bcls == True:
+			barcode_len,is_dual_index=self.DetermineBarcodeLength()
+			use_bases_mask = self.UseBasesMask(barcode_len,is_dual_index)
+			self.Log(["Using use_bases_mask:",use_bases_mask])
+		self.Log(["Converting run",self.id,"with",engine.name])
+		ok = engine.Convert( convert_sheet, output_dir, use_bases_mask, mismatches, jobs, lanes )
+		if ok and compress_bcls == True:
 			# Compress .bcl files.
 			self.CompressFiles("*.bcl")
-		return retval == 0
+		return ok
 	
+	def ConvertLogName( self, output_dir, suffix ):
+		"""Name of the log file of the bcl conversion program writing
+		output_dir: bcltofastq.out for the usual Unaligned directory,
+		bcltofastq_<dir>.out for others, so concurrent conversions each
+		have their own."""
+		if not output_dir or os.path.basename(output_dir) == "Unaligned":
+			return "bcltofastq.%s" % suffix
+		return "bcltofastq_%s.%s" % ( os.path.basename(output_dir), suffix )
+
+	def SampleSheetLanes( self, sample_sheet ):
+		"""Returns the set of lanes in a sample sheet with an FCID,Lane,...
+		header, or None if it doesn't list any."""
+		lanes = set()
+		lane_column = None
+		ifs = open(sample_sheet)
+		for rec in ifs:
+			f = rec.strip().split(',')
+			if f[0] == 'FCID':
+				if 'Lane' in f:
+					lane_column = f.index('Lane')
+				continue
+			if lane_column is not None and len(f) > lane_column and f[lane_column].isdigit():
+				lanes.add(int(f[lane_column]))
+		ifs.close()
+		return lanes or None
+
+	def UncompressBcls( self, sample_sheet, use_bases_mask=None, keep_gzipped=False, numjobs=8, all_files=False ):
+		"""
+		Uncompresses the compressed bcl files bcl2fastq will read for
+		sample_sheet: only its lanes, and only the cycles the use
+		bases mask doesn't leave out. Files of other lanes and cycles stay
+		compressed, unless all_files is True, for a program that needs
+		every bcl file. With keep_gzipped only zstd files are uncompressed,
+		for a bcl2fastq that reads .bcl.gz files itself. Uncompressed files
+		stay that way until the bcl files are compressed again after
+		conversion, so later conversions of the same run find them ready.
+		Returns True on success.
+		"""
+		# Concurrent conversions take turns, so a file is only
+		# uncompressed once.
+		with self.bcl_lock:
+			basecalls = os.path.join(self.dirname,"Data","Intensities","BaseCalls")
+			lanes = self.SampleSheetLanes(sample_sheet)
+			cycles = self.RunInfo().UsedCycles(use_bases_mask)
+			index = self.Inventory()
+			files = []
+			skipped = 0
+			for fname in index.Files("*.bcl.*", compressed=True, under=basecalls):
+				if keep_gzipped and compress.CodecOf(fname) == 'gzip':
+					continue
+				# Data/Intensities/BaseCalls/L001/C12.1/s_1_1101.bcl.gz
+				m = re.search(r"/L(\d+)/C(\d+)\.\d+/[^/]+$", fname)
+				if m and not all_files and ( ( lanes and int(m.group(1)) not in lanes ) or int(m.group(2)) not in cycles ):
+					skipped += 1
+					continue
+				files.append(fname)
+			if not files:
+				return True
+			self.Log(["Uncompressing",len(files),"bcl files for run",self.id,"leaving",skipped,"of other lanes and cycles compressed"])
+			compressor = self.Compressor( numjobs )
+			ok = compressor.Uncompress( files, [ index.Size(f) for f in files ] )
+			index.Changed( removed=compressor.removed, added=compressor.added )
+			return ok
+
 	def CheckMultiplex( self ):
 		"""Checks if a run contains any barcoded samples or not. Counts
 		the number of samples for each lane on the flow cell, and returns
 		true if any lane has more than one sample."""
-		g = gnomex.GNomExConnection()
-		connection = g.GnConnect(params.db_user,params.db_password,asdict=True)
-		c = connection.cursor()
-		try:
-			query="""select count(*) n
-				from flowcellchannel
-				join sequencelane on sequencelane.idflowcellchannel = flowcellchannel.idflowcellchannel
-				join sample on sample.idsample = sequencelane.idsample
-				where flowcellchannel.filename = '%s' 
-				group by flowcellchannel.filename, flowcellchannel.number""" % self.id
-			c.execute(query)
-		except pymssql.OperationError:
-			print query
-			raise
-
-		results = c.fetchall()
-		connection.close()
-		for rec in results:
-			if rec['n'] > 1:
+		for n in self.Metadata().SamplesPerLane().values():
+			if n > 1:
 				self.Log("Run %s is barcoded."%self.id)
 				return True
 		self.Log("Run %s is not barcoded."%self.id)
@@ -345,29 +472,12 @@ class Run(Emailer,SimultaneousJobRunner):
 	def FindBarcodedLanes( self ):
 		"""Determines which lanes on the flow cell contain barcoded samples. Returns a string
 		with the lane numbers, for example "12348"."""
-		g = gnomex.GNomExConnection()
-		connection = g.GnConnect(params.db_user,params.db_password)
-		c = connection.cursor()
-		try:
-			query="""select flowcellchannel.number, count(*) n
-			from flowcellchannel
-			join sequencelane on sequencelane.idflowcellchannel = flowcellchannel.idflowcellchannel
-			join sample on sample.idsample = sequencelane.idsample
-			where flowcellchannel.filename = '%s'
-			group by flowcellchannel.filename, flowcellchannel.number   
-			order by flowcellchannel.filename, flowcellchannel.number"""%self.id
-
-			c.execute(query)
-		except pymssql.OperationError:
-			print query
-			raise
-
-		results = c.fetchall()
-		connection.close()
+		sample_count = self.Metadata().SamplesPerLane()
+		lanes = sample_count.keys()
+		lanes.sort()
 		barcoded_lanes = ''
-		for rec in results:
-			lane = rec[0]
-			numsamples=rec[1]
+		for lane in lanes:
+			numsamples=sample_count[lane]
 			if numsamples > 1:
 				barcoded_lanes += str(lane)
 		return barcoded_lanes
@@ -423,36 +533,9 @@ class Run(Emailer,SimultaneousJobRunner):
 		if os.path.exists(samplesheet_fname):
 			return samplesheet_fname
 
-		# Select lanes from flow cell that are bar coded.
-		g = gnomex.GNomExConnection()
-		connection = g.GnConnect(params.db_user,params.db_password,asdict=False)
-		c = connection.cursor()
-		try:
-			query = """select flowcell.barcode,
-	flowcellchannel.number,
-	sample.number,
-	genomebuild.genomebuildname,
-	sample.barcodesequence,
-	appuser.firstname, 
-	appuser.lastname,
-	request.number,
-	sample.barcodesequenceb
-from flowcell
-	join flowcellchannel on flowcellchannel.idflowcell=flowcell.idflowcell
-	join sequencelane on sequencelane.idflowcellchannel = 
-		flowcellchannel.idflowcellchannel
-	join sample on sequencelane.idsample = sample.idsample
-	left outer join genomebuild on sequencelane.idgenomebuildalignto = 
-		genomebuild.idgenomebuild
-	join request on sequencelane.idrequest = request.idrequest
-	join appuser on request.idappuser = appuser.idappuser
-where flowcellchannel.filename = '%s'
-order by flowcellchannel.number, sample.number;""" % self.id
-			c.execute(query)
-		except pymssql.OperationError:
-			print query
-			raise
-		results = c.fetchall()
+		# Select the flow cell's samples from GNomEx. Don't trust the
+		# cache here: samples may have been edited since it was filled.
+		results = self.Metadata(fresh=True).SampleSheetRecords()
 		# Open file
 		ofs = open(samplesheet_fname,'w')
 		# Write header.
@@ -522,8 +605,6 @@ order by flowcellchannel.number, sample.number;""" % self.id
 
 		# Close file.
 		ofs.close()
-		# Close database.
-		connection.close()
 		# Return file name.
 		return samplesheet_fname
 
@@ -604,21 +685,10 @@ order by flowcellchannel.number, sample.number;""" % self.id
 		index reads in member variables num_data_reads and
 		num_index_reads. Brett Milash.
 		"""
-		# Parse the RunInfo.xml file.
-		configfile = os.path.join(self.dirname, "RunInfo.xml")
-		doc = xml.dom.minidom.parse(configfile)
-
-		# Get the Read elements from the document.
-		reads=doc.getElementsByTagName("Read")
-
 		# Count the reads that are at least 25 bp long.
-		self.num_data_reads = 0
-		self.num_index_reads = 0
-		for read in reads:
-			if int(read.getAttribute('NumCycles')) >= 25:
-				self.num_data_reads += 1
-			else:
-				self.num_index_reads += 1
+		info = self.RunInfo()
+		self.num_data_reads = info.NumDataReads()
+		self.num_index_reads = info.NumIndexReads()
 
 		if self.num_data_reads == 1:
 			self.IsPaired = False
@@ -829,70 +899,116 @@ WITH_SEQUENCE true
 			sample_info.append( (lane,sample,request, requester) )
 		ifs.close()
 
-		# Construct cat statements to build the result files.
+		# Join each sample's chunks into one file per lane and end.
 		self.DetermineRunType()
+		basename=os.path.join(self.dirname,"Unaligned")
+		# Lanes not converted again during reprocessing reuse the
+		# previous data files, which are already in the repository.
+		merged_lanes = self.MergeUnchangedLanes(basename, sample_info)
+		concatenator = Concatenator()
 		for ( lane, sample, request, requester ) in sample_info:
-			basename=os.path.join(self.dirname,"Unaligned")
+			if lane in merged_lanes:
+				continue
 			dirname=os.path.join(basename,'Project_'+request,'Sample_'+sample)
-			if self.IsPaired:
-				# Paired-end sequencing
-				for end in [ 1, 2 ]:
-					newname = "%s/%s_%s_%d_%d.txt.gz" % ( basename, sample, self.id, lane, end )
-					if os.path.exists(dirname):
-						command = "cat %s/%s_*_L00%d_R%d_*.fastq.gz > %s" % ( dirname, sample, lane, end, newname )
-					else:
-						command = "cat < /dev/null | gzip > %s" % newname
-					self.AddJob( command )
-					self.datafiles.append(newname)
-					self.Log(command)
-			else:
-				# Single-end sequencing.
-				end = 1
-				newname = "%s/%s_%s_%d.txt.gz" % ( basename, sample, self.id, lane )
+			for end in self.Ends():
+				newname = self.DataFileName( basename, sample, lane, end )
 				if os.path.exists(dirname):
-					command = "cat %s/Project_%s/Sample_%s/%s_*_L00%d_R%d_*.fastq.gz > %s" % ( basename, request, sample, sample, lane, end, newname )
+					parts = FindChunks( dirname, sample, lane, end )
 				else:
-					command = "cat < /dev/null | gzip > %s" % newname
-				self.AddJob( command )
+					# No reads: an empty gzip file.
+					parts = []
+				concatenator.AddJob( parts, newname )
 				self.datafiles.append(newname)
-				self.Log(command)
-		retval = self.RunJobs(4,verbose=True)
-
+		retval = concatenator.Run( getattr(params,'concat_threads',4) )
+		# The checksums were computed during the copy. Record them so
+		# GenerateChecksums doesn't read the files again.
+		for ( newname, ( md5, nbytes ) ) in concatenator.results.items():
+			self.checksums[newname] = md5
 		return retval
 
+	def RecordDistributedSampleSheet( self ):
+		"""Copies the sample sheet the data files were made from into
+		Unaligned once they're all in the repository, for lane
+		selective reprocessing."""
+		shutil.copy( self.SampleSheetName(), os.path.join(self.dirname,"Unaligned",DISTRIBUTED_SAMPLESHEET) )
+
+	def Ends( self ):
+		"""Read ends with data files: [ 1, 2 ] for a paired run,
+		[ 1 ] otherwise. DetermineRunType must have been called."""
+		if self.IsPaired:
+			return [ 1, 2 ]
+		return [ 1 ]
+
+	def DataFileName( self, basename, sample, lane, end ):
+		"""Name of the joined gzipped fastq file of a sample, lane and
+		end in directory basename."""
+		if self.IsPaired:
+			return "%s/%s_%s_%d_%d.txt.gz" % ( basename, sample, self.id, lane, end )
+		return "%s/%s_%s_%d.txt.gz" % ( basename, sample, self.id, lane )
+
+	def MergeUnchangedLanes( self, basename, sample_info ):
+		"""
+		During lane selective reprocessing, hard links the data files
+		(and their checksums) and the undetermined index reads of the
+		lanes that weren't converted again from the previous Unaligned
+		directory into basename. These files aren't added to
+		self.datafiles, since the repository already has them. Returns
+		the set of lanes merged.
+		"""
+		lanes = self.ReprocessLanes()
+		if lanes is None:
+			return set()
+		previous = self.PreviousUnaligned()
+		merged = set([ rec[0] for rec in sample_info ]) - set(lanes)
+		for ( lane, sample, request, requester ) in sample_info:
+			if lane not in merged:
+				continue
+			for end in self.Ends():
+				oldname = self.DataFileName( previous, sample, lane, end )
+				newname = self.DataFileName( basename, sample, lane, end )
+				for suffix in [ "", ".md5" ]:
+					if os.path.exists(oldname+suffix) and not distribute.LinkInto( oldname+suffix, basename ):
+						shutil.copy2( oldname+suffix, newname+suffix )
+				md5 = checksums.ReadChecksumFile(newname)
+				if md5:
+					self.checksums[newname] = md5
+		for lane in merged:
+			olddir = os.path.join(previous,"Undetermined_indices","Sample_lane%d"%lane)
+			newdir = os.path.join(basename,"Undetermined_indices","Sample_lane%d"%lane)
+			if os.path.isdir(olddir) and not os.path.exists(newdir):
+				distribute.LinkTree( olddir, newdir )
+		self.Log(["Reused data files of unchanged lanes",sorted(merged),"from",previous])
+		return merged
+
 	def GenerateChecksums( self ):
 		"""
-		Creates a .md5 checksum file for each gzipped fastq file.
+		Creates a .md5 checksum file for each gzipped fastq file,
+		except those whose checksum was already computed while they
+		were written.
 		"""
-		md5files = []
 		# Generate MD5 checksum files for each data file.
 		self.Log(["Generating MD5 checksum files for run",self.id])
+		service = checksums.ChecksumService()
 		for filename in self.datafiles:
-			# Some of the file names may be directories. Copy
-			# them using cp -r. This is the case for requests
-			# from Amplicon Express.
-			if os.path.isdir(filename):
-				pass
-			else:
-				# Generate command.
-				directory=os.path.dirname(filename)
-				fastq_file=os.path.basename(filename)
-				md5file = fastq_file + ".md5"
-				cmd="(cd %s; /usr/bin/md5sum %s > %s)" % ( directory, fastq_file, md5file )
-				self.AddJob( cmd )
-				md5files.append(os.path.join( directory, md5file) )
+			# Some of the file names may be directories. This is
+			# the case for requests from Amplicon Express.
+			if not os.path.isdir(filename) and filename not in self.checksums:
+				service.AddFile(filename)
+		# Reap any finished child processes left behind by earlier
+		# stages, so a later RunJobs doesn't collect them.
 		cleared = False
 		while not cleared:
 			try:
 				(pid,jobexitstatus) = os.waitpid(-1,os.P_WAIT)
 			except:
 				cleared = True
-		self.RunJobs(5,verbose=True)
+		retval = service.Run( getattr(params,'checksum_threads',5) )
+		self.checksums.update( service.results )
 		# Add the md5 checksum files to the list of data files
 		# to be distributed.
+		md5files = [ filename + ".md5" for filename in self.datafiles if filename in self.checksums ]
 		self.datafiles += md5files
-		return True
-
+		return retval
 
 	def DistributeDemultiplexed_18( self ):
 		# CASAVA 1.8 creates many gzipped fastq files per sample.
@@ -902,6 +1018,7 @@ WITH_SEQUENCE true
 			if self.GenerateChecksums():
 				# Copy data files.
 				if self.CopyDataFiles():
+					self.RecordDistributedSampleSheet()
 					# Notify that run is complete.
 					self.NotifyComplete('')
 					return True
@@ -972,16 +1089,7 @@ WITH_SEQUENCE true
 		self.Log(["Renaming data files for run",self.id])
 		self.DetermineRunType()
 		# Get list of sample names and their lanes.
-		query = """select sample.number samplenum, flowcellchannel.number lanenum
-	from flowcellchannel
-	join sequencelane on sequencelane.idflowcellchannel = flowcellchannel.idflowcellchannel
-	join sample on sample.idsample = sequencelane.idsample
-	where flowcellchannel.filename = '%s'""" % self.id
-		g = gnomex.GNomExConnection()
-		connection = g.GnConnect(params.db_user,params.db_password)
-		c = connection.cursor()
-		c.execute(query)
-		results = c.fetchall()
+		results = [ ( s['sample'], s['lane'] ) for s in self.Metadata().samples ]
 		# Build mapping from s_<lane>_[<end>_]sequence.txt files to <sample>_<run>_<lane>.txt files.
 		gerald_dir = self.FindGeraldDirectory(gerald_parent_dir)
 		self.Log(["RenameDataFiles: gerald_parent_dir = %s, gerald_dir = %s." % ( gerald_parent_dir, gerald_dir )])
@@ -1054,18 +1162,7 @@ WITH_SEQUENCE true
 	def CopyDataFiles( self ):
 		"""Copies data files from a run to the directories accessed by GNomEx."""
 		# Get list of sample numbers, their request numbers, and the year of the request.
-		query = """select distinct sample.number samplenum, request.number reqnum, request.createDate reqdate
-		from flowcellchannel
-		join sequencelane on sequencelane.idflowcellchannel = flowcellchannel.idflowcellchannel
-		join sample on sample.idsample = sequencelane.idsample
-		join request on sample.idrequest = request.idrequest
-		where flowcellchannel.filename = '%s'""" % self.id
-
-		g = gnomex.GNomExConnection()
-		connection = g.GnConnect(params.db_user,params.db_password,asdict=True)
-		c = connection.cursor()
-		c.execute(query)
-		results = c.fetchall()
+		results = self.Metadata().SampleRequests()
 		# Set the umask so the files are world readable (and directories are
 		# readable and executable).
 		os.umask(002)
@@ -1092,36 +1189,62 @@ WITH_SEQUENCE true
 			else:
 				self.Log(["Result directory",resultdir,"already exists."])
 
-		# Set up list of copy commands.
+		# Files are hard linked or reflinked into the repository when
+		# it shares a file system with the run folder, and copied
+		# otherwise. params.distribution_mode 'copy' always copies.
+		link = getattr(params,'distribution_mode','link') == 'link'
+		self.linked = 0
+		copier = distribute.Copier( max_inflight_bytes=getattr(params,'copy_inflight_bytes',8*1024**3),
+			reread=getattr(params,'copy_reread',False) )
+
 		for filename in self.datafiles:
 			# Some of the file names may be directories. Copy
-			# them using cp -r. This is the case for requests
+			# them recursively. This is the case for requests
 			# from Amplicon Express.
 			if os.path.isdir(filename):
 				request_num = os.path.basename(filename).split('_')[-1]
 				try:
 					resultdir = result_directory[request_num]
-					self.Log(["Copying",filename,"to",resultdir])
-					#self.AddJob("/bin/cp -r " + filename + " " +resultdir)
-					self.AddJob("/usr/bin/rsync " + filename + " " +resultdir)
 				except KeyError:
 					self.Log(["WARNING - request",request_num,"produced a data directory, but not found in database. Unable to copy file to result directory."])
+					continue
+				self.Log(["Copying",filename,"to",resultdir])
+				parent = os.path.dirname(filename)
+				for ( dirpath, dirnames, filenames ) in os.walk(filename):
+					destdir = os.path.join( resultdir, os.path.relpath( dirpath, parent ) )
+					if not os.path.exists(destdir):
+						os.makedirs(destdir)
+					for name in filenames:
+						self.PlaceFile( os.path.join(dirpath,name), destdir, copier, link )
 			else:
 				# Regular file, not a directory.
 				sample_num = os.path.basename(filename).split('_')[0]
 				try:
 					resultdir = result_directory[sample_num]
-					self.Log(["Copying",filename,"to",resultdir])
-					# This command will loop until file is copied successfully. Brett Milash 8/6/2013.
-					if filename.endswith(".gz"):
-						self.AddJob( "until /bin/gunzip -c %s/%s > /dev/null; do /usr/bin/rsync %s %s; done" % ( resultdir, os.path.basename(filename), filename, resultdir ) )
-					else:
-						self.AddJob("/bin/cp " + filename + " " +resultdir)
 				except KeyError:
 					self.Log(["WARNING - sample",sample_num,"produced a data file, but not found in database. Unable to copy file to result directory."])
-		self.RunJobs(6,verbose=True)
+					continue
+				self.PlaceFile( filename, resultdir, copier, link )
+		if self.linked:
+			self.Log(["Linked",self.linked,"data files of run",self.id,"into the repository."])
+		return copier.Run( getattr(params,'copy_threads',6) )
 
-		return True
+	def PlaceFile( self, filename, resultdir, copier, link=True ):
+		"""
+		Puts one data file into a repository directory: by hard link
+		or reflink if link is True and the file system allows it,
+		otherwise by adding a verified copy to copier. Copies are
+		checked against the file's checksum when one was made.
+		"""
+		if link:
+			how = distribute.LinkInto( filename, resultdir )
+			if how:
+				self.Log(["Placed",filename,"in",resultdir,"by",how])
+				self.linked += 1
+				return
+		self.Log(["Copying",filename,"to",resultdir])
+		known_md5 = self.checksums.get(filename) or checksums.ReadChecksumFile(filename)
+		copier.AddJob( filename, os.path.join( resultdir, os.path.basename(filename) ), known_md5 )
 
 	def NotifyStarting( self ):
 		"""Sends an email that the pipeline software is starting."""
@@ -1247,8 +1370,8 @@ WITH_SEQUENCE true
 		for filehandle in ofs.values():
 			filehandle.close()
 
-		# Process each sample sheet.
-		retvals = []
+		# Work out each sample sheet's conversion.
+		groups = []
 		self.DetermineRunType()
 		for (barcode_len, fname, is_dual_index) in samplesheets:
 			# Determine the number of mismatches to allow.
@@ -1267,7 +1390,7 @@ WITH_SEQUENCE true
 			sample_sheet_full_path=os.path.join(self.dirname,"Data","Intensities","BaseCalls",fname)
 			outdir = os.path.join(self.dirname,"Unaligned_%d" % barcode_len)
 			self.output_dirs.append( outdir )
-			self.Log(["Starting bcl conversion, barcode length",barcode_len,", sample sheet", sample_sheet_full_path,", output dir", outdir])
+			self.Log(["Bcl conversion, barcode length",barcode_len,", sample sheet", sample_sheet_full_path,", output dir", outdir])
 
 
 			# If lane has dual index, recalculate the barcode_len
@@ -1291,13 +1414,67 @@ WITH_SEQUENCE true
 			#	else:
 			#		use_bases_mask = "Y*n,n*"
 			use_bases_mask = self.UseBasesMask( barcode_len, is_dual_index )
-			result = self.BclConvert( sample_sheet_full_path, outdir, use_bases_mask, compress_bcls=False, mismatches=num_mismatches )
-			retvals.append( result )
+			groups.append( ( barcode_len, sample_sheet_full_path, outdir, use_bases_mask, num_mismatches ) )
+
+		# Run the conversions at the same time, at most
+		# params.bcl_convert_max_groups at once (to bound the load on
+		# the disks), biggest first. Each one, when it starts, gets a
+		# share of the free cores in proportion to its work (lanes x
+		# tiles x cycles read) among the conversions that can run
+		# alongside it, and gives them back when it's done.
+		cores = getattr(params,'bcl_convert_cores',None) or multiprocessing.cpu_count()
+		max_groups = max( 1, getattr(params,'bcl_convert_max_groups',4) )
+		tiles = self.RunInfo().TilesPerLane() or 1
+		weights = []
+		for ( barcode_len, sample_sheet_full_path, outdir, use_bases_mask, num_mismatches ) in groups:
+			lanes = self.SampleSheetLanes( sample_sheet_full_path ) or [ 1 ]
+			weights.append( len(lanes) * tiles * len(self.RunInfo().UsedCycles(use_bases_mask)) )
+		order = sorted( range(len(groups)), key=lambda i: -weights[i] )
+		waiting = list( order )
+		pool = { 'free': cores, 'running': 0 }
+		condition = threading.Condition()
+		def TakeCores( i ):
+			"""Waits for conversion i's turn and a free slot. Returns its
+			share of the free cores."""
+			with condition:
+				while pool['running'] >= max_groups or waiting[0] != i:
+					condition.wait()
+				alongside = waiting[:max_groups-pool['running']]
+				del waiting[0]
+				share = PartitionCores( [ weights[j] for j in alongside ], max( pool['free'], 0 ) )[0]
+				pool['free'] -= share
+				pool['running'] += 1
+				return share
+		def GiveCores( share ):
+			with condition:
+				pool['free'] += share
+				pool['running'] -= 1
+				condition.notify_all()
+		results = {}
+		def Convert( i ):
+			( barcode_len, sample_sheet_full_path, outdir, use_bases_mask, num_mismatches ) = groups[i]
+			jobs = TakeCores( i )
+			try:
+				self.Log(["Converting samples with barcode length", barcode_len, "with", jobs, "jobs"])
+				try:
+					result = self.BclConvert( sample_sheet_full_path, outdir, use_bases_mask, compress_bcls=False, mismatches=num_mismatches, jobs=jobs )
+				except Exception, e:
+					self.Log(["PROBLEM! Bcl conversion of samples with barcode length", barcode_len, "raised", e])
+					result = False
+			finally:
+				GiveCores( jobs )
+			results[i] = result
 			if not result:
 				self.Log(["Bcl conversion of samples with barcode length", barcode_len, "failed."])
-				break
 			else:
 				self.Log(["Bcl conversion of samples with barcode length", barcode_len, "succeeded."])
+		threads = [ threading.Thread( target=Convert, args=(i,) ) for i in order ]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		retvals = [ results.get(i,False) for i in range(len(groups)) ]
+
 		# A side effect of calling BclConvert() is to replace
 		# self.sample_sheet with one of the barcode-length-specific
 		# sample sheets. This causes the problem when running the QC
@@ -1313,55 +1490,19 @@ WITH_SEQUENCE true
 		return min(retvals)
 
 	def MergeBclConversions( self ):
-		"""Combines results of multiple Bcl conversions (due to different length barcodes) into a single directory."""
-		# Check if "Unaligned" directory exists. If not, create it.
+		"""Combines results of multiple Bcl conversions (due to different
+		length barcodes) into a single directory. Every move is planned,
+		and checked for conflicts, before any is made (see merge)."""
 		unaligned_dir = os.path.join(self.dirname, "Unaligned")
-		if not os.path.exists( unaligned_dir ):
-			os.mkdir( unaligned_dir )
-		# Check if Undetermined_indices directory exists. If not, 
-		# create it.
-		undetermined_dir = os.path.join( unaligned_dir, "Undetermined_indices" )
-		if not os.path.exists( undetermined_dir ):
-			os.mkdir( undetermined_dir )
-
-		# Process each output directory created during Bcl file conversion.
 		if not self.output_dirs:
 			# Find the output directories.
-			for file in os.listdir(self.dirname):
+			for file in sorted(os.listdir(self.dirname)):
 				if file[0:10] == 'Unaligned_':
 					self.output_dirs.append(file)
-		for outputdir in self.output_dirs:
-			outputdir = os.path.join(self.dirname,outputdir)
-			# Get list of files in outputdir. Move any named "Project_*" 
-			# to the unaligned directory.
-			pattern = "Project_.*"
-			for file in os.listdir( outputdir ):
-				if re.match(pattern,file):
-					try:
-						os.rename( os.path.join( outputdir, file ), os.path.join( unaligned_dir, file ) )
-					except OSError:
-						# Problem! Folder already exists, probably from another lane.
-						# mv Unaligned_%d/Project_?/Sample_* Unaligned/Project_?
-						self.Log("Unaligned/%s directory already exists. Moving sample directories." % file)
-						command="mv %s/%s/Sample_* %s/%s" % ( outputdir, file, unaligned_dir, file )
-						self.Log(command)
-						os.system(command)
-
-						#message = "Problem! OSError generated trying to move %s from %s to %s." % ( file,outputdir,unaligned_dir)
-						#self.Log( message )
-						#self.Notify("Problem with flow cell processing for " + self.dirname, message )
-
-			# Look for directories containing bad barcode reads. 
-			# These are used by the QC report. If any found, move 
-			# to the undetermined indices directory.
-			bad_barcodes_dir = os.path.join( outputdir, "Undetermined_indices" )
-			if os.path.exists( bad_barcodes_dir ):
-				pattern = "Sample_lane.*"
-				for file in os.listdir( bad_barcodes_dir ):
-					if re.match(pattern,file):
-						os.rename( os.path.join( bad_barcodes_dir, file ), os.path.join( undetermined_dir, file ) )
-				
-		return True
+		output_dirs = [ os.path.join(self.dirname,outputdir) for outputdir in self.output_dirs ]
+		plan = merge.MergePlan( self.dirname, output_dirs, unaligned_dir )
+		self.Log(["Merging", len(output_dirs), "bcl conversions of run", self.id, "into", unaligned_dir, "with", len(plan.moves), "moves"])
+		return plan.Execute( getattr(params,'merge_threads',8) )
 
 	def Qc_18( self ):
 		"""Runs a barcode QC report on a flowcell for pipeline version
@@ -1430,7 +1571,7 @@ WITH_SEQUENCE true
 			lanes = self.FindQcLanes()
 
 			# Generate the report.
-			import EvaluateIndexing
+			import evaluateindexing as EvaluateIndexing
 			outputfile=os.path.join(self.dirname,"barcode_report_%s.xls"% self.id )
 			self.Log(["About to run qc report for",self.id,"lanes",`lanes`,"writing to",outputfile])
 			EvaluateIndexing.RunReport( self.dirname, outputfile, pipeline_version, lanes )
@@ -1444,14 +1585,11 @@ WITH_SEQUENCE true
 			# hiseq 2000 run.
 			if barcode[0] in ['A','B']:
 				barcode = barcode[1:]
-			g = gnomex.GNomExConnection()
-			connection = g.GnConnect(params.db_user,params.db_password,asdict=True)
-			c = connection.cursor()
-			c.execute("select number, createdate from flowcell where barcode = %s", barcode)
-			results = c.fetchall()
-			connection.close()
-			fcnumber=results[0]["number"]
-			fcdate=results[0]["createdate"]
+			flowcell = self.Metadata().Flowcell()
+			if flowcell is None:
+				results = self.Query( 'flowcell_by_barcode', (barcode,) )
+				flowcell = results[0]
+			(fcnumber,fcdate) = flowcell
 			fcyear = str(fcdate.year)
 			flowcelldatadir=os.path.join(params.repository_root_dir,"FlowCellData",fcyear,fcnumber)
 
@@ -1470,31 +1608,55 @@ WITH_SEQUENCE true
 			self.Log(["PROBLEM! Can't generate/send QC report."])
 			raise
 
+	def Inventory( self ):
+		"""
+		Returns the inventory.RunInventory of the run folder's files,
+		shared by the stages that compress, uncompress and remove files
+		instead of each walking the tree with find.
+		"""
+		return inventory.GetInventory(self.dirname)
+
 	def RunShellCommand( self, command, pattern, numjobs=8 ):
 		"""Runs command on all files matching pattern. Runs in 
 		parallel numjobs at a time, defaults to 8 concurrent jobs."""
 
 		self.Log(["Running command", command, "on files matching pattern",pattern,"from run",self.id])
-		cmd = '/usr/bin/find %s -name "%s" -print' % ( self.dirname, pattern )
-		child_dir = self.dirname
-		child_stderr=open(os.path.join(child_dir,"find.err"),'a')
-		p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout
-		for rec in p:
-			fname = rec.strip()
+		for fname in self.Inventory().Files( pattern ):
 			cmd = "%s '%s'" % (command,fname)
 			self.AddJob(cmd)
-		p.close()
 		self.RunJobs(numjobs,verbose=True)
 
+	def Compressor( self, numjobs ):
+		"""Returns a compress.Compressor for the run folder, with the
+		codec and level in pipelineparams."""
+		return compress.Compressor( self.dirname,
+			codec=getattr(params,'compression_codec','gzip'),
+			level=getattr(params,'compression_level',None),
+			processes=getattr(params,'compression_processes',numjobs) )
+
 	def CompressFiles( self, pattern, numjobs=8 ):
 		"""Compresses files under run folder that match the given pattern."""
 		self.Log(["Compressing files matching",pattern,"from run",self.id])
-		self.RunShellCommand("/bin/gzip -f", pattern, numjobs )
-
-	def UncompressFiles( self, pattern, numjobs=8 ):
-		"""Unompresses files under run folder that match the given pattern."""
+		index = self.Inventory()
+		files = index.Files( pattern, compressed=False )
+		compressor = self.Compressor( numjobs )
+		ok = compressor.Compress( files, [ index.Size(f) for f in files ] )
+		index.Changed( removed=compressor.removed, added=compressor.added )
+		return ok
+
+	def UncompressFiles( self, pattern, numjobs=8, exclude=None ):
+		"""Unompresses files under run folder that match the given pattern.
+		Files in top level directories whose names match the pattern
+		exclude are left alone."""
 		self.Log(["Uncompressing files matching",pattern,"from run",self.id])
-		self.RunShellCommand("/bin/gunzip", pattern, numjobs )
+		index = self.Inventory()
+		files = index.Files( pattern, compressed=True )
+		if exclude:
+			files = [ f for f in files if not fnmatch.fnmatch( os.path.relpath(f,self.dirname).split(os.sep)[0], exclude ) ]
+		compressor = self.Compressor( numjobs )
+		ok = compressor.Uncompress( files, [ index.Size(f) for f in files ] )
+		index.Changed( removed=compressor.removed, added=compressor.added )
+		return ok
 	
 
 	def Cleanup( self ):
@@ -1503,14 +1665,17 @@ WITH_SEQUENCE true
 		self.Log(["Cleaning up run",self.id])
 		# Remove qseq files.
 		self.Log(["Removing qseq files from run",self.id])
-		child_dir = self.dirname
-		child_stdout=open(os.path.join(child_dir,"find.out"),'a')
-		child_stderr=open(os.path.join(child_dir,"find.err"),'a')
-		child_args=["find",self.dirname,"-name","*qseq.txt","-delete"]
-		p = subprocess.Popen(args=child_args,cwd=child_dir,stdout=child_stdout,stderr=child_stderr)
-		retval = p.wait()
-		child_stdout.close()
-		child_stderr.close()
+		retval = 0
+		removed = []
+		index = self.Inventory()
+		for fname in index.Files("*qseq.txt"):
+			try:
+				os.unlink(fname)
+				removed.append(fname)
+			except OSError, e:
+				self.Log(["PROBLEM! Can't remove",fname,":",e])
+				retval = 1
+		index.Changed( removed=removed )
 
 		# Compress .bcl files.
 		# Now doing this right after BCL to QSEQ conversion.
@@ -1541,7 +1706,11 @@ WITH_SEQUENCE true
 		return os.path.join(self.dirname,"Data","Intensities","BaseCalls","created_samplesheet.csv")
 
 	def Reprocess( self ):
-		"""Uncompress bcl and txt files so run can be processed again from the beginning."""
+		"""Uncompress txt and control files so run can be processed again
+		from the beginning. bcl files are uncompressed by BclConvert, only
+		those of the lanes and cycles being converted. The Unaligned
+		directory is kept as Unaligned.N, so lanes whose samples didn't
+		change can reuse its data files (see ReprocessLanes)."""
 		self.Log(["Reprocessing run", self.id, "run directory", self.dirname])
 		# Remove the sample sheet file, to force one to be regenerated.
 		#samplesheet_fname = self.SampleSheetName()
@@ -1563,31 +1732,123 @@ WITH_SEQUENCE true
 			self.Log(["Renaming",unaligned_dir,"to",newname])
 			os.rename(unaligned_dir,newname)
 
-		# Uncompress the bcl files.
-		flowcell = self.FlowCellVersion()
-		if flowcell == "HiSeq Flow Cell v3":
-			self.UncompressFiles("*.bcl.gz")
-		# Uncompress the txt files.
-		self.UncompressFiles("*.txt.gz")
+		# Uncompress the txt files. The data files of earlier
+		# conversions stay compressed, for reuse by unchanged lanes.
+		self.UncompressFiles("*.txt.*", exclude="Unaligned*")
 		# Uncompress the control files.
-		self.UncompressFiles("*.control.gz")
+		self.UncompressFiles("*.control.*")
 		return True
-	
+
+	def SampleSheetRows( self, sample_sheet ):
+		"""Returns the rows of a sample sheet with an FCID,Lane,...
+		header, as a dictionary of sorted lists of rows indexed by lane."""
+		rows = {}
+		ifs = open(sample_sheet)
+		for rec in ifs:
+			f = rec.strip().split(',')
+			if f[0] == 'FCID' or len(f) < 2 or not f[1].isdigit():
+				continue
+			rows.setdefault(int(f[1]),[]).append(tuple(f))
+		ifs.close()
+		for lane in rows:
+			rows[lane].sort()
+		return rows
+
+	def PreviousUnaligned( self ):
+		"""
+		Returns the most recent Unaligned.N directory left by Reprocess
+		whose data files were distributed (it has the sample sheet they
+		were made from), or None.
+		"""
+		previous = None
+		highest = 0
+		for name in os.listdir(self.dirname):
+			m = re.match(r"Unaligned\.(\d+)$", name)
+			if m and int(m.group(1)) > highest and os.path.exists(os.path.join(self.dirname,name,DISTRIBUTED_SAMPLESHEET)):
+				previous = os.path.join(self.dirname,name)
+				highest = int(m.group(1))
+		return previous
+
+	def ReprocessLanes( self ):
+		"""
+		For a run being reprocessed, compares the sample sheet with the
+		one the previous conversion's data files were made from. Returns
+		the sorted list of lanes whose samples changed, to be converted
+		again; the other lanes' data files are reused. Returns None if
+		every lane must be converted: the run wasn't converted before,
+		no lane or every lane changed, or params.lane_selective_reprocess
+		is False. A lane whose previous data files are missing counts as
+		changed.
+		"""
+		if not getattr(params,'lane_selective_reprocess',True):
+			return None
+		previous = self.PreviousUnaligned()
+		if previous is None:
+			return None
+		old_rows = self.SampleSheetRows(os.path.join(previous,DISTRIBUTED_SAMPLESHEET))
+		new_rows = self.SampleSheetRows(self.SampleSheetName())
+		changed = set([ lane for lane in set(old_rows) | set(new_rows) if old_rows.get(lane) != new_rows.get(lane) ])
+		self.DetermineRunType()
+		for lane in set(new_rows) - changed:
+			for f in new_rows[lane]:
+				for end in self.Ends():
+					if not os.path.exists(self.DataFileName(previous,f[2],lane,end)):
+						changed.add(lane)
+		if not changed or set(new_rows) <= changed:
+			return None
+		return sorted(changed & set(new_rows))
+
+	def WriteLaneSampleSheet( self, sample_sheet, lanes ):
+		"""Writes a copy of sample_sheet with only the rows of the given
+		lanes. Returns its name and the number of rows."""
+		fname = re.sub(".csv$","_lanes.csv",sample_sheet)
+		numrows = 0
+		ifs = open(sample_sheet)
+		ofs = open(fname,'w')
+		for rec in ifs:
+			f = rec.strip().split(',')
+			if f[0] == 'FCID' or ( len(f) > 1 and f[1].isdigit() and int(f[1]) in lanes ):
+				ofs.write(rec)
+				if f[0] != 'FCID':
+					numrows += 1
+		ofs.close()
+		ifs.close()
+		return ( fname, numrows )
+
+	def TilesOption( self, lanes ):
+		"""configureBclToFastq.pl --tiles value selecting whole lanes."""
+		return ','.join([ "s_%d" % lane for lane in lanes ])
+
 	def CheckIfMiseq( self ):
 		"""
 		Checks if run is from a Miseq sequencer.
 		"""
 		#self.Log("Checking if run %s is a miseq run." % self.id)
-		configfile = os.path.join(self.dirname, "RunInfo.xml")
-		doc = xml.dom.minidom.parse(configfile)
-		e=doc.getElementsByTagName("Instrument")[0]
-		instrument=e.firstChild.nodeValue
+		instrument = self.RunInfo().instrument
 		is_miseq = instrument in params.miseq_ids
 		if is_miseq:
 			self.Log("Run %s is a miseq run." % self.id )
 		#else:
 		#	self.Log("Run %s is a hiseq run." % self.id )
 		return is_miseq
+
+	def PcrDemultiplexer( self, index_read, nmer_read ):
+		"""
+		Returns the pcrdemux.PcrDemultiplexer that demultiplexes this
+		Patch or Kappa PCR run straight from its bcl files, if
+		params.pcr_demultiplexer is 'numpy' and the run's samples allow
+		it, or None to use bcl2fastq and postprocessing. index_read and
+		nmer_read number the reads from 0.
+		"""
+		if getattr(params,'pcr_demultiplexer','bcl2fastq') != 'numpy':
+			return None
+		demultiplexer = pcrdemux.PcrDemultiplexer( self.dirname, self.id, self.SampleSheetName(), index_read, nmer_read,
+			os.path.join( self.dirname, "Unaligned" ) )
+		problem = demultiplexer.Problem()
+		if problem:
+			self.Log(["Using bcl2fastq for run",self.id,"instead of demultiplexing it directly:",problem])
+			return None
+		return demultiplexer
 	
 
 	
@@ -0,0 +1,194 @@
+"""
+runinfo.py - the sequencer's description of a run folder, from its
+RunInfo.xml (reads, instrument, flow cell layout) and runParameters.xml
+(flow cell version) files. Each file is parsed once with a streaming
+parser, and the result kept until the file's modification time or size
+changes, so the many run state methods that need the read structure
+don't reparse the XML every time.
+"""
+import os
+import re
+import collections
+import xml.etree.cElementTree as ElementTree
+
+# Reads of at least this many cycles are data reads, shorter ones are
+# index reads, for deciding whether a run is single or paired end.
+MIN_DATA_READ_CYCLES = 25
+
+# One read of the run as listed in RunInfo.xml. is_index comes from the
+# IsIndexedRead attribute.
+Read = collections.namedtuple( 'Read', [ 'number', 'cycles', 'is_index' ] )
+
+class RunInfo:
+	"""
+	Contents of a run folder's RunInfo.xml and runParameters.xml.
+	Attributes: run_id, run_number, instrument, flowcell_id, reads (list
+	of Read), lane_count, surface_count, swath_count, tile_count,
+	flowcell_version (None if there is no runParameters.xml or it doesn't
+	name one).
+	"""
+	def __init__( self, run_dir ):
+		self.run_dir = run_dir
+		self.run_id = None
+		self.run_number = None
+		self.instrument = None
+		self.flowcell_id = None
+		self.reads = []
+		self.lane_count = None
+		self.surface_count = None
+		self.swath_count = None
+		self.tile_count = None
+		self.flowcell_version = None
+
+	def ParseRunInfo( self, filename ):
+		for ( event, e ) in ElementTree.iterparse( filename ):
+			if e.tag == 'Read':
+				self.reads.append( Read( int(e.get('Number',len(self.reads)+1)), int(e.get('NumCycles')),
+					e.get('IsIndexedRead') == 'Y' ) )
+			elif e.tag == 'Run':
+				self.run_id = e.get('Id')
+				self.run_number = e.get('Number')
+			elif e.tag == 'Instrument':
+				self.instrument = (e.text or '').strip()
+			elif e.tag == 'Flowcell':
+				self.flowcell_id = (e.text or '').strip()
+			elif e.tag == 'FlowcellLayout':
+				self.lane_count = int(e.get('LaneCount'))
+				self.surface_count = int(e.get('SurfaceCount',1))
+				self.swath_count = int(e.get('SwathCount',1))
+				self.tile_count = int(e.get('TileCount',1))
+			e.clear()
+
+	def ParseRunParameters( self, filename ):
+		for ( event, e ) in ElementTree.iterparse( filename ):
+			if e.tag == 'Flowcell' and self.flowcell_version is None:
+				self.flowcell_version = (e.text or '').strip()
+			e.clear()
+
+	def ReadLengths( self ):
+		"""Tuple of the number of cycles of each read."""
+		return tuple([ read.cycles for read in self.reads ])
+
+	def DataReads( self ):
+		"""Reads long enough to be data reads."""
+		return [ read for read in self.reads if read.cycles >= MIN_DATA_READ_CYCLES ]
+
+	def IndexLengths( self ):
+		"""Tuple of the number of cycles of each index read."""
+		return tuple([ read.cycles for read in self.reads if read.cycles < MIN_DATA_READ_CYCLES ])
+
+	def NumDataReads( self ):
+		return len(self.DataReads())
+
+	def NumIndexReads( self ):
+		return len(self.IndexLengths())
+
+	def DataCycles( self ):
+		"""Number of bases sequenced per cluster in the reads RunInfo.xml
+		doesn't mark as index reads."""
+		return sum([ read.cycles for read in self.reads if not read.is_index ])
+
+	def TilesPerLane( self ):
+		"""Number of tiles imaged in each lane, or None if RunInfo.xml
+		has no FlowcellLayout element."""
+		if self.tile_count is None:
+			return None
+		return self.surface_count * self.swath_count * self.tile_count
+
+	def UsedCycles( self, use_bases_mask=None ):
+		"""
+		Returns the set of cycle numbers (from 1) bcl2fastq reads with
+		the given --use-bases-mask, like "Y*,I6n*,Y*": cycles masked
+		with n are left out. All cycles if there's no mask, or it can't
+		be matched up with the reads.
+		"""
+		cycles = set()
+		first = 1
+		masks = use_bases_mask.split(',') if use_bases_mask else []
+		for ( i, read ) in enumerate( self.reads ):
+			mask = masks[i] if i < len(masks) else None
+			used = MaskRead( mask, read.cycles )
+			if used is None:
+				used = [ True ] * read.cycles
+			for j in range( read.cycles ):
+				if used[j]:
+					cycles.add( first + j )
+			first += read.cycles
+		return cycles
+
+def MaskRead( mask, length ):
+	"""
+	Expands one read's element of a use bases mask into a list of
+	length flags, True for each cycle used. Returns None if mask is None
+	or doesn't fit the read.
+	"""
+	if mask is None:
+		return None
+	tokens = re.findall( r"([YINyin])(\d+|\*)?", mask )
+	if ''.join([ c + ( n or '' ) for ( c, n ) in tokens ]) != mask:
+		return None
+	explicit = sum([ int(n) if n.isdigit() else 1 for ( c, n ) in tokens if n != '*' ])
+	stars = len([ 1 for ( c, n ) in tokens if n == '*' ])
+	if stars > 1 or explicit > length:
+		return None
+	used = []
+	for ( c, n ) in tokens:
+		if n == '*':
+			count = length - explicit
+		elif n:
+			count = int(n)
+		else:
+			count = 1
+		used.extend( [ c.lower() != 'n' ] * count )
+	if len(used) != length:
+		return None
+	return used
+
+# Parsed files indexed by run folder: ( file stamps, RunInfo object ).
+cache = {}
+
+def Prune( run_dirs ):
+	"""Drops the cached files of run folders other than run_dirs, so a
+	long running process doesn't keep every run it ever saw."""
+	keep = set( run_dirs )
+	for run_dir in cache.keys():
+		if run_dir not in keep:
+			del cache[run_dir]
+
+def FileStamp( filename ):
+	"""( mtime, size ) of a file, or None if it doesn't exist."""
+	try:
+		s = os.stat(filename)
+	except OSError:
+		return None
+	return ( s.st_mtime, s.st_size )
+
+def RunParametersFile( run_dir ):
+	"""Name of the run parameters file. Newer instruments capitalize it."""
+	for name in [ "runParameters.xml", "RunParameters.xml" ]:
+		filename = os.path.join( run_dir, name )
+		if os.path.exists(filename):
+			return filename
+	return os.path.join( run_dir, "runParameters.xml" )
+
+def GetRunInfo( run_dir ):
+	"""
+	Returns the RunInfo object for a run folder, parsing its XML files
+	only if they changed since the last call. Raises IOError if the
+	folder has no RunInfo.xml.
+	"""
+	runinfo_file = os.path.join( run_dir, "RunInfo.xml" )
+	parameters_file = RunParametersFile( run_dir )
+	stamps = ( FileStamp(runinfo_file), FileStamp(parameters_file) )
+	try:
+		( cached_stamps, info ) = cache[run_dir]
+		if cached_stamps == stamps:
+			return info
+	except KeyError:
+		pass
+	info = RunInfo( run_dir )
+	info.ParseRunInfo( runinfo_file )
+	if stamps[1] is not None:
+		info.ParseRunParameters( parameters_file )
+	cache[run_dir] = ( stamps, info )
+	return info
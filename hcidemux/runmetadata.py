@@ -0,0 +1,249 @@
+"""
+runmetadata.py - GNomEx information about sequencing runs. The pipeline
+fetches it for every active run with a few set-based queries at the start
+of a cycle, and the run state methods read from that snapshot instead of
+querying GNomEx themselves. RunMetadataCache keeps recent answers in the
+pipeline's sqlite database so unchanged runs don't go back to GNomEx
+every cycle.
+"""
+import time
+import sqlite3
+import cPickle as pickle
+
+import gnomex
+import queries
+from states import States
+import pipelineparams as params
+from logger import Logger
+
+class RunMetadata:
+	"""
+	GNomEx information about one run folder: its flow cell channels
+	(lanes), the samples sequenced in them, the sequencing applications
+	used, and the core facility that owns the flow cell.
+	"""
+	def __init__( self, run_id ):
+		self.id = run_id
+		# One dictionary per flowcellchannel registered with this
+		# run folder name. Keys: lane, flowcell_barcode,
+		# flowcell_number, flowcell_createdate, facilityname.
+		self.channels = []
+		# One dictionary per sequence lane, ordered by lane and
+		# sample number. Keys: lane, flowcell_barcode, sample,
+		# genome, barcode, barcode_b, firstname, lastname, request,
+		# sample_request, sample_request_date. Values are None
+		# where the original queries would have found no match.
+		self.samples = []
+		# Distinct sequencing application names.
+		self.applications = []
+
+	def NumLanes( self ):
+		"""Number of flow cell channels registered for the run."""
+		return len(self.channels)
+
+	def CoreFacilityName( self ):
+		"""Name of the core facility that started the run, or None."""
+		for channel in self.channels:
+			if channel['facilityname']:
+				return channel['facilityname']
+		return None
+
+	def Flowcell( self ):
+		"""Returns ( flowcell number, create date ) or None if unknown."""
+		for channel in self.channels:
+			if channel['flowcell_number']:
+				return ( channel['flowcell_number'], channel['flowcell_createdate'] )
+		return None
+
+	def HasApplication( self, name ):
+		"""True if any sample on the run uses an application whose
+		name contains name (case insensitive, like SQL Server)."""
+		name = name.lower()
+		for application in self.applications:
+			if application and application.lower().find(name) > -1:
+				return True
+		return False
+
+	def SamplesPerLane( self ):
+		"""Dictionary of the number of samples indexed by lane."""
+		counts = {}
+		for s in self.samples:
+			counts[s['lane']] = counts.get(s['lane'],0) + 1
+		return counts
+
+	def SampleSheetRecords( self ):
+		"""
+		Returns the samples as the tuples CreateSampleSheet works
+		from: ( flowcell barcode, lane, sample, genome build, barcode,
+		first name, last name, request, second barcode ).
+		"""
+		recs = []
+		for s in self.samples:
+			if s['flowcell_barcode'] is None or s['request'] is None or s['lastname'] is None:
+				continue
+			recs.append( ( s['flowcell_barcode'], s['lane'], s['sample'], s['genome'],
+				s['barcode'], s['firstname'], s['lastname'], s['request'], s['barcode_b'] ) )
+		return recs
+
+	def SampleRequests( self ):
+		"""
+		Returns list of distinct dictionaries with keys samplenum,
+		reqnum and reqdate, the request each sample belongs to.
+		"""
+		seen = set()
+		recs = []
+		for s in self.samples:
+			if s['sample_request'] is None:
+				continue
+			key = ( s['sample'], s['sample_request'] )
+			if key in seen:
+				continue
+			seen.add(key)
+			recs.append( { 'samplenum':s['sample'], 'reqnum':s['sample_request'], 'reqdate':s['sample_request_date'] } )
+		return recs
+
+class RunMetadataFetcher(Logger):
+	"""
+	Fetches RunMetadata objects for many runs using one pooled GNomEx
+	connection and three queries (see queries.py) per batch of run ids.
+	"""
+	# Number of run ids per "in (...)" list.
+	batch_size = 100
+
+	def Fetch( self, run_ids ):
+		"""Returns dictionary of RunMetadata objects indexed by run id.
+		Every requested run id gets an entry, even if GNomEx knows
+		nothing about it."""
+		metadata = {}
+		for run_id in run_ids:
+			metadata[run_id] = RunMetadata(run_id)
+		if not metadata:
+			return metadata
+		with gnomex.GetPool(params.db_user,params.db_password).Connection() as connection:
+			ids = metadata.keys()
+			for i in range(0,len(ids),self.batch_size):
+				self.FetchBatch( connection, ids[i:i+self.batch_size], metadata )
+		self.Log("Fetched GNomEx information for %d runs." % len(metadata))
+		return metadata
+
+	def FetchBatch( self, connection, ids, metadata ):
+		# SQL Server compares the file names case-insensitively and
+		# ignoring trailing blanks, so match them up the same way.
+		index = {}
+		for run_id in ids:
+			index[run_id.strip().lower()] = metadata[run_id]
+
+		for rec in queries.Execute( 'run_channels', (ids,), 'dict', connection ):
+			filename = rec.pop('filename')
+			index[filename.strip().lower()].channels.append( rec )
+
+		for rec in queries.Execute( 'run_samples', (ids,), 'dict', connection ):
+			filename = rec.pop('filename')
+			index[filename.strip().lower()].samples.append( rec )
+
+		for rec in queries.Execute( 'run_applications', (ids,), 'namedtuple', connection ):
+			index[rec.filename.strip().lower()].applications.append( rec.application )
+
+class RunMetadataCache(Logger):
+	"""
+	Cache of RunMetadata objects in the metadata_cache table of the
+	pipeline database (params.db_file), in front of RunMetadataFetcher.
+	Entries expire after params.gnomex_cache_ttl seconds, or after
+	params.gnomex_unregistered_ttl seconds for runs not yet registered
+	in GNomEx, so a newly registered flow cell is noticed quickly.
+	Entries are dropped when a run enters States.reprocess, and sample
+	sheets are always made from freshly fetched information.
+	"""
+	def __init__( self ):
+		self.db_file = params.db_file
+		self.ttl = getattr(params,'gnomex_cache_ttl',4*3600)
+		self.unregistered_ttl = getattr(params,'gnomex_unregistered_ttl',900)
+
+	def DbOpen( self ):
+		# The connection is opened for each call rather than kept, as
+		# run objects using the cache are handed to forked workers.
+		connection = sqlite3.connect(self.db_file,timeout=60)
+		connection.text_factory = bytes
+		return connection
+
+	def Load( self, connection, run_id ):
+		"""Returns the unexpired cached RunMetadata for run_id, or None."""
+		c = connection.cursor()
+		c.execute("select fetched, data from metadata_cache where id = ?",(run_id,))
+		rec = c.fetchone()
+		if rec is None:
+			return None
+		(fetched,data) = rec
+		metadata = RunMetadata(run_id)
+		(metadata.channels,metadata.samples,metadata.applications) = pickle.loads(str(data))
+		if metadata.NumLanes():
+			ttl = self.ttl
+		else:
+			ttl = min(self.ttl,self.unregistered_ttl)
+		if time.time() - fetched > ttl:
+			return None
+		return metadata
+
+	def Store( self, connection, metadata ):
+		data = pickle.dumps((metadata.channels,metadata.samples,metadata.applications),2)
+		c = connection.cursor()
+		c.execute("insert or replace into metadata_cache (id,fetched,data) values (?,?,?)",
+			(metadata.id,time.time(),sqlite3.Binary(data)))
+
+	def Get( self, runs ):
+		"""
+		Given a list of ( run id, state ) tuples, returns dictionary of
+		RunMetadata objects indexed by run id. Runs in the reprocess
+		state have their cache entries invalidated first. Everything
+		not found in the cache is fetched from GNomEx in one batch and
+		cached.
+		"""
+		metadata = {}
+		connection = self.DbOpen()
+		try:
+			for (run_id,state) in runs:
+				if state == States.reprocess:
+					self.Invalidate( run_id, connection )
+					continue
+				cached = self.Load( connection, run_id )
+				if cached is not None:
+					metadata[run_id] = cached
+			missing = [ run_id for (run_id,state) in runs if run_id not in metadata ]
+			if missing:
+				# Don't hold the database while GNomEx answers.
+				connection.commit()
+				fetched = RunMetadataFetcher().Fetch(missing)
+				for run_id in missing:
+					self.Store( connection, fetched[run_id] )
+				metadata.update(fetched)
+			connection.commit()
+		finally:
+			connection.close()
+		self.Log("GNomEx information for %d runs: %d cached, %d fetched." % ( len(runs), len(runs)-len(missing), len(missing) ))
+		return metadata
+
+	def Refresh( self, run_id ):
+		"""Fetches a run's information from GNomEx, bypassing and then
+		updating the cache. Returns the new RunMetadata object."""
+		metadata = RunMetadataFetcher().Fetch([run_id])[run_id]
+		connection = self.DbOpen()
+		try:
+			self.Store( connection, metadata )
+			connection.commit()
+		finally:
+			connection.close()
+		return metadata
+
+	def Invalidate( self, run_id, connection=None ):
+		"""Removes a run's cache entry."""
+		if connection is None:
+			connection = self.DbOpen()
+			try:
+				self.Invalidate( run_id, connection )
+				connection.commit()
+			finally:
+				connection.close()
+			return
+		self.Log("Discarding cached GNomEx information for run %s." % run_id)
+		c = connection.cursor()
+		c.execute("delete from metadata_cache where id = ?",(run_id,))
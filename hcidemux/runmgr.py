@@ -2,20 +2,44 @@
 import sys
 import os
 import re
+import time
+import errno
+import socket
 import traceback
 import sqlite3
+import multiprocessing
 
+import gnomex
 from run import Run
+from runmetadata import RunMetadataCache
 from states import States
 from logger import Logger
+from fsutil import ScanDir
+from runwatcher import RUN_FOLDER_PATTERN
 import pipelineparams as params
         
+def ProcessAlive( pid ):
+	"""Returns True if process pid is running on this host."""
+	try:
+		os.kill( pid, 0 )
+	except OSError, e:
+		return e.errno == errno.EPERM
+	return True
+
 class RunMgr(Logger):
 	def __init__(self):
 		self.db_file = params.db_file
 		
 		# List of run objects that will get processed.
 		self.runs_to_process = []
+
+		# Worker processes advancing runs through the expensive
+		# states, indexed by run id. With no workers allowed every
+		# run is processed sequentially in this process.
+		self.workers = {}
+		self.max_workers = getattr(params,'max_run_workers',2)
+		# Runs the last ProcessRuns call found no free worker for.
+		self.deferred = []
 		
 		# Open pipelinemgr database that tracks run processing. 
 		# If it doesn't exist, a new database is created
@@ -23,10 +47,16 @@ class RunMgr(Logger):
 			self.DbOpen()
 		else:
 			self.DbCreate()
+		self.DbUpgrade()
 		
 	def AddRun( self, run_object ):
 		self.runs_to_process.append( run_object )
 
+	def ClearRuns( self ):
+		"""Forgets the runs added since the last cycle. Used when the
+		RunMgr is kept alive between cycles in daemon mode."""
+		self.runs_to_process = []
+
 	def DbExists(self):
 			#Checks is piplinemgr database file exists
 		return os.path.exists(self.db_file)
@@ -47,11 +77,75 @@ class RunMgr(Logger):
 	def DbOpen( self ):
 		"Open the database."""
 		#self.Log("Opening database.")
-		self.db_connection = sqlite3.connect(self.db_file)
+		# Worker processes share the database, so wait for their
+		# locks rather than failing immediately.
+		self.db_connection = sqlite3.connect(self.db_file,timeout=60)
 		# Set up the database connection so the returned values
 		# are byte strings rather than unicode.
 		self.db_connection.text_factory = bytes
 		
+	def DbUpgrade( self ):
+		"""Adds any tables missing from databases created by older
+		versions of the pipeline."""
+		c = self.db_connection.cursor()
+		# One row per run currently being advanced by some process.
+		c.execute("create table if not exists run_lock (id primary key,pid,hostname,acquired)")
+		# Modification time of each root directory at its last scan.
+		c.execute("create table if not exists discovery (root primary key,mtime)")
+		# GNomEx information about runs, see RunMetadataCache.
+		c.execute("create table if not exists metadata_cache (id primary key,fetched,data)")
+		self.db_connection.commit()
+		c.close()
+
+	def LockRun( self, run_id ):
+		"""Claims a run for this process. Returns False if another live
+		process already holds it. Locks left behind by processes of this
+		host that died are removed; whether a process of another host
+		sharing the database is alive can't be told from here, so its
+		locks are left alone."""
+		hostname = socket.gethostname()
+		c = self.db_connection.cursor()
+		try:
+			c.execute("insert into run_lock (id,pid,hostname,acquired) values (?,?,?,?)",(run_id,os.getpid(),hostname,time.time()))
+			self.db_connection.commit()
+			return True
+		except sqlite3.IntegrityError:
+			self.db_connection.rollback()
+		c.execute("select pid,hostname from run_lock where id = ?",(run_id,))
+		rec = c.fetchone()
+		if rec is None:
+			# Released while we were looking.
+			return self.LockRun( run_id )
+		(pid,lock_hostname) = rec
+		if lock_hostname != hostname:
+			self.Log(["Run",run_id,"is locked by pid",pid,"on host",lock_hostname])
+			return False
+		if not ProcessAlive(pid):
+			self.Log(["Removing stale lock on run",run_id,"held by pid",pid])
+			c.execute("delete from run_lock where id = ? and pid = ? and hostname = ?",(run_id,pid,hostname))
+			self.db_connection.commit()
+			return self.LockRun( run_id )
+		return False
+
+	def TakeLock( self, run_id ):
+		"""Transfers this process's parent's lock on a run to this
+		process. Returns False if the parent doesn't hold it."""
+		c = self.db_connection.cursor()
+		c.execute("update run_lock set pid=?, acquired=? where id=? and pid=? and hostname=?",(os.getpid(),time.time(),run_id,os.getppid(),socket.gethostname()))
+		taken = c.rowcount == 1
+		self.db_connection.commit()
+		return taken
+
+	def UnlockRun( self, run_id ):
+		"""Releases the lock on a run held by a process of this host."""
+		c = self.db_connection.cursor()
+		c.execute("delete from run_lock where id = ? and hostname = ?",(run_id,socket.gethostname()))
+		self.db_connection.commit()
+
+	def IsBusy( self, run_id ):
+		"""Returns True if a worker process started by this RunMgr is still advancing the run."""
+		return run_id in self.workers
+
 	def CleanUp( self ):
 		"""Clean any old and deleted runs out of the database. Any
 		Run in the database that doesn't appear on the filesystem
@@ -66,6 +160,7 @@ class RunMgr(Logger):
 				# ... remove the record from the database.
 				self.Log("Deleting old run %s (%s) from database." % (id,dirname))
 				c.execute("delete from run where id = ?",(id,))
+				c.execute("delete from metadata_cache where id = ?",(id,))
 				self.db_connection.commit()
 
 	def GetActiveRuns( self ):
@@ -90,84 +185,191 @@ class RunMgr(Logger):
 		runs = map( lambda x:x[0], recs )
 		return runs
 
-	def Discover( self, root_directories ):
+	def GetRootMtime( self, root ):
+		"""Returns modification time of root directory when it was last
+		scanned, or None if it hasn't been scanned."""
+		c = self.db_connection.cursor()
+		c.execute("select mtime from discovery where root = ?",(root,))
+		rec = c.fetchone()
+		if rec is None:
+			return None
+		return rec[0]
+
+	def SetRootMtime( self, root, mtime ):
+		c = self.db_connection.cursor()
+		c.execute("insert or replace into discovery (root,mtime) values (?,?)",(root,mtime))
+		self.db_connection.commit()
+
+	def Discover( self, root_directories, full_scan=False ):
 		"""Look for any new runs. Enter them into the database
-		in the starting state."""
+		in the starting state. A new run folder changes the
+		modification time of its root directory, so a root directory
+		whose mtime is unchanged since the last scan is skipped unless
+		full_scan is True."""
 		self.Log("Discovering new sequencing runs.")
 		# Find subdirectories in the runs directory whose name matches the
 		# regular expression.
-		known_run_ids = self.GetAllRunIds()
-		#self.Log(["Known run ids",known_run_ids])
+		known_run_ids = set(self.GetAllRunIds())
 
 		new_runs = []
-		# Pattern consists of Date_SequencerName_RunNumber_Flowcell.
-		# Pattern updated to match both HiSeq and MiSeq runs.
-		# Brett Milash 3/20/2015.
-
-		# Use this pattern to find both Hiseq and Miseq runs:
-		pattern = re.compile("[0-9]*_[A-Z0-9]*_[0-9]*_[A-Z0-9-]*$")
-
-		# Use this pattern to find only Hiseq runs:
-		#pattern = re.compile("[0-9]*_[A-Z0-9]*_[0-9]*_[AB][A-Z0-9]*")
-
 		for runs_dir in root_directories:
-			for subdir in os.listdir(runs_dir):
-				run_full_path=os.path.join(runs_dir,subdir)
-				if not os.path.isdir(run_full_path):
+			scan_start = time.time()
+			mtime = os.stat(runs_dir).st_mtime
+			if not full_scan and mtime == self.GetRootMtime(runs_dir):
+				self.Log(["Runs directory",runs_dir,"unchanged since last scan."])
+				continue
+			for entry in ScanDir(runs_dir):
+				# Check the name first: it costs nothing, while
+				# is_dir() may need a stat() over NFS.
+				if not RUN_FOLDER_PATTERN.match(entry.name):
+					continue
+				if entry.name in known_run_ids:
+					continue
+				if not entry.is_dir():
 					# Skip non-directory files.
 					continue
-				if pattern.match(subdir):
-
-					#self.Log(["Checking subdirectory",subdir])
-					# Found a runs folder.
-					if subdir not in known_run_ids:
-						# Discovered a new run folder. 
-						new_runs.append((subdir,run_full_path))
-					else:
-						self.Log(["Subdirectory",subdir,"already known."])
+				# Discovered a new run folder. 
+				new_runs.append((entry.name,entry.path))
+			# Only remember the mtime if it is safely in the past.
+			# File systems with 1 second timestamps (NFS) could
+			# otherwise hide a folder created later in the same
+			# second as the scan.
+			if scan_start - mtime > 2:
+				self.SetRootMtime(runs_dir,mtime)
+			else:
+				self.SetRootMtime(runs_dir,None)
 		if new_runs:
+			metadata = RunMetadataCache().Get([ ( subdir, States.new ) for (subdir,run_full_path) in new_runs ])
 			for (subdir,run_full_path) in new_runs:
-				run = Run( subdir,run_full_path )
+				run = Run( subdir,run_full_path,metadata=metadata[subdir] )
 				run.DbAdd( self.db_connection )
 				self.Log(["Discovered run",subdir])
 		else:
 			self.Log("No new sequencing runs.")
 			
-	def ProcessRuns(self):
+	def AdvanceRun( self, run, polling_only=False ):
+		"""Moves a run through its state machine until it stops changing
+		state. If polling_only is True, stops as soon as the run reaches
+		a state that isn't one of States.polling_states."""
+		try:
+			prev_state = None
+			while run.state!= prev_state:
+				prev_state = run.state
+				try:
+					if not run.state in run.transition:
+						self.Log(["Skipping run",run.id,", no transitions from state", run.state])
+						break
+					if polling_only and run.state not in States.polling_states:
+						break
+					(method,success_state,fail_state) = run.transition[run.state]
+				
+					if method(run):
+						# Function successful
+						self.Log(["Run",run.id,"transitioned from",run.state,"to",success_state])
+						# Move run to new State.
+						run.state=success_state
+					else:
+						self.Log(["Run",run.id,"transitioned from",run.state,"to",fail_state])
+						run.state = fail_state
+					run.DbUpdate(self.db_connection)
+				except:
+					(etype,evalue,etraceback) = sys.exc_info()
+					details = traceback.format_exception( etype,evalue,etraceback)
+					self.Log(["Exception encountered processing",run.id,". Continuing with next run. Details:" ]+details)
+		except:
+			run.state='o_error_detected'
+			(etype,evalue,etraceback) = sys.exc_info()
+			details = traceback.format_exception( etype,evalue,etraceback)
+			self.Log(["Exception encountered processing",run.id,". Continuing with next run. Details:" ]+details)
+			if run.NotifyError():
+				run.state='p_error_notified'
+			run.DbUpdate(self.db_connection)
+
+	def RunWorker( self, run ):
+		"""Body of a worker process: advances one run as far as it goes."""
+		# The parent closed its database connection before forking.
+		self.DbOpen()
+		self.workers = {}
+		try:
+			if not self.TakeLock( run.id ):
+				self.Log(["PROBLEM! Worker for run",run.id,"couldn't take over its parent's lock. Leaving the run alone."])
+				return
+			try:
+				self.AdvanceRun( run )
+			finally:
+				self.UnlockRun( run.id )
+		finally:
+			# Worker processes exit without running atexit handlers.
+			gnomex.CloseAll()
+
+	def StartWorker( self, run ):
+		"""Hands a run, already locked by this process, to a new worker process."""
+		self.Log(["Starting worker process for run",run.id,"in state",run.state])
+		worker = multiprocessing.Process( target=self.RunWorker, args=(run,), name=run.id )
+		# An sqlite connection must not be open across a fork, and
+		# the worker opens its own GNomEx connections.
+		self.db_connection.close()
+		gnomex.CloseAll()
+		worker.start()
+		self.DbOpen()
+		self.workers[run.id] = worker
+
+	def ReapWorkers( self ):
+		"""Collects finished worker processes. Returns number still running."""
+		for run_id in self.workers.keys():
+			worker = self.workers[run_id]
+			if not worker.is_alive():
+				worker.join()
+				self.Log(["Worker process for run",run_id,"finished, exit code",worker.exitcode])
+				# Normally the worker released the lock itself. If
+				# it died early the lock still names this process.
+				self.UnlockRun( run_id )
+				del self.workers[run_id]
+		return len(self.workers)
+
+	def ProcessRuns(self, wait=True):
+		"""
+		Advances every run added with AddRun. Cheap polling states
+		(see States.polling_states) are handled right here, one run
+		after the other. Runs that reach an expensive state, such as
+		bcl conversion, are handed to up to params.max_run_workers
+		worker processes so they don't hold up the other runs. If wait
+		is True, returns only after all the workers finish. Otherwise
+		runs that found no free worker are left for the next call.
+		A lock in the run_lock table keeps two processes from ever
+		advancing the same run.
+		"""
 		# runs_to_process is set different for each pipeline called
 		# set by giving RunMgr.runs_to_process = list
 		# list is list of runs
+		self.ReapWorkers()
 		self.runs_to_process.sort()
+		heavy_runs = []
+		self.deferred = []
 		for run in self.runs_to_process:
-			try:
-				prev_state = None
-				while run.state!= prev_state:
-					prev_state = run.state
-					try:
-						if not run.state in run.transition:
-							self.Log(["Skipping run",run.id,", no transitions from state", run.state])
-							break
-						(method,success_state,fail_state) = run.transition[run.state]
-					
-						if method(run):
-							# Function successful
-							self.Log(["Run",run.id,"transitioned from",run.state,"to",success_state])
-							# Move run to new State.
-							run.state=success_state
-						else:
-							self.Log(["Run",run.id,"transitioned from",run.state,"to",fail_state])
-							run.state = fail_state
-						run.DbUpdate(self.db_connection)
-					except:
-						(etype,evalue,etraceback) = sys.exc_info()
-						details = traceback.format_exception( etype,evalue,etraceback)
-						self.Log(["Exception encountered processing",run.id,". Continuing with next run. Details:" ]+details)
-			except:
-				run.state='o_error_detected'
-				(etype,evalue,etraceback) = sys.exc_info()
-				details = traceback.format_exception( etype,evalue,etraceback)
-				self.Log(["Exception encountered processing",run.id,". Continuing with next run. Details:" ]+details)
-				if run.NotifyError():
-					run.state='p_error_notified'
-				run.DbUpdate(self.db_connection)
+			if self.IsBusy(run.id) or not self.LockRun(run.id):
+				self.Log(["Run",run.id,"is being processed by another process. Skipping."])
+				continue
+			if self.max_workers > 0:
+				self.AdvanceRun( run, polling_only=True )
+				if run.state in run.transition and run.state not in States.polling_states:
+					# Keep the lock; the worker takes it over.
+					heavy_runs.append( run )
+					continue
+			else:
+				self.AdvanceRun( run )
+			self.UnlockRun( run.id )
+
+		for run in heavy_runs:
+			while self.ReapWorkers() >= self.max_workers and wait:
+				time.sleep(5)
+			if len(self.workers) < self.max_workers:
+				self.StartWorker( run )
+			else:
+				self.Log(["No free worker for run",run.id,"in state",run.state,". Will try again next cycle."])
+				self.UnlockRun( run.id )
+				self.deferred.append( run.id )
+
+		while wait and self.ReapWorkers():
+			time.sleep(5)
 		self.CleanUp()
@@ -0,0 +1,129 @@
+"""
+runwatcher.py - watches the sequencing run directories with inotify so the
+pipeline can react to new run folders and data transfer completion within
+seconds, rather than waiting for the next hourly cron job.
+"""
+import os
+import re
+import time
+
+from logger import Logger
+
+try:
+	import pyinotify
+except ImportError:
+	pyinotify = None
+
+# Run folder names: Date_SequencerName_RunNumber_Flowcell, matching both
+# HiSeq and MiSeq runs. Also used by RunMgr.Discover.
+RUN_FOLDER_PATTERN = re.compile("[0-9]*_[A-Z0-9]*_[0-9]*_[A-Z0-9-]*$")
+
+# Files the sequencer writes when a read, or the whole run, has been
+# transferred.
+MARKER_PATTERN = re.compile("(Basecalling_Netcopy_complete_Read[0-9]*\.txt|RTAComplete(\.txt)?)$")
+
+if pyinotify is not None:
+	class RunEventHandler(pyinotify.ProcessEvent):
+		"""Passes every inotify event on to the RunWatcher."""
+		def my_init( self, watcher=None ):
+			self.watcher = watcher
+
+		def process_default( self, event ):
+			self.watcher.HandleEvent( event.path, event.name, event.dir )
+
+class RunWatcher(Logger):
+	"""
+	RunWatcher watches the root run directories for newly created run
+	folders, and the folders of active runs for the completion marker
+	files. The Wait method blocks until something interesting happens
+	or a timeout expires. If the pyinotify module is not installed
+	Wait simply sleeps for the timeout, which turns the daemon back
+	into a polling loop.
+	"""
+	def __init__( self, root_directories, settle_time=5 ):
+		self.root_directories = [ os.path.realpath(d) for d in root_directories ]
+		# Seconds to keep collecting events after the first one, so
+		# a burst of related events causes a single pipeline cycle.
+		self.settle_time = settle_time
+		self.pending = False
+		# Watch descriptors indexed by watched path.
+		self.watched = {}
+		self.wm = None
+		self.notifier = None
+		if pyinotify is None:
+			self.Log("pyinotify not installed. Run directories will be polled instead of watched.")
+			return
+		self.wm = pyinotify.WatchManager()
+		self.notifier = pyinotify.Notifier( self.wm, RunEventHandler(watcher=self) )
+		for root in self.root_directories:
+			self.Watch( root )
+
+	def Watch( self, path ):
+		"""Adds an inotify watch on a directory. Returns True if the directory is watched."""
+		if self.wm is None:
+			return False
+		if path in self.watched:
+			return True
+		mask = pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO | pyinotify.IN_CLOSE_WRITE
+		wdd = self.wm.add_watch( path, mask )
+		wd = wdd.get( path, -1 )
+		if wd < 0:
+			self.Log(["Unable to watch directory",path])
+			return False
+		self.watched[path] = wd
+		return True
+
+	def Unwatch( self, path ):
+		"""Removes the inotify watch on a directory, if any."""
+		wd = self.watched.pop( path, None )
+		if wd is not None:
+			self.wm.rm_watch( wd, quiet=True )
+
+	def WatchRuns( self, run_directories ):
+		"""
+		Makes the set of watched run folders match run_directories,
+		normally the folders of the currently active runs. Folders of
+		finished runs are no longer watched.
+		"""
+		if self.wm is None:
+			return
+		wanted = set( [ os.path.realpath(d) for d in run_directories ] )
+		for path in self.watched.keys():
+			if path not in wanted and path not in self.root_directories:
+				self.Unwatch( path )
+		for path in wanted:
+			if os.path.isdir( path ):
+				self.Watch( path )
+
+	def HandleEvent( self, path, name, is_dir ):
+		"""Decides whether an inotify event should start a pipeline cycle."""
+		if path in self.root_directories:
+			if is_dir and RUN_FOLDER_PATTERN.match( name ):
+				run_dir = os.path.join( path, name )
+				self.Log(["New run folder",run_dir])
+				self.Watch( run_dir )
+				self.pending = True
+		elif MARKER_PATTERN.match( name ):
+			self.Log(["Found",os.path.join( path, name )])
+			self.pending = True
+
+	def Wait( self, timeout ):
+		"""
+		Waits up to timeout seconds for a new run folder or completion
+		marker. Returns True if one was seen, False on timeout.
+		"""
+		if self.notifier is None:
+			time.sleep( timeout )
+			return False
+		self.pending = False
+		deadline = time.time() + timeout
+		while time.time() < deadline:
+			if self.pending:
+				# Something happened. Give related events a moment
+				# to arrive, then return.
+				deadline = min( deadline, time.time() + self.settle_time )
+			remaining = max( 0, deadline - time.time() )
+			if self.notifier.check_events( int(remaining * 1000) ):
+				self.notifier.read_events()
+				self.notifier.process_events()
+		return self.pending
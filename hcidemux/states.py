@@ -30,3 +30,13 @@ class States:
 	kappapcr_postprocess='a_kappapcr_postprocess'
 	kappapcr_distribute='b_kappapcr_distribute'
 	Miseq_qc='c_miseq_qc'
+	early_index_qc='d_early_index_qc'
+
+	# States whose transition functions are cheap checks: GNomEx
+	# queries, looking for files, sending email. RunMgr drives runs
+	# through these in its own process and hands runs in any other
+	# state to a worker process.
+	polling_states = [ new, check_registered, early_index_qc, wait_for_data,
+		make_sample_sheet, check_single_index_length, check_if_miseq,
+		check_if_patchpcr, patchpcr_sample_sheet, check_if_kappapcr,
+		kappapcr_sample_sheet, archive, error_detected ]
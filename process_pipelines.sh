@@ -6,8 +6,10 @@
 mkdir -p $HOME/Pipeline/logs
 
 # Execute the demultiplexing pipelines. This will create the run database
-# if it doesn't exist already.
-python ./execute_pipeline.py >> `date +$HOME/Pipeline/logs/pipeline.log.\%Y-\%m-\%d` 2>&1
+# if it doesn't exist already. Any arguments (e.g. --daemon) are passed
+# through to execute_pipeline.py. A daemon switches to the next day's log
+# itself, so it's given the log names too.
+python ./execute_pipeline.py "$@" --log-prefix $HOME/Pipeline/logs/pipeline.log. >> `date +$HOME/Pipeline/logs/pipeline.log.\%Y-\%m-\%d` 2>&1
 
 # Clean out the database of any runs that don't exist anymore.
 for dir in `./dbutil.py --dump | cut -f2`
@@ -5,8 +5,7 @@
 # writes out a tab delimited text file for importing into a spreadsheet
 
 import sys
-from hcidemux import gnomex
-from hcidemux import pipelineparams as params
+from hcidemux import queries
 
 TAB="\t"
 
@@ -14,44 +13,10 @@ TAB="\t"
 class ReportProducer():
 	'''Produces a daily report of recently-sequenced samples.'''
 
-	db_user=params.db_user
-	db_password=params.db_password
-	# Updated query to use codeapplication from the 
-	# seqlibprotocolapplication table, since this is the one recorded
-	# by the sequencing lab rather than the one requested by the user
-	# (which may be incorrect).
-	# Need to exclude the MiSeq runs, and select only samples from HiSeq 
-	# runs.
-	query="""select lab.firstname labfirst, 
-		lab.lastname lablast, 
-		appuser.firstname userfirst, 
-		appuser.lastname userlast, 
-		AnalysisGroup.name groupname, 
-		Analysis.number analnumber, 
-		Analysis.name analname, 
-		organism.organism, 
-		genomebuild.genomebuildname 
-		from lab 
-		join Analysis on Analysis.idLab = lab.idlab 
-		join appuser on appuser.idappuser = Analysis.idappuser 
-		join AnalysisGroupItem on AnalysisGroupItem.idAnalysis = Analysis.idAnalysis 
-		left join AnalysisGroup on AnalysisGroupItem.idAnalysisGroup = AnalysisGroup.idAnalysisGroup 
-		join organism on organism.idorganism = Analysis.idorganism 
-		join AnalysisGenomeBuild on AnalysisGenomeBuild.idAnalysis = Analysis.idAnalysis 
-		left join genomebuild on AnalysisGenomeBuild.idgenomebuild = genomebuild.idgenomebuild 
-		where lab.firstname = '%s' and lab.lastname = '%s' 
-		order by analnumber;"""
-
 	#columns = ['Lab', 'Requester', 'Request', 'Project', 'Sample', 'Organism/Genome', 'Lane']
-	def __init__( self ):
-		# Connect to GNomEx
-		g = gnomex.GNomExConnection()
-		self.connection = g.GnConnect(ReportProducer.db_user,ReportProducer.db_password)
-		self.cursor = self.connection.cursor()
-		
 	def RunReport(self,RequestFirstName,RequestLastName):
-		self.cursor.execute(ReportProducer.query % (RequestFirstName, RequestLastName) )
-		results = self.cursor.fetchall()
+		# The query is lab_analyses in hcidemux/queries.py.
+		results = queries.Execute( 'lab_analyses', (RequestFirstName, RequestLastName) )
 		# Document header.
 		# Table header.
 		columns = ['Lab', 'Owner', 'Group', 'Analysis', 'Analysis Name', 'Organism','Genome']
@@ -5,8 +5,7 @@
 # writes out a tab delimited text file for importing into a spreadsheet
 
 import sys
-from hcidemux import gnomex
-import hcidemux.pipelineparams as params
+from hcidemux import queries
 
 TAB="\t"
 
@@ -20,55 +19,10 @@ def HtmlTh( content ):
 class ReportProducer():
 	'''Produces a daily report of recently-sequenced samples.'''
 
-	db_user=params.db_user
-	db_password=params.db_password
-	# Updated query to use codeapplication from the 
-	# seqlibprotocolapplication table, since this is the one recorded
-	# by the sequencing lab rather than the one requested by the user
-	# (which may be incorrect).
-	# Need to exclude the MiSeq runs, and select only samples from HiSeq 
-	# runs.
-	query="""select lab.firstname labfirst, 
-		lab.lastname lablast,
-		appuser.firstname userfirst, 
-		appuser.lastname userlast, 
-		request.number reqnum,
-		project.name projname,
-		sample.number samnum, 
-		sample.name samname,
-		organism.organism,
-		genomebuild.genomebuildname,
-		seqlibprotocolapplication.codeapplication,
-		request.createdate,
-		numbersequencingcycles.numbersequencingcycles,
-		seqruntype.seqruntype
-	from lab
-	join request on request.idlab = lab.idlab
-	join appuser on appuser.idappuser = request.idappuser
-	join project on request.idproject = project.idproject
-	join sample on sample.idrequest = request.idrequest
-	join organism on sample.idorganism = organism.idorganism
-	join sequencelane on sequencelane.idsample = sample.idsample
-	left outer join genomebuild on sequencelane.idgenomebuildalignto = genomebuild.idgenomebuild
-	join seqruntype on sequencelane.idseqruntype = seqruntype.idseqruntype
-	join numbersequencingcycles on sequencelane.idnumbersequencingcycles = numbersequencingcycles.idnumbersequencingcycles
-	join seqlibprotocol on sample.idseqlibprotocol = seqlibprotocol.idseqlibprotocol
-	join seqlibprotocolapplication on seqlibprotocol.idseqlibprotocol = seqlibprotocolapplication.idseqlibprotocol
-	join application on seqlibprotocolapplication.codeapplication = application.codeapplication
-	where lab.firstname = '%s'
-	and lab.lastname = '%s'
-	order by userlast, samnum;"""
-
 	#columns = ['Lab', 'Requester', 'Request', 'Project', 'Sample', 'Organism/Genome', 'Lane']
-	def __init__( self ):
-		# Connect to GNomEx
-		g = gnomex.GNomExConnection()
-		self.connection = g.GnConnect(ReportProducer.db_user,ReportProducer.db_password)
-		self.cursor = self.connection.cursor()
-		
 	def RunReport(self,RequestFirstName,RequestLastName):
-		self.cursor.execute(ReportProducer.query % (RequestFirstName, RequestLastName) )
-		results = self.cursor.fetchall()
+		# The query is lab_requests in hcidemux/queries.py.
+		results = queries.Execute( 'lab_requests', (RequestFirstName, RequestLastName) )
 		# Document header.
 		# Table header.
 		columns = ['Lab', 'Requester', 'RequestNum', 'Project', 'SampleId', 'SampleName', 'Organism','Genome','Cycles','RunType','RequestYear']
@@ -3,8 +3,7 @@
 
 import sys
 import os
-from hcidemux import gnomex
-from hcidemux import pipelineparams as params
+from hcidemux import queries
 
 def ReportRunLabs( run_folder_name ):
 	"""Given a run directory name, list the request numbers and the 
@@ -32,17 +31,7 @@ def ReportRunLabs( run_folder_name ):
 		ifs.close()
 		#print requests
 		# Select request number and lab name.
-		request_string = ",".join(map(lambda x:"'"+x+"'",list(requests)))
-		query = """select request.number,lab.firstname,lab.lastname
-from request,lab
-where request.idlab=lab.idlab
-and request.number in (%s)"""  % request_string
-		#print query
-		g = gnomex.GNomExConnection()
-		connection = g.GnConnect(params.db_user,params.db_password,asdict=True)
-		c = connection.cursor()
-		c.execute(query)
-		results = c.fetchall()
+		results = queries.Execute( 'request_labs', ( list(requests), ), 'dict' )
 		print
 		print "Run folder:", run_folder_name
 		for rec in results:
@@ -5,7 +5,7 @@
 import os
 import sys
 import datetime as dt
-import hcidemux.gnomex
+import hcidemux.queries
 import hcidemux.pipelineparams as params
 
 def EraseCommas(s):
@@ -66,39 +66,10 @@ class IEMSampleSheetCreator:
         Illumina Experiment Manager. 
         """
         # Select lanes from flow cell that are bar coded.
-        g = hcidemux.gnomex.GNomExConnection()
-        connection = g.GnConnect(params.db_user,params.db_password,asdict=False)
-        c = connection.cursor()
-        query = """select flowcell.barcode,
-            flowcellchannel.number,
-            sample.number,
-            genomebuild.genomebuildname,
-            sample.barcodesequence,
-            appuser.firstname, 
-            appuser.lastname,
-            request.number,
-            sample.barcodesequenceb
-            from flowcell
-            join flowcellchannel on flowcellchannel.idflowcell=flowcell.idflowcell
-            join sequencelane on sequencelane.idflowcellchannel = 
-            flowcellchannel.idflowcellchannel
-            join sample on sequencelane.idsample = sample.idsample
-            left outer join genomebuild on sequencelane.idgenomebuildalignto = 
-            genomebuild.idgenomebuild
-            join request on sequencelane.idrequest = request.idrequest
-            join appuser on request.idappuser = appuser.idappuser
-            where flowcellchannel.filename = '%s'\n""" % self.id
         if self.lanes:
-          # Append lane selection to where clause.
-          query += "and flowcellchannel.number in (%s)\n" % str(','.join(map(str,self.lanes)))
-          query += "order by flowcellchannel.number, sample.number;"
-
-        try:
-          c.execute(query)
-        except pymssql.OperationError:
-			sys.stderr.write( query )
-			raise
-        results = c.fetchall()
+            results = hcidemux.queries.Execute( 'samplesheet_lanes', ( self.id, self.lanes ) )
+        else:
+            results = hcidemux.queries.Execute( 'samplesheet', ( self.id, ) )
 		# Open file
 		#ofs = open(samplesheet_fname,'w')
         ofs = sys.stdout
@@ -157,8 +128,6 @@ class IEMSampleSheetCreator:
                 row[0] = 2
                 ofs.write(','.join(row) + '\n')
                 
-        # Close database.
-        connection.close()
 		# Return file name.
         
 if __name__ == "__main__":